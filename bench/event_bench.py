@@ -0,0 +1,327 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Slimbook Service
+# Copyright (C) 2022 Slimbook
+# In case you modify or redistribute this code you must keep the copyright line above.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Replays event streams through event-notify.py using stand-in devices and
+# a fake slimbook backend, and measures the time from an event entering a
+# source handler until its notification is received by a zmq subscriber.
+#
+# usage: event_bench.py [--stream file.json] [--count N] [--model titan]
+#
+# A recorded stream is a json list of records:
+#   {"source": "keyboard", "type": 4, "code": 4, "value": 118}
+#   {"source": "qc71", "type": 1, "code": 469, "value": 1}
+#   {"source": "udev", "subsystem": "power_supply", "action": "change",
+#    "properties": {"POWER_SUPPLY_TYPE": "Mains", "POWER_SUPPLY_ONLINE": "0"}}
+#   {"source": "upower", "profile": "balanced"}
+# an optional "delay" (seconds) passes before injecting the record.
+#
+# Debouncing runs on a fake clock: it advances by --interval between
+# records, or by the record delay, and deferred events are flushed after
+# every record and once at the end. Notifications flushed later are
+# reported in the "deferred" row, timed from the flush.
+
+import fake_slimbook
+
+import os
+import sys
+import json
+import time
+import tempfile
+import importlib.util
+from optparse import OptionParser
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVICE_DIR = os.path.join(BENCH_DIR, "..", "slimbook", "usr", "share", "slimbook")
+
+machine = fake_slimbook.install()
+sys.path.insert(0, SERVICE_DIR)
+
+import evdev
+import zmq
+import debounce
+
+MODELS = {
+    "prox" : (fake_slimbook.SLB_MODEL_PROX, 2),
+    "titan" : (fake_slimbook.SLB_MODEL_TITAN, 3),
+    "creative" : (fake_slimbook.SLB_MODEL_CREATIVE, 3),
+    "excalibur" : (fake_slimbook.SLB_MODEL_EXCALIBUR, 3)
+}
+
+class InputEvent:
+    def __init__(self, type, code, value):
+        self.type = type
+        self.code = code
+        self.value = value
+        self.sec = 0
+        self.usec = 0
+
+class UdevDevice(dict):
+    def __init__(self, subsystem, action, properties):
+        dict.__init__(self, properties)
+        self.subsystem = subsystem
+        self.action = action
+        self.device_node = properties.get("DEVNAME")
+        self.sys_name = os.path.basename(self.device_node or "")
+
+# stand-in for the GLib.Variant handed to D-Bus property handlers
+class Variant:
+    def __init__(self, value):
+        self.value = value
+
+    def unpack(self):
+        return self.value
+
+class FakeTouchpad:
+    MODE_HIDRAW = 1
+    STATE_UNKNOWN = 0
+    STATE_LOCKED = 1
+    STATE_UNLOCKED = 2
+
+    def __init__(self):
+        self.mode = FakeTouchpad.MODE_HIDRAW
+        self.state = FakeTouchpad.STATE_UNLOCKED
+
+    def valid(self):
+        return True
+
+    def toggle(self):
+        if (self.state == FakeTouchpad.STATE_LOCKED):
+            self.state = FakeTouchpad.STATE_UNLOCKED
+        else:
+            self.state = FakeTouchpad.STATE_LOCKED
+
+    def get_state(self):
+        return self.state
+
+    def on_udev_event(self, action, node):
+        pass
+
+def load_service():
+    spec = importlib.util.spec_from_file_location(
+        "event_notify", os.path.join(SERVICE_DIR, "event-notify.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
+
+def synthetic_stream(count):
+    ecodes = evdev.ecodes
+    fn_keys = [
+        fake_slimbook.SLB_SCAN_TOUCHPAD_SWITCH,
+        fake_slimbook.SLB_SCAN_QC71_SUPER_LOCK,
+        fake_slimbook.SLB_SCAN_ENERGY_SAVER_MODE,
+        fake_slimbook.SLB_SCAN_BALANCED_MODE,
+        fake_slimbook.SLB_SCAN_PERFORMANCE_MODE
+    ]
+    module_keys = [ecodes.KEY_FN_F2, ecodes.KEY_FN_F5, ecodes.KEY_FN_F12]
+    profiles = ["power-saver", "balanced", "performance"]
+    records = []
+
+    for n in range(count):
+        kind = n % 4
+
+        if (kind == 0):
+            # plain typing noise around an Fn scancode press and release
+            scan = fn_keys[(n // 4) % len(fn_keys)]
+            records.append({"source": "keyboard", "type": ecodes.EV_MSC, "code": ecodes.MSC_SCAN, "value": 0x1e})
+            records.append({"source": "keyboard", "type": ecodes.EV_KEY, "code": ecodes.KEY_A, "value": 1})
+            records.append({"source": "keyboard", "type": ecodes.EV_SYN, "code": 0, "value": 0})
+            records.append({"source": "keyboard", "type": ecodes.EV_MSC, "code": ecodes.MSC_SCAN, "value": scan})
+            records.append({"source": "keyboard", "type": ecodes.EV_MSC, "code": ecodes.MSC_SCAN, "value": scan})
+        elif (kind == 1):
+            key = module_keys[(n // 4) % len(module_keys)]
+            records.append({"source": "qc71", "type": ecodes.EV_KEY, "code": key, "value": 1})
+            records.append({"source": "qc71", "type": ecodes.EV_KEY, "code": key, "value": 0})
+        elif (kind == 2):
+            online = str((n // 4) % 2)
+            records.append({"source": "udev", "subsystem": "power_supply", "action": "change",
+                "properties": {"POWER_SUPPLY_TYPE": "Mains", "POWER_SUPPLY_ONLINE": online}})
+        else:
+            records.append({"source": "upower", "profile": profiles[(n // 4) % len(profiles)]})
+
+    return records
+
+def percentile(values, p):
+    if (len(values) == 0):
+        return 0.0
+
+    values = sorted(values)
+    n = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+
+    return values[n]
+
+# monotonic clock for the debouncer, only moves when told to
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class Bench:
+    def __init__(self, service, dedupe, interval):
+        self.service = service
+        self.dedupe = dedupe
+        self.interval = interval
+        self.clock = FakeClock()
+        self.published = 0
+        self.keyboard_state = {}
+
+        self.tmp = tempfile.mkdtemp(prefix = "slb-bench-")
+        service.setup_sockets(
+            os.path.join(self.tmp, "pub.socket"), os.path.join(self.tmp, "ctl.socket"))
+
+        self.sub = service.context.socket(zmq.SUB)
+        self.sub.connect("ipc://{0}".format(os.path.join(self.tmp, "pub.socket")))
+        self.sub.setsockopt_string(zmq.SUBSCRIBE, "")
+        # give the subscription time to reach the publisher
+        time.sleep(0.2)
+
+        send_notify = service.send_notify
+
+        def counting_send_notify(code):
+            self.published += 1
+            send_notify(code)
+
+        service.send_notify = counting_send_notify
+        service.set_power_profile = lambda profile: None
+        service.start_qc71_module_reader = lambda: None
+        service.stop_qc71_module_reader = lambda: None
+        service.post_event = service.process_event
+
+        if (not self.dedupe):
+            # a zero window lets every event through
+            service.debouncer = debounce.Debouncer({}, {}, debounce.Leading(0))
+
+        service.debouncer.clock = self.clock
+
+        service.setup_dispatcher(FakeTouchpad(), machine.platform(), machine.model,
+            machine.power_profiles, machine.module_loaded)
+
+    def inject(self, record):
+        source = record["source"]
+
+        if (source == "keyboard"):
+            event = InputEvent(record["type"], record["code"], record["value"])
+            self.service.keyboard_event(event, self.keyboard_state)
+        elif (source == "qc71"):
+            event = InputEvent(record["type"], record["code"], record["value"])
+            self.service.qc71_module_event(event)
+        elif (source == "udev"):
+            device = UdevDevice(record["subsystem"], record.get("action", "change"), record.get("properties", {}))
+            self.service.udev_event(device)
+        elif (source == "upower"):
+            changed = Variant({"ActiveProfile": record["profile"]})
+            self.service.upower_hndlr(None, changed, None)
+
+    # runs step and waits for the notifications it published
+    def measure(self, step, source, latencies):
+        before = self.published
+        t0 = time.perf_counter()
+        step()
+
+        pending = self.published - before
+        if (pending == 0):
+            return 0
+
+        for n in range(pending):
+            self.sub.recv_multipart()
+        t1 = time.perf_counter()
+
+        latencies.setdefault(source, []).append(t1 - t0)
+
+        return pending
+
+    def run(self, records):
+        latencies = {}
+        received = 0
+        start = time.perf_counter()
+
+        for record in records:
+            delay = record.get("delay")
+            self.clock.now += self.interval if delay == None else delay
+
+            received += self.measure(self.service.flush_events, "deferred", latencies)
+            received += self.measure(lambda: self.inject(record), record["source"], latencies)
+
+        # let every pending window expire
+        self.clock.now += 3600
+        received += self.measure(self.service.flush_events, "deferred", latencies)
+
+        elapsed = time.perf_counter() - start
+
+        return latencies, received, elapsed
+
+def main():
+    parser = OptionParser(usage = "usage: %prog [options]")
+    parser.add_option("-s", "--stream", dest = "stream", default = None,
+                      help = "json file with a recorded event stream.")
+    parser.add_option("-n", "--count", dest = "count", type = "int", default = 10000,
+                      help = "number of synthetic event groups.")
+    parser.add_option("-m", "--model", dest = "model", default = "titan",
+                      help = "fake model: {0}.".format(", ".join(MODELS)))
+    parser.add_option("--no-dedupe", action = "store_false", dest = "dedupe", default = True,
+                      help = "let every event through the debounce policies.")
+    parser.add_option("-i", "--interval", dest = "interval", type = "float", default = 0.1,
+                      help = "fake seconds between records without a delay.")
+    (options, args) = parser.parse_args()
+
+    machine.model, machine.power_profiles = MODELS[options.model]
+
+    if (options.stream):
+        with open(options.stream, "r") as f:
+            records = json.load(f)
+    else:
+        records = synthetic_stream(options.count)
+
+    service = load_service()
+    bench = Bench(service, options.dedupe, options.interval)
+    latencies, received, elapsed = bench.run(records)
+
+    stats = service.debouncer.stats()
+    passed = sum(c["passed"] for c in stats.values())
+    deferred = sum(c["deferred"] for c in stats.values())
+    suppressed = sum(c["suppressed"] for c in stats.values())
+
+    # debounce suppressions are on purpose, dispatcher drops are handled
+    # events with nothing to notify
+    print("model:{0} events:{1} notifications:{2} deferred:{3} suppressed:{4} dispatcher dropped:{5}".format(
+        options.model, len(records), received, deferred, suppressed, passed - received))
+    for name in sorted(stats):
+        print("  {0:<8} passed:{1} deferred:{2} suppressed:{3}".format(name,
+            stats[name]["passed"], stats[name]["deferred"], stats[name]["suppressed"]))
+    print("elapsed:{0:.3f}s throughput:{1:.0f} events/s".format(elapsed, len(records) / elapsed))
+    print("{0:<10}{1:>8}{2:>12}{3:>12}{4:>12}{5:>12}".format("source", "count", "p50 us", "p90 us", "p99 us", "max us"))
+
+    everything = []
+    for source in sorted(latencies):
+        values = latencies[source]
+        everything.extend(values)
+        print("{0:<10}{1:>8}{2:>12.1f}{3:>12.1f}{4:>12.1f}{5:>12.1f}".format(source, len(values),
+            percentile(values, 50) * 1e6, percentile(values, 90) * 1e6,
+            percentile(values, 99) * 1e6, max(values) * 1e6))
+
+    if (everything):
+        print("{0:<10}{1:>8}{2:>12.1f}{3:>12.1f}{4:>12.1f}{5:>12.1f}".format("all", len(everything),
+            percentile(everything, 50) * 1e6, percentile(everything, 90) * 1e6,
+            percentile(everything, 99) * 1e6, max(everything) * 1e6))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+# Slimbook Service
+# Copyright (C) 2022 Slimbook
+# In case you modify or redistribute this code you must keep the copyright line above.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# In-memory stand-in for the slimbook python package (info, qc71 and
+# smbios), so service code can run on machines without Slimbook hardware
+# or the slimbook kernel module.
+
+import sys
+import types
+
+SLB_PLATFORM_UNKNOWN = 0x0000
+SLB_PLATFORM_QC71 = 0x0100
+SLB_PLATFORM_Z16 = 0x0200
+SLB_PLATFORM_HMT16 = 0x0400
+
+SLB_MODEL_UNKNOWN = 0x0000
+SLB_MODEL_PROX = 0x0101
+SLB_MODEL_EXECUTIVE = 0x0102
+SLB_MODEL_TITAN = 0x0103
+SLB_MODEL_HERO = 0x0104
+SLB_MODEL_EVO = 0x0105
+SLB_MODEL_CREATIVE = 0x0106
+SLB_MODEL_EXCALIBUR = 0x0201
+
+SLB_QC71_PROFILE_UNKNOWN = 0
+SLB_QC71_PROFILE_ENERGY_SAVER = 1
+SLB_QC71_PROFILE_BALANCED = 2
+SLB_QC71_PROFILE_PERFORMANCE = 3
+SLB_QC71_PROFILE_SILENT = SLB_QC71_PROFILE_ENERGY_SAVER
+SLB_QC71_PROFILE_NORMAL = SLB_QC71_PROFILE_BALANCED
+
+SLB_SCAN_QC71_SUPER_LOCK = 0x68
+SLB_SCAN_QC71_SILENT_MODE = 0x69
+SLB_SCAN_TOUCHPAD_SWITCH = 0x76
+SLB_SCAN_ENERGY_SAVER_MODE = 0x6a
+SLB_SCAN_BALANCED_MODE = 0x6b
+SLB_SCAN_PERFORMANCE_MODE = 0x6c
+
+MODEL_NAME = {
+    SLB_MODEL_PROX : "ProX",
+    SLB_MODEL_EXECUTIVE : "Executive",
+    SLB_MODEL_TITAN : "Titan",
+    SLB_MODEL_HERO : "Hero",
+    SLB_MODEL_EVO : "Evo",
+    SLB_MODEL_CREATIVE : "Creative",
+    SLB_MODEL_EXCALIBUR : "Excalibur"
+}
+
+class Machine:
+    def __init__(self, model = SLB_MODEL_TITAN, power_profiles = 3):
+        self.model = model
+        self.power_profiles = power_profiles
+        self.module_loaded = True
+        self.profile = SLB_QC71_PROFILE_BALANCED
+        self.super_lock = 0
+        self.profile_writes = 0
+
+    def platform(self):
+        if (self.model == SLB_MODEL_UNKNOWN):
+            return SLB_PLATFORM_UNKNOWN
+        return self.model & 0xff00
+
+machine = Machine()
+
+def _info_module():
+    info = types.ModuleType("slimbook.info")
+
+    for key, value in globals().items():
+        if (key.startswith("SLB_")):
+            setattr(info, key, value)
+
+    info.get_model = lambda: machine.model
+    info.get_family = lambda: machine.model
+    info.get_platform = machine.platform
+    info.get_family_name = lambda: MODEL_NAME.get(machine.model, "unknown").lower()
+    info.get_performance_profiles = lambda: machine.power_profiles
+    info.is_module_loaded = lambda: machine.module_loaded
+    info.product_name = lambda: "SLIMBOOK " + MODEL_NAME.get(machine.model, "unknown").upper()
+    info.product_sku = lambda: "FAKE-SKU"
+    info.board_vendor = lambda: "SLIMBOOK"
+    info.bios_version = lambda: "0.0.0"
+    info.ec_firmware_release = lambda: "0.0"
+    info.uptime = lambda: 0
+    info.keyboard_device = lambda: "/dev/null"
+    info.module_device = lambda: "/dev/null"
+
+    return info
+
+def _qc71_module():
+    qc71 = types.ModuleType("slimbook.qc71")
+
+    def profile_set(value):
+        machine.profile = value
+        machine.profile_writes += 1
+
+    qc71.profile_get = lambda: machine.profile
+    qc71.profile_set = profile_set
+    qc71.super_lock_get = lambda: machine.super_lock
+    qc71.manual_control_set = lambda value: None
+
+    return qc71
+
+def install():
+    package = types.ModuleType("slimbook")
+    package.__path__ = []
+    package.info = _info_module()
+    package.qc71 = _qc71_module()
+    package.smbios = types.ModuleType("slimbook.smbios")
+
+    sys.modules["slimbook"] = package
+    sys.modules["slimbook.info"] = package.info
+    sys.modules["slimbook.qc71"] = package.qc71
+    sys.modules["slimbook.smbios"] = package.smbios
+
+    return machine
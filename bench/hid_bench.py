@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Slimbook Service
+# Copyright (C) 2022 Slimbook
+# In case you modify or redistribute this code you must keep the copyright line above.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Measures the touchpad lock path (read the switch feature report, write it
+# back) with the old bytes based feature calls and with iohid.FeatureBuffer.
+#
+# usage: hid_bench.py [--count N] [--device /dev/hidrawN --report-id N]
+#
+# Without --device the hidraw ioctls are replaced by a stand-in that copies
+# like the kernel would, so only the python side cost is measured. With a
+# device the current switch value is written back, so its state is kept.
+
+import os
+import sys
+import time
+import tracemalloc
+from optparse import OptionParser
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVICE_DIR = os.path.join(BENCH_DIR, "..", "slimbook", "usr", "share", "slimbook")
+
+sys.path.insert(0, SERVICE_DIR)
+
+import iohid
+
+# stand-in for fcntl.ioctl on a touchpad switch report
+def fake_ioctl(fd, cmd, arg, mutate = True):
+    if ((cmd & 0xFFFF) == (iohid.HIDIOCGFEATURE & 0xFFFF)):
+        if (isinstance(arg, bytearray) and mutate):
+            arg[1] = 0x03
+            return 0
+
+        return bytes(arg[:1]) + bytes([0x03]) + bytes(arg[2:])
+
+    if (isinstance(arg, bytearray) and mutate):
+        return 0
+
+    return bytes(arg)
+
+# feature calls as they were before FeatureBuffer
+def legacy_set_feature(fd, id, data):
+    cmd = iohid.HIDIOCSFEATURE | ((1 + len(data))<<16)
+    data = bytes([id]) + data
+    return iohid.ioctl(fd, cmd, data)
+
+def legacy_get_feature(fd, id, size):
+    cmd = iohid.HIDIOCGFEATURE | ((1 + size)<<16)
+    data = bytes([id]) + bytes([0]*size)
+    return iohid.ioctl(fd, cmd, data)[1:]
+
+def legacy_path(fd, report_id, feature):
+    value = int(legacy_get_feature(fd, report_id, 1)[0]) & 0x03
+    legacy_set_feature(fd, report_id, bytes([value]))
+
+def buffer_path(fd, report_id, feature):
+    value = feature.get(fd)[0] & 0x03
+    feature.data[0] = value
+    feature.set(fd)
+
+def measure(name, path, fd, report_id, count):
+    feature = iohid.FeatureBuffer(report_id, 1)
+
+    for n in range(100):
+        path(fd, report_id, feature)
+
+    samples = []
+    for n in range(count):
+        start = time.perf_counter_ns()
+        path(fd, report_id, feature)
+        samples.append(time.perf_counter_ns() - start)
+
+    # transient memory of a single call, averaged
+    tracemalloc.start()
+    allocated = 0
+    for n in range(1000):
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        path(fd, report_id, feature)
+        allocated += tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+
+    samples.sort()
+    print("{0:8} {1:10.2f} {2:10.2f} {3:10.2f} {4:12.1f}".format(name,
+        samples[len(samples) // 2] / 1000,
+        samples[int(len(samples) * 0.99)] / 1000,
+        samples[-1] / 1000,
+        allocated / 1000))
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("--count", type = "int", default = 100000, help = "calls per path")
+    parser.add_option("--device", default = None, help = "hidraw node of the touchpad")
+    parser.add_option("--report-id", type = "int", default = 0, help = "switch feature report id")
+    (options, args) = parser.parse_args()
+
+    if (options.device):
+        fd = os.open(options.device, os.O_RDWR)
+    else:
+        fd = -1
+        iohid.ioctl = fake_ioctl
+
+    print("{0:8} {1:>10} {2:>10} {3:>10} {4:>12}".format("path", "p50 us", "p99 us", "max us", "bytes/call"))
+    measure("legacy", legacy_path, fd, options.report_id, options.count)
+    measure("buffer", buffer_path, fd, options.report_id, options.count)
@@ -0,0 +1,146 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Slimbook Service
+# Copyright (C) 2022 Slimbook
+# In case you modify or redistribute this code you must keep the copyright line above.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Loads client.py and event-notify.py (without running their main) under
+# python -X importtime and reports what their imports cost.
+#
+# usage: import_bench.py [--fake] [--top N] [--runs N] [--budget ms]
+#
+# --fake uses the fake slimbook backend from fake_slimbook.py. With
+# --budget the exit status is 1 when an entry point takes longer than the
+# budget or loads a module it should defer.
+
+import os
+import sys
+import subprocess
+from optparse import OptionParser
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVICE_DIR = os.path.join(BENCH_DIR, "..", "slimbook", "usr", "share", "slimbook")
+
+# entry point -> modules that must not be imported at startup
+ENTRY_POINTS = {
+    "client.py" : ["requests", "feedparser", "dateutil", "webbrowser"],
+    "event-notify.py" : ["requests", "feedparser", "dateutil", "webbrowser"]
+}
+
+LOADER = """
+import sys
+sys.path.insert(0, {bench!r})
+sys.path.insert(0, {service!r})
+if ({fake!r}):
+    import fake_slimbook
+    fake_slimbook.install()
+import importlib.util
+spec = importlib.util.spec_from_file_location("entry", {path!r})
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+"""
+
+# returns a list of (self us, cumulative us, depth, name)
+def parse_importtime(output):
+    records = []
+
+    for line in output.splitlines():
+        if (not line.startswith("import time:")):
+            continue
+
+        fields = line[len("import time:"):].split("|")
+        if (len(fields) != 3 or not fields[0].strip().isdigit()):
+            continue
+
+        name = fields[2].rstrip()
+        stripped = name.lstrip()
+        depth = (len(name) - len(stripped) - 1) // 2
+        records.append((int(fields[0]), int(fields[1]), depth, stripped))
+
+    return records
+
+def measure(entry, fake):
+    path = os.path.join(SERVICE_DIR, entry)
+    code = LOADER.format(bench = BENCH_DIR, service = SERVICE_DIR, fake = fake, path = path)
+
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+        stdout = subprocess.DEVNULL, stderr = subprocess.PIPE, text = True)
+
+    records = parse_importtime(proc.stderr)
+    if (proc.returncode != 0):
+        errors = [l for l in proc.stderr.splitlines() if not l.startswith("import time:")]
+        raise RuntimeError("{0} failed to load:\n{1}".format(entry, "\n".join(errors[-10:])))
+
+    return records
+
+def report(entry, fake, runs, top, budget):
+    totals = []
+    modules = {}
+    records = []
+
+    for n in range(runs):
+        records = measure(entry, fake)
+        totals.append(sum(r[1] for r in records if r[2] == 0))
+
+        for us, cumulative, depth, name in records:
+            modules.setdefault(name, []).append((us, cumulative))
+
+    totals.sort()
+    total = totals[len(totals) // 2]
+    loaded = set(r[3] for r in records)
+    forbidden = [m for m in ENTRY_POINTS[entry] if m in loaded]
+
+    print("{0}: {1:.1f} ms in {2} modules (median of {3})".format(entry, total / 1000, len(loaded), runs))
+
+    costs = []
+    for name, samples in modules.items():
+        selfs = sorted(s[0] for s in samples)
+        cumulatives = sorted(s[1] for s in samples)
+        costs.append((selfs[len(selfs) // 2], cumulatives[len(cumulatives) // 2], name))
+
+    costs.sort(reverse = True)
+    print("  {0:>9} {1:>11}  module".format("self ms", "cumul ms"))
+    for us, cumulative, name in costs[:top]:
+        print("  {0:9.2f} {1:11.2f}  {2}".format(us / 1000, cumulative / 1000, name))
+
+    failed = False
+
+    if (forbidden):
+        print("  deferred modules loaded at startup: {0}".format(", ".join(forbidden)))
+        failed = True
+
+    if (budget != None and total / 1000 > budget):
+        print("  over budget: {0:.1f} ms > {1:.1f} ms".format(total / 1000, budget))
+        failed = True
+
+    print()
+
+    return failed
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("--fake", action = "store_true", default = False, help = "use fake slimbook backend")
+    parser.add_option("--top", type = "int", default = 15, help = "modules to list per entry point")
+    parser.add_option("--runs", type = "int", default = 5, help = "runs per entry point")
+    parser.add_option("--budget", type = "float", default = None, help = "startup budget in ms")
+    (options, args) = parser.parse_args()
+
+    failed = False
+    for entry in args or ENTRY_POINTS:
+        failed = report(entry, options.fake, options.runs, options.top, options.budget) or failed
+
+    sys.exit(1 if failed else 0)
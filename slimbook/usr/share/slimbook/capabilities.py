@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+# Slimbook Service
+# Copyright (C) 2022 Slimbook
+# In case you modify or redistribute this code you must keep the copyright line above.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import common
+
+import slimbook.info
+
+import os
+import json
+
+DMI_PATH = "/sys/class/dmi/id/"
+
+# dmi entries that change whenever hardware or firmware does
+DMI_KEY_FILES = ["product_name", "product_sku", "bios_version", "ec_firmware_release"]
+
+# Hardware facts that do not change while the machine is running. They are
+# probed once and stored under /run, keyed by dmi product and firmware
+# versions so a bios or ec update invalidates them.
+class Capabilities:
+    FIELDS = [
+        "key",
+        "model",
+        "platform",
+        "family",
+        "family_name",
+        "product",
+        "sku",
+        "vendor",
+        "bios_version",
+        "ec_firmware",
+        "power_profiles"
+    ]
+
+    def __init__(self, data):
+        for field in Capabilities.FIELDS:
+            setattr(self, field, data.get(field))
+
+    @staticmethod
+    def probe():
+        data = {
+            "key": dmi_key(),
+            "model": slimbook.info.get_model(),
+            "platform": slimbook.info.get_platform(),
+            "family": slimbook.info.get_family(),
+            "family_name": slimbook.info.get_family_name(),
+            "product": slimbook.info.product_name(),
+            "sku": slimbook.info.product_sku(),
+            "vendor": slimbook.info.board_vendor(),
+            "bios_version": slimbook.info.bios_version(),
+            "ec_firmware": slimbook.info.ec_firmware_release(),
+            "power_profiles": slimbook.info.get_performance_profiles()
+        }
+
+        return Capabilities(data)
+
+    def to_dict(self):
+        data = {}
+        for field in Capabilities.FIELDS:
+            data[field] = getattr(self, field)
+
+        return data
+
+def dmi_key():
+    values = []
+
+    for name in DMI_KEY_FILES:
+        try:
+            with open(DMI_PATH + name, "r") as f:
+                values.append(f.read().strip())
+        except:
+            values.append("")
+
+    return "|".join(values)
+
+def from_dict(data):
+    if (data and data.get("key") == dmi_key()):
+        return Capabilities(data)
+
+    return None
+
+def load(path = common.SLB_CAPS_PATH):
+    try:
+        with open(path, "r") as f:
+            return from_dict(json.load(f))
+    except:
+        return None
+
+def store(caps, path = common.SLB_CAPS_PATH):
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok = True)
+
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(caps.to_dict(), f)
+    os.chmod(tmp, 0o644)
+    os.replace(tmp, path)
+
+def get(path = common.SLB_CAPS_PATH):
+    caps = load(path)
+
+    if (caps == None):
+        caps = Capabilities.probe()
+        try:
+            store(caps, path)
+        except:
+            pass
+
+    return caps
@@ -21,10 +21,7 @@
 from common import Configuration
 from common import _
 
-import slimbook.info
-
 import zmq
-import feedparser
 import gi
 
 import logging
@@ -34,13 +31,11 @@ import os
 import sys
 import shutil
 import common
-import webbrowser
-import hashlib
+import capabilities
+import feeds
+import notify
 import time
 import signal
-import fnmatch
-import datetime
-from dateutil import parser
 from optparse import OptionParser
 
 
@@ -97,74 +92,116 @@ def update_server_settings(settings):
     socket.send_json(data)
     socket.close()
         
-class Feed:
-
-    def __init__(self, entry):
-        try:
+capabilities_cache = None
 
-            m = hashlib.md5()
-            m.update(str(entry).encode())
-            
-            self.id = m.hexdigest()
-            self.title = entry.title
-            self.body = entry.description
-            self.link = entry.get("link")
-            self.published = entry.get("published")
-            #print("link:",entry.get("link"))
-            self.tags = []
-            self.icon = "dialog-information"
-            
-            self.cached = False
-            self.old = False
-            
-            if self.published:
-                now = datetime.datetime.now(datetime.timezone.utc)
-                ptime = parser.parse(self.published)
-                delta = now - ptime
-                self.old = delta.days > 90
-            else:
-                self.old = True
-            
-            if (entry.get("tags")):
-                for tag in entry.tags:
-                    term = tag.get("term")
-                    
-                    if (term):
-                        self.tags.append(term)
-                    
-                        if (term == "firmware"):
-                            self.icon = "application-x-firmware"
-            
-        except Exception as e:
-            print(e)
+# never blocks, the server copy is fetched at startup with ServerRequest and
+# the local one is used until it is there
+def get_capabilities():
+    global capabilities_cache
+    
+    if (capabilities_cache == None):
+        capabilities_cache = capabilities.get()
+    
+    return capabilities_cache
 
-def load_cache_feeds():
-    feeds = []
+def set_capabilities(data):
+    global capabilities_cache
     
-    try:
-        cache_file = os.path.expanduser("~/.cache/slimbook-service/feeds.dat")
-        f = open(cache_file,"r")
-        for line in f.readlines():
-            value = line.strip()
-            feeds.append(value)
-        f.close()
-    except:
-        pass
+    caps = capabilities.from_dict(data)
     
-    return feeds
+    # server not running or outdated
+    if (caps != None):
+        capabilities_cache = caps
+
+# A request to the server whose reply is read from the main loop, like
+# notifications. callback gets the reply, or None when there is none.
+class ServerRequest:
+    def __init__(self, cmd, callback, timeout = 1000):
+        self.cmd = cmd
+        self.callback = callback
+        self.socket = zmq_context.socket(zmq.REQ)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.connect("ipc://{0}".format(common.SLB_IPC_CTL_PATH))
+        self.socket.send_json({"cmd": cmd})
+        
+        self.watch = GLib.unix_fd_add_full(GLib.PRIORITY_DEFAULT,
+            self.socket.getsockopt(zmq.FD), GLib.IOCondition.IN, self.on_ready)
+        self.timeout = GLib.timeout_add(timeout, self.on_timeout)
+        # reply may be in before the fd is watched
+        GLib.idle_add(self.on_idle)
     
-def store_cache_feeds(feeds):
-    try:
-        cache_path = os.path.expanduser("~/.cache/slimbook-service/")
-        os.makedirs(cache_path,exist_ok = True)
+    def on_ready(self, fd, condition):
+        self.check()
+        
+        return True
     
-        f = open(cache_path+"feeds.dat","w")
-        for feed in feeds:
-            f.write(feed.id+"\n")
+    def on_idle(self):
+        self.check()
         
-        f.close()
-    except Exception as e:
-        print(e)
+        return False
+    
+    def on_timeout(self):
+        logging.warning("no reply from server to {0}".format(self.cmd))
+        self.timeout = None
+        self.finish(None)
+        
+        return False
+    
+    def check(self):
+        socket = self.socket
+        
+        if (socket == None or not (socket.getsockopt(zmq.EVENTS) & zmq.POLLIN)):
+            return
+        
+        try:
+            data = socket.recv_json()
+        except Exception as e:
+            logging.warning("failed to get reply from server to {0}: {1}".format(self.cmd, e))
+            data = None
+        
+        self.finish(data)
+    
+    def finish(self, data):
+        if (self.watch != None):
+            GLib.source_remove(self.watch)
+            self.watch = None
+        
+        if (self.timeout != None):
+            GLib.source_remove(self.timeout)
+            self.timeout = None
+        
+        self.socket.close()
+        self.socket = None
+        
+        self.callback(data)
+
+# topics shown in the menu, in this order
+STATE_TOPICS = [
+    common.SLB_TOPIC_PROFILE,
+    common.SLB_TOPIC_SUPER_LOCK,
+    common.SLB_TOPIC_TOUCHPAD,
+    common.SLB_TOPIC_WEBCAM,
+    common.SLB_TOPIC_AC
+]
+
+# states without a notification text of their own
+STATE_LABELS = {
+    common.SLB_EVENT_AC_ONLINE : _("Connected to AC power"),
+    common.SLB_EVENT_AC_OFFLINE : _("Running on battery"),
+    common.SLB_EVENT_UPOWER_POWER_SAVER : common.SLB_EVENT_DATA[common.SLB_EVENT_ENERGY_SAVER_MODE][0],
+    common.SLB_EVENT_UPOWER_BALANCED : common.SLB_EVENT_DATA[common.SLB_EVENT_BALANCED_MODE][0],
+    common.SLB_EVENT_UPOWER_PERFORMANCE : common.SLB_EVENT_DATA[common.SLB_EVENT_PERFORMANCE_MODE][0]
+}
+
+def state_label(code):
+    label = STATE_LABELS.get(code)
+    
+    if (label == None):
+        event = common.SLB_EVENT_DATA.get(code)
+        if (event):
+            label = event[0]
+    
+    return label
 
 def check_time_feeds():
     feed = os.path.expanduser("~/.cache/slimbook-service/sb-rss.xml")
@@ -176,6 +213,56 @@ def check_time_feeds():
     else:
         return False
 
+# pixbufs shared by all windows, keyed by (icon name, size)
+pixbuf_cache = {}
+pixbuf_theme = None
+
+def get_pixbuf(icon_name, size):
+    global pixbuf_theme
+    
+    if (pixbuf_theme == None):
+        pixbuf_theme = Gtk.IconTheme.get_default()
+        pixbuf_theme.connect("changed", lambda theme: pixbuf_cache.clear())
+    
+    key = (icon_name, size)
+    pix = pixbuf_cache.get(key)
+    
+    if (pix == None):
+        pix = pixbuf_theme.load_icon(icon_name = icon_name, size = size, flags = Gtk.IconLookupFlags.FORCE_SYMBOLIC)
+        pixbuf_cache[key] = pix
+    
+    return pix
+
+# css is added to the whole screen, so each stylesheet is loaded only once
+css_installed = set()
+
+def install_css(widget, css):
+    if (css in css_installed):
+        return
+    
+    provider = Gtk.CssProvider()
+    provider.load_from_data(css.encode("utf-8"))
+    Gtk.StyleContext.add_provider_for_screen(
+            widget.get_screen(),
+            provider,
+            Gtk.STYLE_PROVIDER_PRIORITY_APPLICATION)
+    
+    css_installed.add(css)
+
+# icon and text row used for list placeholders
+def message_grid(icon_name, text):
+    img = Gtk.Image.new_from_pixbuf(get_pixbuf(icon_name, 32))
+    lbl = Gtk.Label(label = text)
+    
+    grid = Gtk.Grid.new()
+    grid.set_row_spacing(4)
+    grid.set_column_spacing(8)
+    grid.attach(img,0,0,1,4)
+    grid.attach(lbl,1,1,1,1)
+    grid.show_all()
+    
+    return grid
+
 class ServiceIndicator(Gio.Application):
     def __init__(self):
         super().__init__(application_id="slimbook.service",flags=Gio.ApplicationFlags.IS_SERVICE)
@@ -206,18 +293,41 @@ class ServiceIndicator(Gio.Application):
         self.socket = zmq_context.socket(zmq.SUB)
         self.socket.connect("ipc://{0}".format(common.SLB_IPC_PATH))
         self.socket.setsockopt_string(zmq.SUBSCRIBE, "")
-        self.poller = zmq.Poller()
-        self.poller.register(self.socket, zmq.POLLIN)
+        self.gaps = notify.GapDetector()
+        # topic -> last state event, from a snapshot and then notifications
+        self.state = {}
+        self.snapshot_request = None
         
-        GLib.idle_add(self.zmq_loop)
+        # zmq fd is edge triggered, on_zmq_ready drains all pending messages
+        GLib.unix_fd_add_full(GLib.PRIORITY_DEFAULT, self.socket.getsockopt(zmq.FD),
+            GLib.IOCondition.IN, self.on_zmq_ready)
+        # anything already queued won't trigger the fd
+        GLib.idle_add(self.zmq_drain)
         
         self.set_indicator()
         Notify.init('Slimbook')
         
+        # subscribed first, so nothing falls between snapshot and stream
+        self.sync_state()
+        
+        try:
+            ServerRequest(common.CMD_GET_CAPABILITIES, set_capabilities)
+        except Exception as e:
+            logging.warning("failed to request capabilities from server: {0}".format(e))
+        
         GLib.timeout_add_seconds(5,self.on_notifications_timeout)
         
         self.feed_updating = False
         
+        # dialogs are built on first use and hidden when closed
+        self.preferences_dialog = None
+        self.sysinfo_dialog = None
+        self.news_dialog = None
+        
+        self.feed_store = feeds.FeedStore()
+        self.seen = feeds.SeenStore()
+        self.news = []
+        
     def on_name_acquired(self, connection, name):
     
         connection.register_object(
@@ -232,11 +342,82 @@ class ServiceIndicator(Gio.Application):
             self.show_preferences()
             invo.return_value(None)
     
-    def zmq_loop(self):
+    def sync_state(self):
+        # one request at a time
+        if (self.snapshot_request != None):
+            return
+        
+        try:
+            self.snapshot_request = ServerRequest(common.CMD_GET_SNAPSHOT, self.on_snapshot)
+        except Exception as e:
+            logging.warning("failed to request snapshot from server: {0}".format(e))
+    
+    def on_snapshot(self, snapshot):
+        self.snapshot_request = None
+        
+        # server not running or outdated
+        if (snapshot and snapshot.get("states") != None):
+            self.apply_snapshot(snapshot)
+    
+    def apply_snapshot(self, snapshot):
+        # a notification newer than the snapshot may be in already
+        newer = self.gaps.sync(snapshot["sequences"], snapshot.get("instance"))
+        
+        for name, state in snapshot["states"].items():
+            if (name not in newer):
+                self.state[name] = state["code"]
+        
+        self.update_state_menu()
+        logging.info("state synced: {0}".format(", ".join(sorted(self.state))))
+    
+    def update_state_menu(self):
+        shown = False
+        
+        for name, item in self.state_items.items():
+            label = state_label(self.state.get(name))
+            
+            if (label == None):
+                item.hide()
+            else:
+                item.set_label(label)
+                item.show()
+                shown = True
+        
+        self.state_separator.set_visible(shown)
+    
+    def on_zmq_ready(self, fd, condition):
+        self.zmq_drain()
+        
+        return True
+    
+    def zmq_drain(self):
     
-        while self.poller.poll(timeout = 50):
-            data = self.socket.recv_json()
+        while (self.socket.getsockopt(zmq.EVENTS) & zmq.POLLIN):
+            try:
+                data = notify.decode(self.socket.recv_multipart())
+            except ValueError as e:
+                logging.warning("bad notification: {0}".format(e))
+                continue
+            
+            restarts = self.gaps.restarts
+            lost = self.gaps.check(data)
+            # already in the snapshot
+            if (lost == None):
+                continue
+            
             code = data.get("code")
+            
+            if (code in common.SLB_STATE_EVENTS):
+                self.state[data["topic"]] = code
+                self.update_state_menu()
+            
+            if (lost > 0):
+                logging.warning("missed {0} {1} notifications".format(lost, data["topic"]))
+                self.sync_state()
+            elif (self.gaps.restarts != restarts):
+                logging.info("server restarted")
+                self.sync_state()
+            
             event = common.SLB_EVENT_DATA.get(code)
             # avoid crashing on unhandled event codes
             if (event == None):
@@ -244,7 +425,7 @@ class ServiceIndicator(Gio.Application):
             
             self.message("Slimbook",event[0],event[1])
         
-        return True
+        return False
     
     def on_notifications_timeout(self):
         if (self.notifications_enabled):
@@ -286,56 +467,35 @@ class ServiceIndicator(Gio.Application):
         warn_user = False
         
         logging.info("checking news...")
-        cached = load_cache_feeds()
         
-        product = slimbook.info.product_name().lower().strip()
-        sku = slimbook.info.product_sku().lower().strip()
-        family = slimbook.info.get_family_name()
-        ec_firmware = slimbook.info.ec_firmware_release()
-        bios_version = slimbook.info.bios_version()
+        caps = get_capabilities()
+        product = caps.product.lower().strip()
+        sku = caps.sku.lower().strip()
+        family = caps.family_name
+        ec_firmware = caps.ec_firmware
+        bios_version = caps.bios_version
         logging.info("model:{0}".format(product))
         logging.info("sku:{0}".format(sku))
         logging.info("family:{0}".format(family))
         logging.info("ec:{0}".format(ec_firmware))
         logging.info("bios:{0}".format(bios_version))
         
+        identity = {
+            "product": product,
+            "sku": sku,
+            "family": family,
+            "platform": common.PLATFORM_NAME.get(caps.platform, ""),
+            "bios_version": bios_version,
+            "ec_firmware": ec_firmware
+        }
+        
         try:
-            feed = feedparser.parse(os.path.expanduser("~/.cache/slimbook-service/sb-rss.xml"))
-            now = datetime.datetime.now(datetime.timezone.utc)
-
-            for entry in feed["entries"]:
-                nw = Feed(entry)
-                filters = 0
-                match = False
+            for nw in self.feed_store.entries(identity):
+                nw.cached = False
                 
-                for tag in nw.tags:
-                    if (tag.startswith("family:")):
-                        target=tag.split(":")[1]
-                        filters = filters + 1
-                        if (fnmatch.fnmatch(family,target)):
-                            logging.info("feed match family filter:{0}={1}".format(family,target))
-                            match = True
-                    
-                    if (tag.startswith("model:")):
-                        target=tag.split(":")[1]
-                        filters = filters + 1
-                        
-                        if (fnmatch.fnmatch(product,target)):
-                            logging.info("feed match product filter:{0}={1}".format(product,target))
-                            match = True
-                        elif (fnmatch.fnmatch(sku,target)):
-                            logging.info("feed match sku filter:{0}={1}".format(sku,target))
-                            match = True
-                        
-                if (filters > 0 and match == False):
-                    logging.info("entry ignored by filter")
-                    continue
-                    
-                for cid in cached:
-                    if cid == nw.id:
-                        logging.info("id cached:{0}".format(nw.id))
-                        nw.cached = True
-                        break
+                if (nw.id in self.seen):
+                    logging.info("id cached:{0}".format(nw.id))
+                    nw.cached = True
                         
                 news.append(nw)
                 
@@ -350,12 +510,14 @@ class ServiceIndicator(Gio.Application):
                     
                     warn_user = True
             
-            store_cache_feeds(news)
+            self.seen.mark_seen([nw.id for nw in news])
             
                 
         except Exception as e:
             logging.error(e)
         
+        self.news = news
+        
         if (warn_user):
             self.indicator.set_status(appindicator.IndicatorStatus.ATTENTION)
         else:
@@ -422,6 +584,17 @@ class ServiceIndicator(Gio.Application):
         """Create and populate the menu."""
         menu = Gtk.Menu()
 
+        # current state from the service, hidden until known
+        self.state_items = {}
+        for name in STATE_TOPICS:
+            item = Gtk.MenuItem.new_with_label("")
+            item.set_sensitive(False)
+            menu.append(item)
+            self.state_items[name] = item
+        
+        self.state_separator = Gtk.SeparatorMenuItem()
+        menu.append(self.state_separator)
+        
         self.menu_news = Gtk.MenuItem.new_with_label(_('Notifications'))
         self.menu_news.connect('activate', self.on_news_item)
         self.menu_news.show()
@@ -452,9 +625,7 @@ class ServiceIndicator(Gio.Application):
         menu.append(self.report)
 
         bug_item = Gtk.MenuItem(label=_('Report a bug...'))
-        bug_item.connect(
-            'activate', lambda x: webbrowser.open(
-                'https://github.com/slimbook/slimbook_service/issues/new'))
+        bug_item.connect('activate', self.on_bug_item)
         bug_item.show()
         menu.append(bug_item)
         
@@ -502,8 +673,7 @@ this program. If not, see <http://www.gnu.org/licenses/>.
             'Slimbook <dev@slimbook.es>'])
         about_dialog.set_translator_credits(_('translator-credits'))
 
-        theme = Gtk.IconTheme()
-        pix = theme.load_icon(icon_name = common.ICON, size = 125, flags = Gtk.IconLookupFlags.FORCE_SYMBOLIC)
+        pix = get_pixbuf(common.ICON, 125)
         about_dialog.set_icon(pix)
         about_dialog.set_logo(pix)
         about_dialog.set_program_name(common.APPNAME)
@@ -515,18 +685,35 @@ this program. If not, see <http://www.gnu.org/licenses/>.
     def on_sysinfo_item(self, widget, data=None):
         logging.debug("system info")
         widget.set_sensitive(False)
+        thread = threading.Thread(target = self.sysinfo_worker, args = (widget,))
+        thread.daemon = True
+        thread.start()
+    
+    def sysinfo_worker(self, widget):
         info = common.get_system_info()
+        GLib.idle_add(self.on_sysinfo_ready, widget, info)
+    
+    def on_sysinfo_ready(self, widget, info):
+        if (self.sysinfo_dialog == None):
+            self.sysinfo_dialog = SystemInfoDialog()
         
-        sysinfo_dialog = SystemInfoDialog(info)
-        sysinfo_dialog.run()
-        sysinfo_dialog.destroy()
+        self.sysinfo_dialog.set_info(info)
+        self.sysinfo_dialog.run()
+        self.sysinfo_dialog.hide()
         widget.set_sensitive(True)
+        
+        return False
     
     def on_news_item(self, widget, data = None):
         logging.debug("news")
         widget.set_sensitive(False)
-        news_dialog = NotificationsDialog(self)
-        news_dialog.connect('delete-event', self.on_news_delete_event)
+        
+        if (self.news_dialog == None):
+            self.news_dialog = NotificationsDialog(self)
+            self.news_dialog.connect('delete-event', self.on_news_delete_event)
+        else:
+            self.news_dialog.populate()
+            self.news_dialog.present()
     
     def on_quit_item(self, widget, data=None):
         Notify.uninit()
@@ -546,12 +733,20 @@ this program. If not, see <http://www.gnu.org/licenses/>.
         self.show_report()
         widget.set_sensitive(True)
 
+    def on_bug_item(self, widget, data=None):
+        import webbrowser
+        webbrowser.open('https://github.com/slimbook/slimbook_service/issues/new')
+
     # Interface and Method
 
     def on_news_delete_event(self, window, event):
+        self.seen.dismiss([nw.id for nw in self.news])
         self.menu_news.set_sensitive(True)
         self.indicator.set_status(appindicator.IndicatorStatus.ACTIVE) if self.show else self.indicator.set_status(
             appindicator.IndicatorStatus.PASSIVE)
+        
+        window.hide()
+        return True
 
     def on_preferences_close(self, *args):
         self.menu_preferences.set_sensitive(True)
@@ -562,8 +757,13 @@ this program. If not, see <http://www.gnu.org/licenses/>.
         
     def show_preferences(self):
         self.menu_preferences.set_sensitive(False)
-        preferences_dialog = PreferencesDialog()
-        preferences_dialog.connect("preferences-close",self.on_preferences_close)
+        
+        if (self.preferences_dialog == None):
+            self.preferences_dialog = PreferencesDialog()
+            self.preferences_dialog.connect("preferences-close",self.on_preferences_close)
+        else:
+            self.preferences_dialog.load_preferences()
+            self.preferences_dialog.present()
 
     def show_report(self):
         self.report.set_sensitive(False)
@@ -577,13 +777,12 @@ class ReportDialog(Gtk.Window):
 
         self.path = ""
         self.has_ended = False
+        self.job = None
 
         self.connect('delete-event',self.on_report_delete_event)
                 
         self.set_position(Gtk.WindowPosition.CENTER_ALWAYS)
-        theme = Gtk.IconTheme()
-        pix = theme.load_icon(icon_name = common.ICON, size = 64, flags = Gtk.IconLookupFlags.FORCE_SYMBOLIC)
-        self.set_icon(pix)
+        self.set_icon(get_pixbuf(common.ICON, 64))
 
         header = Gtk.HeaderBar()
         header.set_title(_('Generate report'))
@@ -692,28 +891,36 @@ class ReportDialog(Gtk.Window):
 
         self.show_all()
 
-    def prog_bar_proc(self, args):
-        if args[0] == True:
-            self.path_label.set_label(_("Succesful! Dumped at ") + self.path)
-            self.resize(200, 100)
-            self.stack.set_visible_child_name("Message view")
-            self.progress_bar.set_fraction(1.0)
-        else:
-            self.progress_bar.pulse()
+    def on_report_progress(self, line):
+        self.progress_bar.pulse()
+        
+        if (line):
+            self.progress_bar.set_text(line)
+    
+    def on_report_done(self, path, error):
+        self.job = None
+        self.progress_bar.set_fraction(1.0)
         
-        if args[1] != "":
+        if (error != ""):
+            self.err_code = error
             self.err_code_label.set_label(_("Error! Report wasn't able to be generated\nError: ") + self.err_code)
             self.stack.set_visible_child_name("Error view")
-            self.resize(200, 100)
-            self.err_code = args[1]
-
-        if args[2] != "":
-            self.path = args[2]
-
+        else:
+            self.path = path
+            self.path_label.set_label(_("Succesful! Dumped at ") + self.path)
+            self.stack.set_visible_child_name("Message view")
+        
+        self.resize(200, 100)
 
     def on_report_button_common(self, widget, str):
-        self.bar_thread = ReportThread(self.prog_bar_proc, str)
-        self.bar_thread.start()
+        self.job = ReportJob(str, self.on_report_progress, self.on_report_done)
+        
+        try:
+            self.job.start()
+        except GLib.Error as e:
+            self.on_report_done("", e.message)
+            return
+        
         self.disable_buttons()
 
     def on_report_button(self, widget):
@@ -734,17 +941,108 @@ class ReportDialog(Gtk.Window):
 
 
     def on_report_delete_event(self, window, event):
+        if (self.job):
+            self.job.cancel()
+            self.job = None
+        
         self.set_sensitive(False)
 
-class ReportThread(threading.Thread):
-    def __init__(self, cb, report_type):
-        threading.Thread.__init__(self)
-        self.callback = cb
-        self.report_type = report_type
-
-    def run(self):
-        common.report_proc(self, GLib.idle_add, self.callback, self.report_type)
+# Runs slimbookctl report from the GLib main loop: output pipes are read
+# when data is available, the exit status comes from a child watch and
+# the dialog is updated at most every REPORT_UPDATE_INTERVAL ms.
+REPORT_UPDATE_INTERVAL = 100
 
+class ReportJob:
+    def __init__(self, report_type, progress_cb, done_cb):
+        self.report_type = report_type
+        self.progress_cb = progress_cb
+        self.done_cb = done_cb
+        self.pid = None
+        self.status = None
+        self.pipes = 0
+        self.stdout = b""
+        self.last_line = ""
+        self.dirty = False
+        self.timer = None
+    
+    def start(self):
+        flags = GLib.SpawnFlags.SEARCH_PATH | GLib.SpawnFlags.DO_NOT_REAP_CHILD
+        self.pid, stdin, stdout, stderr = GLib.spawn_async(
+            ["slimbookctl", self.report_type],
+            flags = flags,
+            standard_output = True,
+            standard_error = True)
+        
+        for fd in [stdout, stderr]:
+            os.set_blocking(fd, False)
+            GLib.unix_fd_add_full(GLib.PRIORITY_DEFAULT, fd,
+                GLib.IOCondition.IN | GLib.IOCondition.HUP | GLib.IOCondition.ERR,
+                self.on_output, fd == stdout)
+            self.pipes = self.pipes + 1
+        
+        GLib.child_watch_add(GLib.PRIORITY_DEFAULT, self.pid, self.on_child_exit)
+        self.timer = GLib.timeout_add(REPORT_UPDATE_INTERVAL, self.on_timer)
+    
+    def cancel(self):
+        self.progress_cb = None
+        self.done_cb = None
+        
+        if (self.pid and self.status == None):
+            try:
+                os.kill(self.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    
+    def on_output(self, fd, condition, is_stdout):
+        while True:
+            try:
+                data = os.read(fd, 4096)
+            except BlockingIOError:
+                return True
+            
+            if (len(data) == 0):
+                os.close(fd)
+                self.pipes = self.pipes - 1
+                self.finish()
+                return False
+            
+            # stderr is only drained
+            if (is_stdout):
+                self.stdout = self.stdout + data
+                tail = self.stdout[-1024:].decode("utf-8", "replace")
+                lines = [l for l in tail.splitlines() if l.strip()]
+                if (lines):
+                    self.last_line = lines[-1].strip()
+                    self.dirty = True
+    
+    def on_child_exit(self, pid, status):
+        GLib.spawn_close_pid(pid)
+        self.status = os.waitstatus_to_exitcode(status)
+        self.finish()
+    
+    def on_timer(self):
+        if (self.dirty and self.progress_cb):
+            self.progress_cb(self.last_line)
+            self.dirty = False
+        elif (self.progress_cb):
+            self.progress_cb(None)
+        
+        return True
+    
+    def finish(self):
+        if (self.status == None or self.pipes > 0):
+            return
+        
+        if (self.timer):
+            GLib.source_remove(self.timer)
+            self.timer = None
+        
+        error = ""
+        if (self.status != 0):
+            error = common.report_status_message(self.status)
+        
+        if (self.done_cb):
+            self.done_cb(common.report_path(self.stdout.decode("utf-8", "replace")), error)
 
 class PreferencesDialog(Gtk.Window):
     def __init__(self):
@@ -754,9 +1052,7 @@ class PreferencesDialog(Gtk.Window):
         self.connect('delete-event',self.on_delete_event)
         
         self.set_position(Gtk.WindowPosition.CENTER_ALWAYS)
-        theme = Gtk.IconTheme()
-        pix = theme.load_icon(icon_name = common.ICON, size = 64, flags = Gtk.IconLookupFlags.FORCE_SYMBOLIC)
-        self.set_icon(pix)
+        self.set_icon(get_pixbuf(common.ICON, 64))
 
         header = Gtk.HeaderBar()
         header.set_title(_('Slimbook Preferences'))
@@ -823,9 +1119,7 @@ class PreferencesDialog(Gtk.Window):
         table1.attach(self.switch6, 1, 2, 12, 13, xpadding=15, ypadding=15,
                       xoptions=Gtk.AttachOptions.SHRINK)
 
-        self.load_preferences()
-        
-        self.changes = False
+        self.loading = False
         self.switch0.connect('state-set',self.on_switch_state_set)
         self.switch1.connect('state-set',self.on_switch_state_set)
         self.switch2.connect('state-set',self.on_switch_state_set)
@@ -834,15 +1128,21 @@ class PreferencesDialog(Gtk.Window):
         self.switch5.connect('state-set',self.on_switch_state_set)
         self.switch6.connect('state-set',self.on_switch_state_set)
         
+        self.load_preferences()
+        
         self.show_all()
 
     def on_switch_state_set(self, switch, state):
+        if (self.loading):
+            return
+        
         self.btn_save.set_sensitive(True)
         self.changes = True
     
     def on_delete_event(self, window, event):
         self.emit('preferences-close', self.changes)
-        return False
+        self.hide()
+        return True
     
     def on_btn_save_clicked(self, widget):
         self.save_preferences()
@@ -859,6 +1159,7 @@ class PreferencesDialog(Gtk.Window):
             configuration.set_defaults()
             configuration.read()
 
+        self.loading = True
         self.switch0.set_active(configuration.get('show') == True)
         self.switch1.set_active(os.path.exists(common.FILE_AUTO_START))
         self.switch2.set_active(configuration.get('theme') == 'light')
@@ -866,6 +1167,10 @@ class PreferencesDialog(Gtk.Window):
         self.switch4.set_active(configuration.get('trackpad-lock') == True)
         self.switch5.set_active(configuration.get('power-profile') == True)
         self.switch6.set_active(configuration.get('ac-notifications') == True)
+        self.loading = False
+        
+        self.changes = False
+        self.btn_save.set_sensitive(False)
     
     def save_preferences(self):
 
@@ -894,62 +1199,63 @@ class PreferencesDialog(Gtk.Window):
         
 class SystemInfoDialog(Gtk.Dialog):
 
-    def __init__(self,info):
+    CSS = '''
+        list {
+            border-width: 1px;
+            border-style: inset;
+            border-color: lightgrey;
+        }
+        
+        row {
+            border-width: 1px;
+            border-style: outset;
+            border-color: lightgrey;
+            min-height: 32px;
+            min-width: 600px;
+        }
+        '''
+
+    def __init__(self):
         Gtk.Dialog.__init__(self, _('Slimbook System information'),
                             None,
                             modal=True,
                             destroy_with_parent=True,
                             use_header_bar=True
                             )
-                            
-        CSS = '''
-            list {
-                border-width: 1px;
-                border-style: inset;
-                border-color: lightgrey;
-            }
-            
-            row {
-                border-width: 1px;
-                border-style: outset;
-                border-color: lightgrey;
-                min-height: 32px;
-                min-width: 600px;
-            }
-            '''
+        
         self.resize(800,700)
-        self.info = info
+        self.info = []
+        # (row, key label, value label) reused between runs
+        self.rows = []
         
-        provider = Gtk.CssProvider()
-        provider.load_from_data(CSS.encode("utf-8"))
-        style_context = self.get_style_context()
-        style_context.add_provider_for_screen(
-                self.get_screen(),
-                provider,
-                Gtk.STYLE_PROVIDER_PRIORITY_APPLICATION)
+        install_css(self, SystemInfoDialog.CSS)
         
         #btn_copy = Gtk.Button(label=_("Copy"))
-        btn_copy = Gtk.Button.new_from_icon_name("edit-copy",Gtk.IconSize.BUTTON)
-        btn_copy.connect("clicked",self.btn_copy_clicked)
-        self.get_header_bar().pack_end(btn_copy)
+        self.btn_copy = Gtk.Button.new_from_icon_name("edit-copy",Gtk.IconSize.BUTTON)
+        self.btn_copy.connect("clicked",self.btn_copy_clicked)
+        self.get_header_bar().pack_end(self.btn_copy)
         
         scrw = Gtk.ScrolledWindow()
         scrw.set_border_width(12)
-        listbox = Gtk.ListBox()
-        listbox.set_vexpand(True)
-        listbox.set_hexpand(True)
+        self.listbox = Gtk.ListBox()
+        self.listbox.set_vexpand(True)
+        self.listbox.set_hexpand(True)
         
-        listbox.set_selection_mode(Gtk.SelectionMode.NONE)
+        self.listbox.set_selection_mode(Gtk.SelectionMode.NONE)
         
-        scrw.add(listbox)
+        scrw.add(self.listbox)
         self.get_content_area().add(scrw)
         
-        for k in info:
-            key = k[0]
-            value = k[1]
-            label_key = Gtk.Label(label=key)
+        self.show_all()
+    
+    def set_info(self, info):
+        self.info = info
+        self.btn_copy.set_sensitive(True)
+        
+        for n in range(len(self.rows), len(info)):
+            label_key = Gtk.Label()
             #label_key.set_markup("<b>{0}</b>".format(key))
-            label_value = Gtk.Label(label=value)
+            label_value = Gtk.Label()
             
             hbox = Gtk.Box.new(Gtk.Orientation.HORIZONTAL, 0)
             
@@ -958,10 +1264,21 @@ class SystemInfoDialog(Gtk.Dialog):
             
             row = Gtk.ListBoxRow()
             row.add(hbox)
+            row.show_all()
             
-            listbox.add(row)
+            self.listbox.add(row)
+            self.rows.append((row, label_key, label_value))
         
-        self.show_all()
+        while (len(self.rows) > len(info)):
+            row = self.rows.pop()[0]
+            self.listbox.remove(row)
+        
+        # only labels whose text changed get relayouted
+        for (row, label_key, label_value), (key, value) in zip(self.rows, info):
+            if (label_key.get_text() != str(key)):
+                label_key.set_text(str(key))
+            if (label_value.get_text() != str(value)):
+                label_value.set_text(str(value))
         
     def btn_copy_clicked(self,button):
         clipboard = Gtk.Clipboard.get(Gdk.SELECTION_CLIPBOARD)
@@ -975,37 +1292,36 @@ class SystemInfoDialog(Gtk.Dialog):
         clipboard.set_text(txt,-1)
         button.set_sensitive(False)
 
+class FeedItem(GObject.Object):
+    def __init__(self, feed):
+        GObject.Object.__init__(self)
+        self.feed = feed
+
 class NotificationsDialog(Gtk.Window):
 
+    CSS = '''
+        list {
+            border-width: 1px;
+            border-style: inset;
+            border-color: lightgrey;
+        }
+        
+        row {
+            border-width: 1px;
+            border-style: outset;
+            border-color: lightgrey;
+            min-height: 32px;
+            min-width: 400px;
+        }
+        '''
+
     def __init__(self, parent):
         Gtk.Window.__init__(self)
         self.set_modal(True)
         self.parent = parent
         self.set_default_size(500,600)
         
-        CSS = '''
-            list {
-                border-width: 1px;
-                border-style: inset;
-                border-color: lightgrey;
-            }
-            
-            row {
-                border-width: 1px;
-                border-style: outset;
-                border-color: lightgrey;
-                min-height: 32px;
-                min-width: 400px;
-            }
-            '''
-            
-        provider = Gtk.CssProvider()
-        provider.load_from_data(CSS.encode("utf-8"))
-        style_context = self.get_style_context()
-        style_context.add_provider_for_screen(
-                self.get_screen(),
-                provider,
-                Gtk.STYLE_PROVIDER_PRIORITY_APPLICATION)
+        install_css(self, NotificationsDialog.CSS)
         
         parent.connect("feed-update-start", self.on_feed_update_start)
         parent.connect("feed-update-complete", self.on_feed_update_complete)
@@ -1022,76 +1338,91 @@ class NotificationsDialog(Gtk.Window):
         
         vbox = Gtk.VBox(spacing = 12)
         sw = Gtk.ScrolledWindow()
+        
+        # rows are created by the listbox from the store, so updating the
+        # store only builds rows for entries that were not there before
+        self.store = Gio.ListStore.new(FeedItem)
         self.listbox = Gtk.ListBox()
+        self.listbox.bind_model(self.store, self.create_row)
+        self.listbox.set_placeholder(message_grid("face-plain-symbolic", _("Nothing to show")))
         
         self.listbox.set_selection_mode(Gtk.SelectionMode.NONE)
         
+        # shown above the list while the feed is downloaded
+        self.fetching = message_grid("emblem-synchronizing-symbolic", _("Fetching..."))
+        self.fetching.set_no_show_all(True)
+        
         self.add(vbox)
         sw.add(self.listbox)
+        vbox.pack_start(self.fetching,False,False,1)
         vbox.pack_start(sw,True,True,1)
         vbox.set_border_width(16)
         
         self.populate()
         
         self.show_all()
+        
+        if (parent.feed_updating):
+            self.show_feed_update()
+    
+    def create_row(self, item):
+        feed = item.feed
+        
+        grid = Gtk.Grid.new()
+        grid.set_row_spacing(4)
+        grid.set_column_spacing(8)
+        
+        lbl_title = Gtk.Label()
+        lbl_title.set_markup("<b>{0}</b>".format(feed.title))
+        lbl_title.set_halign(Gtk.Align.START)
+        
+        lbl_body = Gtk.Label(label = feed.body)
+        lbl_body.set_halign(Gtk.Align.START)
+        if (feed.link):
+            btn_link = Gtk.LinkButton(uri = feed.link, label = feed.link)
+            btn_link.set_halign(Gtk.Align.START)
+            grid.attach(btn_link,1,2,1,1)
+        
+        img = Gtk.Image.new_from_pixbuf(get_pixbuf(feed.icon, 32))
+        
+        grid.attach(img,0,0,1,4)
+        
+        grid.attach(lbl_title,1,0,1,1)
+        grid.attach(lbl_body,1,1,1,1)
+        
+        row = Gtk.ListBoxRow()
+        row.add(grid)
+        row.show_all()
+        
+        return row
     
     def populate(self):
-        #feeds = check_news()
         feeds = self.parent.check_news()
+        ids = set(feed.id for feed in feeds)
         
-        for feed in feeds:
-            
-            grid = Gtk.Grid.new()
-            grid.set_row_spacing(4)
-            grid.set_column_spacing(8)
-            
-            lbl_title = Gtk.Label()
-            lbl_title.set_markup("<b>{0}</b>".format(feed.title))
-            lbl_title.set_halign(Gtk.Align.START)
-            
-            lbl_body = Gtk.Label(label = feed.body)
-            lbl_body.set_halign(Gtk.Align.START)
-            if (feed.link):
-                btn_link = Gtk.LinkButton(uri = feed.link, label = feed.link)
-                btn_link.set_halign(Gtk.Align.START)
-                grid.attach(btn_link,1,2,1,1)
-             
-            theme = Gtk.IconTheme()
-            pix = theme.load_icon(icon_name = feed.icon, size = 32, flags = Gtk.IconLookupFlags.FORCE_SYMBOLIC)
-            
-            img = Gtk.Image.new_from_pixbuf(pix)
-            
-            grid.attach(img,0,0,1,4)
-            
-            grid.attach(lbl_title,1,0,1,1)
-            grid.attach(lbl_body,1,1,1,1)
-            
-            row = Gtk.ListBoxRow()
-            row.add(grid)
-            
-            self.listbox.add(row)
+        # drop entries that are no longer in the feed
+        for n in reversed(range(self.store.get_n_items())):
+            if (self.store.get_item(n).feed.id not in ids):
+                self.store.remove(n)
         
-        if (len(feeds) == 0):
-            theme = Gtk.IconTheme()
+        # remaining entries keep their rows, new ones are inserted in place
+        for n, feed in enumerate(feeds):
+            count = self.store.get_n_items()
             
-            pix = theme.load_icon(icon_name = "face-plain-symbolic", size = 32, flags = Gtk.IconLookupFlags.FORCE_SYMBOLIC)
+            if (n < count and self.store.get_item(n).feed.id == feed.id):
+                continue
             
-            img = Gtk.Image.new_from_pixbuf(pix)
-            lbl = Gtk.Label(label = _("Nothing to show"))
+            item = None
+            for m in range(n + 1, count):
+                if (self.store.get_item(m).feed.id == feed.id):
+                    item = self.store.get_item(m)
+                    self.store.remove(m)
+                    break
             
-            grid = Gtk.Grid.new()
-            grid.set_row_spacing(4)
-            grid.set_column_spacing(8)
-            grid.attach(img,0,0,1,4)
-            grid.attach(lbl,1,1,1,1)
-                
-            row = Gtk.ListBoxRow()
-            row.add(grid)
+            if (item == None):
+                item = FeedItem(feed)
             
-            self.listbox.add(row)
-        
-        self.listbox.show_all()
-        
+            self.store.insert(n, item)
     
     def on_btn_refresh_clicked(self, widget):
         self.parent.update_feed()
@@ -1104,36 +1435,15 @@ class NotificationsDialog(Gtk.Window):
     
     def show_feed_update(self):
         self.btn_refresh.set_sensitive(False)
-        children = self.listbox.get_children()
-        for child in children:
-            self.listbox.remove(child)
-        
-        theme = Gtk.IconTheme()
-
-        pix = theme.load_icon(icon_name = "emblem-synchronizing-symbolic", size = 32, flags = Gtk.IconLookupFlags.FORCE_SYMBOLIC)
-        
-        img = Gtk.Image.new_from_pixbuf(pix)
-        lbl = Gtk.Label(label = _("Fetching..."))
-        
-        grid = Gtk.Grid.new()
-        grid.set_row_spacing(4)
-        grid.set_column_spacing(8)
-        grid.attach(img,0,0,1,4)
-        grid.attach(lbl,1,1,1,1)
-            
-        row = Gtk.ListBoxRow()
-        row.add(grid)
-            
-        self.listbox.add(row)
-        self.listbox.show_all()
+        self.fetching.show()
         
     def on_feed_update_complete(self, *args):
         self.btn_refresh.set_sensitive(True)
-        children = self.listbox.get_children()
+        self.fetching.hide()
         
-        for child in children:
-            self.listbox.remove(child)
-        self.populate()
+        # when hidden, it is populated again on next show
+        if (self.get_visible()):
+            self.populate()
 
 def manage_autostart(create):
     if not os.path.exists(common.AUTOSTART_DIR):
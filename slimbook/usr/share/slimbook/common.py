@@ -25,9 +25,13 @@ import os, codecs, json
 import subprocess
 import locale
 import gettext
-import requests
 import re
 import signal
+import mmap
+import bisect
+import threading
+import time
+import tempfile
 import sys
 
 LANGDOMAIN = "slimbook"
@@ -104,6 +108,84 @@ SLB_EVENT_DATA = {
     SLB_EVENT_PERFORMANCE_MODE : [_("Performance"),"power-profile-performance-symbolic"]
 }
 
+# notification topics, subscribers can filter by prefix
+SLB_TOPIC_PROFILE = "profile"
+SLB_TOPIC_SUPER_LOCK = "superlock"
+SLB_TOPIC_TOUCHPAD = "touchpad"
+SLB_TOPIC_WEBCAM = "webcam"
+SLB_TOPIC_AC = "ac"
+SLB_TOPIC_MODULE = "module"
+SLB_TOPIC_EVENT = "event"
+
+SLB_EVENT_TOPIC = {
+    SLB_EVENT_QC71_SILENT_MODE_CHANGED : SLB_TOPIC_PROFILE,
+    SLB_EVENT_QC71_SILENT_MODE_ON : SLB_TOPIC_PROFILE,
+    SLB_EVENT_QC71_SILENT_MODE_OFF : SLB_TOPIC_PROFILE,
+    SLB_EVENT_QC71_SILENT_MODE : SLB_TOPIC_PROFILE,
+    SLB_EVENT_QC71_NORMAL_MODE : SLB_TOPIC_PROFILE,
+    SLB_EVENT_QC71_PERFORMANCE_MODE : SLB_TOPIC_PROFILE,
+    SLB_EVENT_QC71_DYNAMIC_MODE : SLB_TOPIC_PROFILE,
+    SLB_EVENT_ENERGY_SAVER_MODE : SLB_TOPIC_PROFILE,
+    SLB_EVENT_BALANCED_MODE : SLB_TOPIC_PROFILE,
+    SLB_EVENT_PERFORMANCE_MODE : SLB_TOPIC_PROFILE,
+    SLB_EVENT_UPOWER_POWER_EVENT : SLB_TOPIC_PROFILE,
+    SLB_EVENT_UPOWER_POWER_SAVER : SLB_TOPIC_PROFILE,
+    SLB_EVENT_UPOWER_BALANCED : SLB_TOPIC_PROFILE,
+    SLB_EVENT_UPOWER_PERFORMANCE : SLB_TOPIC_PROFILE,
+
+    SLB_EVENT_QC71_SUPER_LOCK_CHANGED : SLB_TOPIC_SUPER_LOCK,
+    SLB_EVENT_QC71_SUPER_LOCK_ON : SLB_TOPIC_SUPER_LOCK,
+    SLB_EVENT_QC71_SUPER_LOCK_OFF : SLB_TOPIC_SUPER_LOCK,
+
+    SLB_EVENT_TOUCHPAD_CHANGED : SLB_TOPIC_TOUCHPAD,
+    SLB_EVENT_TOUCHPAD_ON : SLB_TOPIC_TOUCHPAD,
+    SLB_EVENT_TOUCHPAD_OFF : SLB_TOPIC_TOUCHPAD,
+
+    SLB_EVENT_WEBCAM_CHANGED : SLB_TOPIC_WEBCAM,
+    SLB_EVENT_WEBCAM_ON : SLB_TOPIC_WEBCAM,
+    SLB_EVENT_WEBCAM_OFF : SLB_TOPIC_WEBCAM,
+
+    SLB_EVENT_AC_OFFLINE : SLB_TOPIC_AC,
+    SLB_EVENT_AC_ONLINE : SLB_TOPIC_AC,
+
+    SLB_EVENT_QC71_INPUT_LOADED : SLB_TOPIC_MODULE,
+    SLB_EVENT_QC71_INPUT_UNLOADED : SLB_TOPIC_MODULE
+}
+
+# notified events telling the current state of their topic
+SLB_STATE_EVENTS = [
+    SLB_EVENT_QC71_SILENT_MODE_ON,
+    SLB_EVENT_QC71_SILENT_MODE_OFF,
+    SLB_EVENT_QC71_SILENT_MODE,
+    SLB_EVENT_QC71_NORMAL_MODE,
+    SLB_EVENT_QC71_PERFORMANCE_MODE,
+    SLB_EVENT_QC71_DYNAMIC_MODE,
+    SLB_EVENT_ENERGY_SAVER_MODE,
+    SLB_EVENT_BALANCED_MODE,
+    SLB_EVENT_PERFORMANCE_MODE,
+    SLB_EVENT_UPOWER_POWER_SAVER,
+    SLB_EVENT_UPOWER_BALANCED,
+    SLB_EVENT_UPOWER_PERFORMANCE,
+    SLB_EVENT_QC71_SUPER_LOCK_ON,
+    SLB_EVENT_QC71_SUPER_LOCK_OFF,
+    SLB_EVENT_TOUCHPAD_ON,
+    SLB_EVENT_TOUCHPAD_OFF,
+    SLB_EVENT_WEBCAM_ON,
+    SLB_EVENT_WEBCAM_OFF,
+    SLB_EVENT_AC_OFFLINE,
+    SLB_EVENT_AC_ONLINE,
+    SLB_EVENT_QC71_INPUT_LOADED,
+    SLB_EVENT_QC71_INPUT_UNLOADED
+]
+
+# input events that are a state by themselves, even when not notified
+SLB_STATE_SOURCE_EVENTS = [
+    SLB_EVENT_AC_OFFLINE,
+    SLB_EVENT_AC_ONLINE,
+    SLB_EVENT_QC71_INPUT_LOADED,
+    SLB_EVENT_QC71_INPUT_UNLOADED
+]
+
 PARAMS = {
             'first-time': True,
             'version': '',
@@ -149,6 +231,10 @@ OPT_POWER_PROFILE    = "power-profile"
 OPT_AC_NOTIFICATIONS = "ac-notifications"
 
 CMD_LOAD_SETTINGS = "cmd-load"
+CMD_GET_CAPABILITIES = "cmd-capabilities"
+CMD_GET_INPUT_STATS = "cmd-input-stats"
+CMD_GET_EVENT_STATS = "cmd-event-stats"
+CMD_GET_SNAPSHOT = "cmd-snapshot"
 
 QC71_DOUBLE_PROFILE = [slimbook.info.SLB_MODEL_PROX, slimbook.info.SLB_MODEL_EXECUTIVE]
 QC71_TRIPLE_PROFILE = [slimbook.info.SLB_MODEL_TITAN, slimbook.info.SLB_MODEL_HERO, slimbook.info.SLB_MODEL_EVO, slimbook.info.SLB_MODEL_CREATIVE]
@@ -176,6 +262,43 @@ QC71_TRIPLE_PROFILE_TO_NOTIFICATION = {
     slimbook.info.SLB_QC71_PROFILE_PERFORMANCE : SLB_EVENT_PERFORMANCE_MODE
 }
 
+# Fn performance key cycles: current profile -> (next profile, notification, power profile)
+QC71_DOUBLE_PROFILE_CYCLE = {
+    slimbook.info.SLB_QC71_PROFILE_SILENT : (slimbook.info.SLB_QC71_PROFILE_NORMAL, SLB_EVENT_QC71_SILENT_MODE_OFF, POWER_PROFILE_BALANCED),
+    slimbook.info.SLB_QC71_PROFILE_NORMAL : (slimbook.info.SLB_QC71_PROFILE_SILENT, SLB_EVENT_QC71_SILENT_MODE_ON, POWER_PROFILE_POWER_SAVER)
+}
+
+QC71_TRIPLE_PROFILE_CYCLE = {
+    slimbook.info.SLB_QC71_PROFILE_PERFORMANCE : (slimbook.info.SLB_QC71_PROFILE_ENERGY_SAVER, SLB_EVENT_ENERGY_SAVER_MODE, POWER_PROFILE_POWER_SAVER),
+    slimbook.info.SLB_QC71_PROFILE_ENERGY_SAVER : (slimbook.info.SLB_QC71_PROFILE_BALANCED, SLB_EVENT_BALANCED_MODE, POWER_PROFILE_BALANCED),
+    slimbook.info.SLB_QC71_PROFILE_BALANCED : (slimbook.info.SLB_QC71_PROFILE_PERFORMANCE, SLB_EVENT_PERFORMANCE_MODE, POWER_PROFILE_PERFORMANCE)
+}
+
+# indexed by number of performance profiles
+QC71_PROFILE_CYCLE = {
+    2 : QC71_DOUBLE_PROFILE_CYCLE,
+    3 : QC71_TRIPLE_PROFILE_CYCLE
+}
+
+QC71_PROFILE_FROM_UPOWER = {
+    2 : (QC71_DOUBLE_PROFILE_FROM_UPOWER, QC71_DOUBLE_PROFILE_TO_NOTIFICATION),
+    3 : (QC71_TRIPLE_PROFILE_FROM_UPOWER, QC71_TRIPLE_PROFILE_TO_NOTIFICATION)
+}
+
+# Excalibur keyboard shortcuts are only forwarded to power profiles daemon
+EXCALIBUR_PROFILE_EVENTS = {
+    SLB_EVENT_ENERGY_SAVER_MODE : POWER_PROFILE_POWER_SAVER,
+    SLB_EVENT_BALANCED_MODE : POWER_PROFILE_BALANCED,
+    SLB_EVENT_PERFORMANCE_MODE : POWER_PROFILE_PERFORMANCE
+}
+
+# platform names used by feed targeting tags
+PLATFORM_NAME = {
+    slimbook.info.SLB_PLATFORM_QC71 : "qc71",
+    slimbook.info.SLB_PLATFORM_Z16 : "z16",
+    slimbook.info.SLB_PLATFORM_HMT16 : "hmt16"
+}
+
 #set a default dark theme for kde
 xdg_current_desktop = os.environ.get("XDG_CURRENT_DESKTOP")
 if xdg_current_desktop == "KDE":
@@ -196,10 +319,23 @@ FILE_AUTO_START = os.path.join(AUTOSTART_DIR,
                                
 SLB_FEED_URL = "https://github.com/Slimbook-Team/slimbook-notifications-feed/raw/main/slb-rss-{0}.xml"
 SLB_CACHE_PATH = os.path.expanduser("~/.cache/slimbook-service/")
+SLB_FEED_FILE = "sb-rss.xml"
+SLB_FEED_META_FILE = "sb-rss.meta"
+
+# connect, read timeouts in seconds
+FEED_TIMEOUT = (10, 30)
+FEED_RETRIES = 3
 
 SLB_IPC_PATH     = "/var/run/slimbook-service.socket"
 SLB_IPC_CTL_PATH = "/var/run/slimbook-service-ctl.socket"
 
+PCI_IDS_PATH = "/usr/share/misc/pci.ids"
+PCI_IDS_INDEX_PATH = SLB_CACHE_PATH + "pci.idx"
+
+SLB_RUN_PATH = "/var/run/slimbook-service/"
+SLB_CAPS_PATH = SLB_RUN_PATH + "capabilities.json"
+SLB_TOUCHPAD_PATH = SLB_RUN_PATH + "touchpad.json"
+
 def is_package():
     return os.path.abspath(os.path.dirname(__file__)).startswith('/usr')
 
@@ -304,60 +440,222 @@ def _read_file(file):
     
     return data
 
-def _get_pciid(vendor,device):
-    ret=[vendor,device]
+# pci.ids resolver: the file is memory mapped and only a vendor -> offset
+# index is kept, so a lookup reads just the block of the matching vendor.
+# The index is cached on disk and rebuilt when pci.ids changes.
+class PciIds:
+    VENDOR_RE = re.compile(rb"^([0-9a-f]{4})  ", re.M)
     
-    f=open("/usr/share/misc/pci.ids","r")
-    lines=f.readlines()
-    f.close()
+    def __init__(self, path = PCI_IDS_PATH, index_path = PCI_IDS_INDEX_PATH):
+        self.path = path
+        self.index_path = index_path
+        self.stamp = None
+        self.vendors = []
+        self.offsets = []
+        self.data = None
+    
+    def _load_index(self, stamp):
+        try:
+            with open(self.index_path, "r") as f:
+                index = json.load(f)
+            
+            if (index["stamp"] == stamp):
+                return index["vendors"], index["offsets"]
+        except:
+            pass
+        
+        return None
+    
+    def _store_index(self, stamp):
+        try:
+            os.makedirs(os.path.dirname(self.index_path), exist_ok = True)
+            tmp = self.index_path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump({"stamp": stamp, "vendors": self.vendors, "offsets": self.offsets}, f)
+            os.replace(tmp, self.index_path)
+        except:
+            pass
+    
+    def _open(self):
+        st = os.stat(self.path)
+        stamp = [st.st_mtime_ns, st.st_size]
+        
+        if (self.data and self.stamp == stamp):
+            return
+        
+        if (self.data):
+            self.data.close()
+        
+        with open(self.path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        self.stamp = stamp
+        
+        index = self._load_index(stamp)
+        
+        if (index):
+            self.vendors, self.offsets = index
+        else:
+            entries = sorted((m.group(1).decode(), m.start()) for m in PciIds.VENDOR_RE.finditer(self.data))
+            self.vendors = [e[0] for e in entries]
+            self.offsets = [e[1] for e in entries]
+            self._store_index(stamp)
     
-    vm = False
+    def _line(self, offset):
+        end = self.data.find(b"\n", offset)
+        if (end < 0):
+            end = len(self.data)
+        
+        return self.data[offset:end].decode("utf-8", "replace"), end + 1
     
-    for line in lines:
-        if not line[0]=="\t":
-            if vm:
+    def lookup(self, vendor, device):
+        ret = [vendor, device]
+        
+        self._open()
+        
+        n = bisect.bisect_left(self.vendors, vendor)
+        if (n == len(self.vendors) or self.vendors[n] != vendor):
+            return ret
+        
+        line, offset = self._line(self.offsets[n])
+        ret[0] = line[6:].strip()
+        
+        size = len(self.data)
+        prefix = "\t" + device + "  "
+        
+        while (offset < size):
+            line, offset = self._line(offset)
+            
+            if (line.startswith("#") or line.startswith("\t\t") or line == ""):
+                continue
+            
+            if (not line.startswith("\t")):
                 break
             
-            if vendor == line[:4]:
-                ret[0]=line[6:].strip()
-                vm = True
-        else:
-            if vm:
-                if device == line[1:5]:
-                    ret[1]=line[6:].strip()
+            if (line.startswith(prefix)):
+                ret[1] = line[7:].strip()
+                break
+        
+        return ret
+
+_pci_ids = None
+
+def _get_pciid(vendor,device):
+    global _pci_ids
     
-    return ret
+    if (_pci_ids == None):
+        _pci_ids = PciIds()
     
-def _get_cpu():
-    ret = []
+    return _pci_ids.lookup(vendor, device)
+    
+CPU_SYSFS_PATH = "/sys/devices/system/cpu/"
 
-    f = open("/proc/cpuinfo","r")
-    lines = f.readlines()
-    f.close()
+# /proc/cpuinfo fields used for topology, anything else is skipped
+CPUINFO_FIELDS = ("processor", "model name", "physical id", "core id")
+
+class CpuPackage:
+    def __init__(self, model):
+        self.model = model
+        self.cores = set()
+        self.threads = 0
+        # kHz
+        self.max_freq = 0
+
+def _read_sysfs_int(path):
+    try:
+        with open(path, "r") as f:
+            return int(f.read().strip())
+    except:
+        return None
+
+def _read_cpuinfo():
+    cpus = []
+    cpu = None
     
-    model = ""
-    cpus = {}
+    with open("/proc/cpuinfo","r") as f:
+        for line in f:
+            if (not line.startswith(CPUINFO_FIELDS)):
+                continue
+            
+            key, sep, value = line.partition(":")
+            key = key.strip()
+            value = value.strip()
+            
+            if (key == "processor"):
+                cpu = {"processor": int(value)}
+                cpus.append(cpu)
+            elif (cpu != None):
+                cpu[key] = value
+    
+    return cpus
+
+def _sysfs_cpus():
+    cpus = []
+    
+    for name in os.listdir(CPU_SYSFS_PATH):
+        if (re.fullmatch("cpu[0-9]+", name)):
+            cpus.append({"processor": int(name[3:])})
+    
+    return sorted(cpus, key = lambda c: c["processor"])
+
+def _build_cpu_topology():
+    packages = {}
     
-    for line in lines:
-        tmp = line.split(":")
-        if (len(tmp) < 2):
-            continue
+    try:
+        cpus = _read_cpuinfo()
+    except:
+        cpus = []
+    
+    if (len(cpus) == 0):
+        cpus = _sysfs_cpus()
+    
+    for cpu in cpus:
+        path = CPU_SYSFS_PATH + "cpu{0}/".format(cpu["processor"])
+        
+        physical = cpu.get("physical id")
+        if (physical == None):
+            physical = _read_sysfs_int(path + "topology/physical_package_id")
         
-        key = tmp[0].strip()
-        value = tmp[1].strip()
+        core = cpu.get("core id")
+        if (core == None):
+            core = _read_sysfs_int(path + "topology/core_id")
         
-        if (key == "model name"):
-            model = value
+        if (core == None):
+            core = cpu["processor"]
+        
+        package = packages.get(str(physical))
+        if (package == None):
+            package = CpuPackage(cpu.get("model name", ""))
+            packages[str(physical)] = package
+        
+        package.cores.add(str(core))
+        package.threads = package.threads + 1
+        
+        freq = _read_sysfs_int(path + "cpufreq/cpuinfo_max_freq")
+        if (freq and freq > package.max_freq):
+            package.max_freq = freq
+    
+    return packages
+
+_cpu_topology = None
+
+def get_cpu_topology():
+    global _cpu_topology
     
-        if (key == "physical id"):
-            if not value in cpus:
-                cpus[value] = (model,1)
-            else:
-                c,count = cpus[value]
-                cpus[value] = (c,count + 1)
+    if (_cpu_topology == None):
+        _cpu_topology = _build_cpu_topology()
     
-    for k in cpus:
-        ret.append(cpus[k][0] + " x " + str(cpus[k][1]))
+    return _cpu_topology
+
+def _get_cpu():
+    ret = []
+    
+    for k, package in get_cpu_topology().items():
+        txt = "{0} x {1} ({2} cores)".format(package.model, package.threads, len(package.cores))
+        
+        if (package.max_freq > 0):
+            txt = txt + " {0:.2f} GHz".format(package.max_freq / 1000000)
+        
+        ret.append(txt)
      
     return ret
 
@@ -378,38 +676,70 @@ def _get_gpu():
     
     return gpus
     
-def get_system_info():
-    info = []
-    
-    sb_platform = slimbook.info.get_platform()
+# System information is split in collectors, each one producing a group
+# of fields. Collectors run concurrently and keep their result for ttl
+# seconds, None meaning the value never changes while the session lasts.
+class Collector:
+    def __init__(self, name, func, ttl = None):
+        self.name = name
+        self.func = func
+        self.ttl = ttl
+        self.value = None
+        self.stamp = None
+        self.lock = threading.Lock()
     
+    def collect(self):
+        with self.lock:
+            now = time.monotonic()
+            
+            if (self.stamp != None and (self.ttl == None or (now - self.stamp) < self.ttl)):
+                return self.value
+            
+            # failures are not kept, next call tries again
+            try:
+                self.value = self.func()
+            except Exception as e:
+                print("{0} collector failed: {1}".format(self.name, e), file = sys.stderr)
+                self.value = None
+                self.stamp = None
+                return None
+            
+            self.stamp = now
+            
+            return self.value
+
+def _collect_platform():
+    return slimbook.info.get_platform()
+
+def _collect_uptime():
     uptime = slimbook.info.uptime()
     h = int(uptime / 3600)
     m = int((uptime / 60) % 60)
     s = uptime % 60
     
-    txt = "{0}h {1}m {2}s".format(h,m,s)
-    info.append([INFO_UPTIME,txt])
-    
-    try:
-        data = _read_file("/proc/version")
-        info.append([INFO_KERNEL,data[0].strip().split()[2]])
-    except:
-        pass
-    
-    serial=""
-    memory_devices = []
-    disk_devices = []
-    memory = ""
-    uma = ""
-    tdp = ""
-    
-    is_module = INFO_NO
-    fn_lock = ""
-    super_lock = ""
-    silent_mode = ""
-    profile = ""
-    
+    return "{0}h {1}m {2}s".format(h,m,s)
+
+def _collect_kernel():
+    data = _read_file("/proc/version")
+    return data[0].strip().split()[2]
+
+def _slimbookctl_defaults():
+    return {
+        "serial": "",
+        "memory devices": [],
+        "disk devices": [],
+        "memory": "",
+        "uma": "",
+        "tdp": "",
+        "module": INFO_NO,
+        "fn lock": "",
+        "super lock": "",
+        "silent mode": "",
+        "profile": ""
+    }
+
+def _collect_slimbookctl():
+    ret = _slimbookctl_defaults()
     tmp = []
     
     try:
@@ -425,69 +755,71 @@ def get_system_info():
             value = pair[1]
             
             if (key == "serial"):
-                serial = value
+                ret["serial"] = value
             
             if (key == "memory device"):
-                memory_devices.append(value)
+                ret["memory devices"].append(value)
             
             if (key == "disk free/total"):
                 idx = value.find(" ")
                 
-                disk_devices.append(value[:idx] + "    " + value[idx:])
+                ret["disk devices"].append(value[:idx] + "    " + value[idx:])
             
             if (key == "memory free/total"):
-                memory = value
+                ret["memory"] = value
             
             if (key == "module loaded"):
-                is_module = value.capitalize()
+                ret["module"] = value.capitalize()
              
             if (key == "fn lock"):
-                fn_lock = value.capitalize()
+                ret["fn lock"] = value.capitalize()
              
             if (key == "super key lock"):
-                super_lock = value.capitalize()
+                ret["super lock"] = value.capitalize()
              
             if (key == "silent mode"):
-                silent_mode = value.capitalize()
+                ret["silent mode"] = value.capitalize()
 
             if (key == "profile"):
-                profile = value.capitalize()
+                ret["profile"] = value.capitalize()
             
             # warning, this case may change in the future
             if (key == "UMA Framebuffer"):
-                uma = value
+                ret["uma"] = value
    
             if (key == "TDP"):
-                tdp = value
+                ret["tdp"] = value
             
             if (key.startswith("TDP sustained")):
-                tdp = value
-            
-    info.append([INFO_MEM,memory])
+                ret["tdp"] = value
     
-    for d in disk_devices:
-        info.append([INFO_DISK_DEVICE,d])
+    return ret
+
+def _collect_boot():
+    info = []
     
-    try:
-        if (os.path.exists("/sys/firmware/efi")):
-            info.append([INFO_BOOT,"UEFI"])
-            sb = False
-            SB_VAR = "/sys/firmware/efi/efivars/SecureBoot-8be4df61-93ca-11d2-aa0d-00e098032b8c"
-            if (os.path.exists(SB_VAR)):
-                f = open(SB_VAR,"rb")
-                var = list(f.read())
-                if (var[4] == 1):
-                    sb = True
-                f.close()
-
-            if sb:
-                info.append([INFO_SB,INFO_YES])
-            else:
-                info.append([INFO_SB,INFO_NO])
+    if (os.path.exists("/sys/firmware/efi")):
+        info.append([INFO_BOOT,"UEFI"])
+        sb = False
+        SB_VAR = "/sys/firmware/efi/efivars/SecureBoot-8be4df61-93ca-11d2-aa0d-00e098032b8c"
+        if (os.path.exists(SB_VAR)):
+            f = open(SB_VAR,"rb")
+            var = list(f.read())
+            if (var[4] == 1):
+                sb = True
+            f.close()
+
+        if sb:
+            info.append([INFO_SB,INFO_YES])
         else:
-            info.append([INFO_BOOT,"Legacy"])
-    except:
-        pass
+            info.append([INFO_SB,INFO_NO])
+    else:
+        info.append([INFO_BOOT,"Legacy"])
+    
+    return info
+
+def _collect_os():
+    info = []
     
     try:
         if (os.path.exists("/usr/lib/os-release")):
@@ -510,7 +842,7 @@ def get_system_info():
                 info.append([INFO_OS,name + " " + version])
     except:
         pass
-
+    
     try:
         info.append([INFO_DESKTOP, os.environ["XDG_CURRENT_DESKTOP"].replace(":",", ")])
     except:
@@ -521,52 +853,85 @@ def get_system_info():
     except:
         pass
     
-    try:
-        data = _read_file("/sys/class/dmi/id/product_name")
-        info.append([INFO_PRODUCT,data[0].strip()])
-    except:
-        pass
-    
-    try:
-        data = _read_file("/sys/class/dmi/id/bios_version")
-        info.append([INFO_BIOS,data[0].strip()])
-    except:
-        pass
+    return info
+
+def _collect_dmi():
+    info = []
     
-    try:
-        data = _read_file("/sys/class/dmi/id/ec_firmware_release")
-        info.append([INFO_EC,data[0].strip()])
-    except:
-        pass
+    for key, name in [(INFO_PRODUCT, "product_name"), (INFO_BIOS, "bios_version"), (INFO_EC, "ec_firmware_release")]:
+        try:
+            data = _read_file("/sys/class/dmi/id/" + name)
+            info.append([key,data[0].strip()])
+        except:
+            pass
     
-    info.append([INFO_SERIAL,serial])
+    return info
 
-    try:
-        for cpu in _get_cpu():
-            info.append([INFO_CPU, cpu])
-    except:
-        pass
+SYSINFO_COLLECTORS = [
+    Collector("platform", _collect_platform),
+    Collector("uptime", _collect_uptime, 0),
+    Collector("kernel", _collect_kernel),
+    Collector("slimbookctl", _collect_slimbookctl, 2),
+    Collector("boot", _collect_boot),
+    Collector("os", _collect_os),
+    Collector("dmi", _collect_dmi),
+    Collector("cpu", _get_cpu),
+    Collector("gpu", _get_gpu)
+]
+
+def get_system_info():
+    # only the system info dialog gets here
+    import concurrent.futures
     
-    info.append([INFO_TDP,tdp])
+    info = []
+    values = {}
     
-    try:
-        for gpu in _get_gpu():
-            info.append([INFO_GPU,gpu])
-    except:
-        pass
+    with concurrent.futures.ThreadPoolExecutor(max_workers = len(SYSINFO_COLLECTORS)) as executor:
+        futures = [(c.name, executor.submit(c.collect)) for c in SYSINFO_COLLECTORS]
         
-    for m in memory_devices:
+        for name, future in futures:
+            values[name] = future.result()
+    
+    sb_platform = values["platform"]
+    ctl = values["slimbookctl"] or _slimbookctl_defaults()
+    
+    if (values["uptime"]):
+        info.append([INFO_UPTIME,values["uptime"]])
+    
+    if (values["kernel"]):
+        info.append([INFO_KERNEL,values["kernel"]])
+    
+    info.append([INFO_MEM,ctl["memory"]])
+    
+    for d in ctl["disk devices"]:
+        info.append([INFO_DISK_DEVICE,d])
+    
+    info.extend(values["boot"] or [])
+    info.extend(values["os"] or [])
+    info.extend(values["dmi"] or [])
+    
+    info.append([INFO_SERIAL,ctl["serial"]])
+    
+    for cpu in values["cpu"] or []:
+        info.append([INFO_CPU, cpu])
+    
+    info.append([INFO_TDP,ctl["tdp"]])
+    
+    for gpu in values["gpu"] or []:
+        info.append([INFO_GPU,gpu])
+        
+    for m in ctl["memory devices"]:
         info.append([INFO_MEM_DEVICE,m])
         
-    info.append([INFO_UMA,uma])
+    info.append([INFO_UMA,ctl["uma"]])
         
-    if (sb_platform != 0 ):
-        info.append([INFO_MODULE,is_module])
+    if (sb_platform):
+        info.append([INFO_MODULE,ctl["module"]])
         
         if (sb_platform == slimbook.info.SLB_PLATFORM_QC71):
-            info.append([INFO_FN_LOCK,fn_lock])
-            info.append([INFO_SUPER_LOCK,super_lock])
-            info.append([INFO_PROFILE,profile])
+            info.append([INFO_FN_LOCK,ctl["fn lock"]])
+            info.append([INFO_SUPER_LOCK,ctl["super lock"]])
+            info.append([INFO_PROFILE,ctl["profile"]])
     
     return info
 
@@ -579,63 +944,130 @@ def get_lang():
         
     return lang
 
-def download_feed():
-    os.makedirs(SLB_CACHE_PATH,exist_ok = True)
-
-    lang = get_lang()
-    #print(SLB_FEED_URL.format(lang))
-    r = requests.get(SLB_FEED_URL.format(lang), allow_redirects = True)
-
-    path = SLB_CACHE_PATH + "/sb-rss.xml"
-    f = open(path,"wb")
-    f.write(r.content)
-    f.close()
-
-def report_proc(self, glib_cb, cb, report_type):
-        proc = subprocess.Popen(["slimbookctl", report_type], stdout= subprocess.PIPE, stderr= subprocess.PIPE)
-        cb_args = [False, "", ""]
-
-        while(proc.poll() == None):
-            glib_cb(cb, cb_args)  
-
-        proc.wait()
-
-        ret = proc.poll()
-
-        if(ret != 0):            
-            match ret:
-                #should never happen
-                case 1:
-                    cb_args[1] = "error"
-                case -1:
-                    cb_args[1] = "terminal disconnected (SIGHUP)"
-                #should never happen
-                case -2:
-                    cb_args[1] = "process stopping by user(SIGINT)"
-                #should never happen unless OOM?
-                case -9:
-                    cb_args[1] = "process killed (SIGKILL)"
-                case -15:
-                    cb_args[1] = "process terminated (SIGTERM)"
-                #should never happen
-                case -19:
-                    cb_args[1] = "process stopped (SIGSTOP)"
-                #should never happen
-                case -20:
-                    cb_args[1] = "process stopped by user (SIGTSTP)"
-
-        try:
-            o = proc.communicate(timeout = 5) 
-        except TimeoutExpired:
-            proc.kill()
-            o = proc.communicate()
+# Feed download: the cached file keeps ETag/Last-Modified of the response
+# next to it so unchanged feeds are answered with a 304, and it is always
+# replaced atomically so readers never see a partial file.
+class FeedFetcher:
+    def __init__(self, url = None, cache_path = SLB_CACHE_PATH, timeout = FEED_TIMEOUT, retries = FEED_RETRIES):
+        self.url = url
+        self.cache_path = cache_path
+        self.path = os.path.join(cache_path, SLB_FEED_FILE)
+        self.meta_path = os.path.join(cache_path, SLB_FEED_META_FILE)
+        self.timeout = timeout
+        self.retries = retries
+        self.session = None
+    
+    def _get_session(self):
+        if (self.session == None):
+            # requests is only loaded when a feed is actually downloaded,
+            # the service imports this module too and never needs it
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+            
+            retry = Retry(
+                total = self.retries,
+                backoff_factor = 0.5,
+                status_forcelist = [429, 500, 502, 503, 504])
+            adapter = HTTPAdapter(max_retries = retry)
             
-        if re.search(r"\/.*", o[0].decode("utf-8")):
-            cb_args.pop(2)
-            path = re.search(r"\/.*", o[0].decode("utf-8")).group(0)
-            cb_args.append(path)
+            self.session = requests.Session()
+            self.session.mount("http://", adapter)
+            self.session.mount("https://", adapter)
+        
+        return self.session
+    
+    def _load_meta(self):
+        try:
+            with open(self.meta_path, "r") as f:
+                return json.load(f)
+        except:
+            return {}
+    
+    def _write_atomic(self, path, data):
+        fd, tmp = tempfile.mkstemp(dir = self.cache_path, prefix = ".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except:
+            os.unlink(tmp)
+            raise
+    
+    def fetch(self):
+        os.makedirs(self.cache_path, exist_ok = True)
+        
+        url = self.url
+        if (url == None):
+            url = SLB_FEED_URL.format(get_lang())
+        
+        headers = {}
+        meta = self._load_meta()
+        
+        if (meta.get("url") == url and os.path.exists(self.path)):
+            if (meta.get("etag")):
+                headers["If-None-Match"] = meta["etag"]
+            if (meta.get("last-modified")):
+                headers["If-Modified-Since"] = meta["last-modified"]
+        
+        r = self._get_session().get(url, headers = headers, timeout = self.timeout, allow_redirects = True)
+        
+        if (r.status_code == 304):
+            # feed is still valid, just refresh its age
+            os.utime(self.path)
+            return False
+        
+        r.raise_for_status()
+        
+        self._write_atomic(self.path, r.content)
+        
+        meta = {
+            "url": url,
+            "etag": r.headers.get("ETag"),
+            "last-modified": r.headers.get("Last-Modified")
+        }
+        self._write_atomic(self.meta_path, json.dumps(meta).encode("utf-8"))
+        
+        return True
 
-        cb_args.pop(0)
-        cb_args.insert(0, True)
+_feed_fetcher = None
 
-        glib_cb(cb, cb_args)  
+def download_feed():
+    global _feed_fetcher
+    
+    if (_feed_fetcher == None):
+        _feed_fetcher = FeedFetcher()
+    
+    return _feed_fetcher.fetch()
+
+def report_status_message(ret):
+    match ret:
+        #should never happen
+        case 1:
+            return "error"
+        case -1:
+            return "terminal disconnected (SIGHUP)"
+        #should never happen
+        case -2:
+            return "process stopping by user(SIGINT)"
+        #should never happen unless OOM?
+        case -9:
+            return "process killed (SIGKILL)"
+        case -15:
+            return "process terminated (SIGTERM)"
+        #should never happen
+        case -19:
+            return "process stopped (SIGSTOP)"
+        #should never happen
+        case -20:
+            return "process stopped by user (SIGTSTP)"
+    
+    return "exit code {0}".format(ret)
+
+def report_path(output):
+    match = re.search(r"\/.*", output)
+    
+    if (match):
+        return match.group(0)
+    
+    return ""
@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+
+# Slimbook Service
+# Copyright (C) 2022 Slimbook
+# In case you modify or redistribute this code you must keep the copyright line above.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import common
+
+import collections
+import logging
+import time
+
+logger = logging.getLogger("slimbook.service")
+
+# bound for per key state, event codes are a small fixed set anyway
+MAX_KEYS = 256
+
+# Policies keep their state in a dict handed by the Debouncer, one per key.
+# submit() returns the code to dispatch right away or None, and may leave
+# a "pending" code with a "deadline" to be dispatched later by due().
+
+# first event passes, repeats of the same code within window are dropped
+class Leading:
+    per_class = False
+
+    def __init__(self, window):
+        self.window = window
+
+    def submit(self, state, code, now):
+        last = state.get("last")
+
+        if (last != None and now - last < self.window):
+            return None
+
+        state["last"] = now
+        return code
+
+# dispatched window seconds after the last repeat of the same code
+class Trailing:
+    per_class = False
+
+    def __init__(self, window):
+        self.window = window
+
+    def submit(self, state, code, now):
+        state["pending"] = code
+        state["deadline"] = now + self.window
+        return None
+
+# every code of the class within window, counted from the first one, ends
+# up as the latest of them, and only if it differs from the one dispatched
+# before (AC plugged and unplugged in a row is no change at all)
+class Coalesce:
+    per_class = True
+
+    def __init__(self, window):
+        self.window = window
+
+    def submit(self, state, code, now):
+        if (state.get("deadline") == None):
+            state["deadline"] = now + self.window
+
+        state["pending"] = code
+        return None
+
+    # code already known to subscribers, like the state at startup
+    def seed(self, state, code):
+        state["emitted"] = code
+
+    def flush(self, state, code):
+        if (state.get("emitted") == code):
+            return None
+
+        state["emitted"] = code
+        return code
+
+# up to burst events pass at once, refilled at rate per second
+class TokenBucket:
+    per_class = True
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+
+    def submit(self, state, code, now):
+        tokens = state.get("tokens", self.burst)
+        last = state.get("last", now)
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        state["last"] = now
+
+        if (tokens < 1):
+            state["tokens"] = tokens
+            return None
+
+        state["tokens"] = tokens - 1
+        return code
+
+class Debouncer:
+    def __init__(self, classes, policies, default, clock = time.monotonic, max_keys = MAX_KEYS):
+        # event code -> class name, class name -> policy
+        self.classes = classes
+        self.policies = policies
+        self.default = default
+        self.clock = clock
+        self.max_keys = max_keys
+
+        self.states = collections.OrderedDict()
+        self.counters = {}
+
+    def _policy(self, code):
+        name = self.classes.get(code, "default")
+        return name, self.policies.get(name, self.default)
+
+    def _state(self, key):
+        state = self.states.get(key)
+
+        if (state == None):
+            state = {}
+            self.states[key] = state
+
+            # oldest keys without anything pending go first
+            while (len(self.states) > self.max_keys):
+                for old in self.states:
+                    if (self.states[old].get("deadline") == None):
+                        del self.states[old]
+                        break
+                else:
+                    break
+        else:
+            self.states.move_to_end(key)
+
+        return state
+
+    def _count(self, name, counter):
+        counters = self.counters.setdefault(name, {"passed": 0, "suppressed": 0, "deferred": 0})
+        counters[counter] += 1
+
+    # returns the codes to dispatch now
+    def submit(self, code, now = None):
+        if (now == None):
+            now = self.clock()
+
+        name, policy = self._policy(code)
+        key = name if policy.per_class else code
+        state = self._state((policy, key))
+
+        replaced = state.get("pending") != None
+        out = policy.submit(state, code, now)
+
+        if (out != None):
+            self._count(name, "passed")
+            return [out]
+
+        if (state.get("deadline") != None):
+            if (replaced):
+                self._count(name, "suppressed")
+            self._count(name, "deferred")
+        else:
+            logger.debug("suppressed event {0:04X} ({1})".format(code, name))
+            self._count(name, "suppressed")
+
+        return []
+
+    # tells stateful policies the current state, without dispatching it
+    def seed(self, code):
+        name, policy = self._policy(code)
+
+        if (hasattr(policy, "seed")):
+            key = name if policy.per_class else code
+            policy.seed(self._state((policy, key)), code)
+
+    # returns deferred codes whose time has come
+    def due(self, now = None):
+        if (now == None):
+            now = self.clock()
+
+        out = []
+
+        for (policy, key), state in list(self.states.items()):
+            deadline = state.get("deadline")
+
+            if (deadline == None or deadline > now):
+                continue
+
+            code = state.pop("pending")
+            state["deadline"] = None
+            name = self.classes.get(code, "default")
+
+            if (hasattr(policy, "flush")):
+                code = policy.flush(state, code)
+
+            if (code == None):
+                self._count(name, "suppressed")
+            else:
+                self._count(name, "passed")
+                out.append(code)
+
+        return out
+
+    def next_deadline(self):
+        deadlines = [s["deadline"] for s in self.states.values() if s.get("deadline") != None]
+
+        if (len(deadlines) == 0):
+            return None
+
+        return min(deadlines)
+
+    # seconds until next deadline, None when nothing is pending
+    def timeout(self):
+        deadline = self.next_deadline()
+
+        if (deadline == None):
+            return None
+
+        return max(0.0, deadline - self.clock())
+
+    def reset(self):
+        self.states.clear()
+
+    def stats(self):
+        return dict(self.counters)
+
+EVENT_CLASSES = {
+    common.SLB_EVENT_AC_OFFLINE : "ac",
+    common.SLB_EVENT_AC_ONLINE : "ac",
+
+    common.SLB_EVENT_QC71_INPUT_LOADED : "module",
+    common.SLB_EVENT_QC71_INPUT_UNLOADED : "module",
+
+    common.SLB_EVENT_UPOWER_POWER_SAVER : "upower",
+    common.SLB_EVENT_UPOWER_BALANCED : "upower",
+    common.SLB_EVENT_UPOWER_PERFORMANCE : "upower",
+
+    common.SLB_EVENT_QC71_SILENT_MODE_CHANGED : "keys",
+    common.SLB_EVENT_QC71_SUPER_LOCK_CHANGED : "keys",
+    common.SLB_EVENT_TOUCHPAD_CHANGED : "keys",
+    common.SLB_EVENT_WEBCAM_CHANGED : "keys",
+    common.SLB_EVENT_ENERGY_SAVER_MODE : "keys",
+    common.SLB_EVENT_BALANCED_MODE : "keys",
+    common.SLB_EVENT_PERFORMANCE_MODE : "keys"
+}
+
+def default_debouncer():
+    policies = {
+        # plug flapping ends up as a single notification of the final state
+        "ac" : Coalesce(1.0),
+        # loaded from startup scan and from udev
+        "module" : Leading(1.25),
+        "upower" : Leading(1.25),
+        # quick Fn toggles pass, key repeat storms do not
+        "keys" : TokenBucket(rate = 4.0, burst = 3)
+    }
+
+    return Debouncer(EVENT_CLASSES, policies, Leading(1.25))
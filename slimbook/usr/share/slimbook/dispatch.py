@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+
+# Slimbook Service
+# Copyright (C) 2022 Slimbook
+# In case you modify or redistribute this code you must keep the copyright line above.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import common
+
+import slimbook.info
+
+import logging
+
+logger = logging.getLogger("slimbook.service")
+
+# Runtime state shared by event handlers. Hardware access goes through
+# the qc71 backend, touchpad and callbacks given here, so handlers can be
+# driven with fake objects.
+class ServiceContext:
+    def __init__(self, qc71, settings, set_power_profile, touchpad = None, on_module_loaded = None, on_module_unloaded = None):
+        self.qc71 = qc71
+        self.settings = settings
+        self.set_power_profile = set_power_profile
+        self.touchpad = touchpad
+        self.on_module_loaded = on_module_loaded
+        self.on_module_unloaded = on_module_unloaded
+
+        self.module_loaded = False
+        self.ac = False
+        # upower event our own profile change will cause, None if none
+        self.expect_upower_event = None
+        self.restore_profile = slimbook.info.SLB_QC71_PROFILE_BALANCED
+
+# Maps input event codes to handlers. A handler gets the event code and
+# returns the code to be notified, or None to drop it. Events without a
+# handler are notified as they are.
+class Dispatcher:
+    def __init__(self):
+        self.handlers = {}
+
+    def register(self, code, handler):
+        self.handlers[code] = handler
+
+    def unregister(self, code):
+        self.handlers.pop(code, None)
+
+    def dispatch(self, event):
+        handler = self.handlers.get(event)
+
+        if (handler == None):
+            return event
+
+        return handler(event)
+
+def _module_handler(ctx, handler):
+    # qc71 handlers only apply while platform driver is loaded
+    def wrapper(event):
+        if (ctx.module_loaded):
+            return handler(event)
+        return event
+
+    return wrapper
+
+def _power_profile_handler(ctx, profile):
+    def handler(event):
+        ctx.set_power_profile(profile)
+        return event
+
+    return handler
+
+def _module_loaded_handler(ctx, loaded):
+    def handler(event):
+        if (loaded and ctx.on_module_loaded):
+            ctx.on_module_loaded()
+        elif (not loaded and ctx.on_module_unloaded):
+            ctx.on_module_unloaded()
+        ctx.module_loaded = loaded
+        return None
+
+    return handler
+
+def _super_lock_handler(ctx):
+    def handler(event):
+        if (ctx.qc71.super_lock_get() == 1):
+            return common.SLB_EVENT_QC71_SUPER_LOCK_ON
+        return common.SLB_EVENT_QC71_SUPER_LOCK_OFF
+
+    return handler
+
+def _profile_cycle_handler(ctx, cycle):
+    def handler(event):
+        value = ctx.qc71.profile_get()
+        logger.debug("current performance:{0}".format(common.POWER_PROFILE_NAME[value]))
+
+        step = cycle.get(value)
+        if (step == None):
+            return event
+
+        profile, notification, power_profile = step
+        ctx.qc71.profile_set(profile)
+        logger.debug("switching to {0}".format(common.POWER_PROFILE_NAME[profile]))
+        # power profile requests are coalesced, only the last one counts
+        ctx.expect_upower_event = common.POWER_NAME_TO_EVENT[power_profile]
+        ctx.set_power_profile(power_profile)
+
+        return notification
+
+    return handler
+
+def _ac_handler(ctx, online, switch_profile):
+    def handler(event):
+        ctx.ac = online
+        logger.debug("AC Online" if online else "AC Offline")
+
+        if (not switch_profile):
+            return event
+
+        if (online):
+            # restore profile
+            ctx.qc71.profile_set(ctx.restore_profile)
+            profile = ctx.restore_profile
+        else:
+            ctx.restore_profile = ctx.qc71.profile_get()
+            ctx.qc71.profile_set(slimbook.info.SLB_QC71_PROFILE_BALANCED)
+            ctx.qc71.profile_set(slimbook.info.SLB_QC71_PROFILE_ENERGY_SAVER)
+            profile = slimbook.info.SLB_QC71_PROFILE_ENERGY_SAVER
+
+        if (ctx.settings[common.OPT_AC_NOTIFICATIONS] == False):
+            return None
+
+        return common.QC71_TRIPLE_PROFILE_TO_NOTIFICATION[profile]
+
+    return handler
+
+def _upower_handler(ctx, family, from_upower, to_notification):
+    def handler(event):
+        # power profile matching is disabled
+        if (ctx.settings[common.OPT_POWER_PROFILE] == False):
+            return None
+
+        if (ctx.expect_upower_event != None):
+            expected = ctx.expect_upower_event
+            ctx.expect_upower_event = None
+            
+            # when the applied profile was already active no event comes,
+            # so anything else is an external change
+            if (event == expected):
+                logger.debug("Expected UPower event, nothing to do")
+                return None
+
+        # Creative doesn't change TDP without AC
+        if (ctx.ac == False and family == slimbook.info.SLB_MODEL_CREATIVE):
+            return None
+
+        expect = from_upower[event]
+        logger.debug("external power event {0:04X}, expected {1:04X}".format(event,expect))
+        ctx.qc71.profile_set(expect)
+
+        return to_notification[expect]
+
+    return handler
+
+def _touchpad_handler(ctx):
+    def handler(event):
+        if (not ctx.settings[common.OPT_TRACKPAD_LOCK]):
+            return None
+
+        tpad = ctx.touchpad
+        if (tpad == None or not tpad.valid()):
+            #discard event
+            return None
+
+        tpad.toggle()
+        state = tpad.get_state()
+
+        if (state == tpad.STATE_LOCKED):
+            return common.SLB_EVENT_TOUCHPAD_OFF
+        elif (state == tpad.STATE_UNLOCKED):
+            return common.SLB_EVENT_TOUCHPAD_ON
+
+        return None
+
+    return handler
+
+def build_dispatcher(ctx, platform, family, power_profiles):
+    dispatcher = Dispatcher()
+
+    if (family == slimbook.info.SLB_MODEL_EXCALIBUR):
+        for code, profile in common.EXCALIBUR_PROFILE_EVENTS.items():
+            dispatcher.register(code, _power_profile_handler(ctx, profile))
+
+    if (platform == slimbook.info.SLB_PLATFORM_QC71):
+        dispatcher.register(common.SLB_EVENT_QC71_INPUT_LOADED, _module_loaded_handler(ctx, True))
+        dispatcher.register(common.SLB_EVENT_QC71_INPUT_UNLOADED, _module_loaded_handler(ctx, False))
+
+        dispatcher.register(common.SLB_EVENT_QC71_SUPER_LOCK_CHANGED,
+            _module_handler(ctx, _super_lock_handler(ctx)))
+
+        cycle = common.QC71_PROFILE_CYCLE.get(power_profiles)
+        if (cycle):
+            dispatcher.register(common.SLB_EVENT_QC71_SILENT_MODE_CHANGED,
+                _module_handler(ctx, _profile_cycle_handler(ctx, cycle)))
+
+        switch_profile = family in [slimbook.info.SLB_MODEL_CREATIVE, slimbook.info.SLB_MODEL_EVO]
+        dispatcher.register(common.SLB_EVENT_AC_OFFLINE,
+            _module_handler(ctx, _ac_handler(ctx, False, switch_profile)))
+        dispatcher.register(common.SLB_EVENT_AC_ONLINE,
+            _module_handler(ctx, _ac_handler(ctx, True, switch_profile)))
+
+        tables = common.QC71_PROFILE_FROM_UPOWER.get(power_profiles)
+        if (tables):
+            from_upower, to_notification = tables
+            handler = _module_handler(ctx, _upower_handler(ctx, family, from_upower, to_notification))
+            for code in from_upower:
+                dispatcher.register(code, handler)
+
+    dispatcher.register(common.SLB_EVENT_TOUCHPAD_CHANGED, _touchpad_handler(ctx))
+
+    return dispatcher
@@ -20,6 +20,13 @@
 
 import common
 import touchpad
+import dispatch
+import powerprofiles
+import capabilities
+import inputsource
+import debounce
+import notify
+from eventcore import EventCore
 
 import slimbook.info
 import slimbook.qc71
@@ -30,13 +37,14 @@ import zmq
 import evdev
 import pyudev
 
-import subprocess
-from datetime import datetime
+from optparse import OptionParser
 import os
 import sys
+import json
 import logging
 import threading
 import queue
+import types
 import time
 
 logger = logging.getLogger("slimbook.service")
@@ -44,20 +52,18 @@ logging.basicConfig(format='%(levelname)s-%(message)s')
 logger.setLevel(logging.INFO)
 
 context = zmq.Context()
-socket_out = context.socket(zmq.PUB)
-socket_out.bind("ipc://{0}".format(common.SLB_IPC_PATH))
-os.chmod(common.SLB_IPC_PATH, 0o777)
-
-socket_ctl = context.socket(zmq.REP)
-#socket_ctl.setsockopt_string(zmq.SUBSCRIBE, "")
-#socket_ctl.setsockopt(zmq.SUBSCRIBE, b'')
-socket_ctl.bind("ipc://{0}".format(common.SLB_IPC_CTL_PATH))
-os.chmod(common.SLB_IPC_CTL_PATH, 0o777)
+socket_out = None
+socket_ctl = None
+publisher = None
 
 slb_events = queue.Queue()
 
-# whenever platform driver is loaded or not
-module_loaded = False
+# event sink: threaded mode queues events for the main loop while
+# event core mode dispatches them in place
+post_event = slb_events.put
+
+# single threaded event core, None when running on worker threads
+event_core = None
 
 settings = {
     common.OPT_TRACKPAD_LOCK: True,
@@ -65,13 +71,122 @@ settings = {
     common.OPT_AC_NOTIFICATIONS: True
 }
 
+# hardware capabilities, probed once at startup
+caps = None
+
+# Fn key scancodes read from the keyboard, first match wins
+KEYBOARD_SCAN_EVENTS = types.MappingProxyType(dict(reversed([
+    (slimbook.info.SLB_SCAN_QC71_SUPER_LOCK, common.SLB_EVENT_QC71_SUPER_LOCK_CHANGED),
+    (slimbook.info.SLB_SCAN_QC71_SILENT_MODE, common.SLB_EVENT_QC71_SILENT_MODE_CHANGED),
+    (slimbook.info.SLB_SCAN_TOUCHPAD_SWITCH, common.SLB_EVENT_TOUCHPAD_CHANGED),
+    (slimbook.info.SLB_SCAN_ENERGY_SAVER_MODE, common.SLB_EVENT_ENERGY_SAVER_MODE),
+    (slimbook.info.SLB_SCAN_BALANCED_MODE, common.SLB_EVENT_BALANCED_MODE),
+    (slimbook.info.SLB_SCAN_PERFORMANCE_MODE, common.SLB_EVENT_PERFORMANCE_MODE)
+])))
+
+# only scancodes are needed from the keyboard, not keys nor sync events
+KEYBOARD_EVENT_MASK = {
+    evdev.ecodes.EV_MSC : [evdev.ecodes.MSC_SCAN]
+}
+
+# evdev readers, one per input node
+input_sources = None
+qc71_module_path = None
+
+# power profiles are applied asynchronously from its own thread
+profile_applier = powerprofiles.ProfileApplier()
+
+# handler state and event code -> handler table, built once at startup
+service_ctx = None
+dispatcher = None
+
+last_ac_status = -1
+
+# per event class debounce and rate limit policies
+debouncer = debounce.default_debouncer()
+
+# event core timer flushing deferred events and its deadline
+flush_source = None
+flush_deadline = None
+
+def setup_sockets(ipc_path = common.SLB_IPC_PATH, ctl_path = common.SLB_IPC_CTL_PATH, format = notify.FORMAT_JSON):
+    global socket_out, socket_ctl, publisher
+    
+    socket_out = context.socket(zmq.PUB)
+    socket_out.bind("ipc://{0}".format(ipc_path))
+    os.chmod(ipc_path, 0o777)
+    publisher = notify.Publisher(socket_out, format)
+
+    socket_ctl = context.socket(zmq.REP)
+    #socket_ctl.setsockopt_string(zmq.SUBSCRIBE, "")
+    #socket_ctl.setsockopt(zmq.SUBSCRIBE, b'')
+    socket_ctl.bind("ipc://{0}".format(ctl_path))
+    os.chmod(ctl_path, 0o777)
+
+def setup_dispatcher(tpad, platform, family, power_profiles, module_loaded):
+    global service_ctx, dispatcher
+    
+    service_ctx = dispatch.ServiceContext(
+        slimbook.qc71, settings, set_power_profile,
+        touchpad = tpad, on_module_loaded = start_qc71_module_reader,
+        on_module_unloaded = stop_qc71_module_reader)
+    service_ctx.module_loaded = module_loaded
+    
+    dispatcher = dispatch.build_dispatcher(service_ctx, platform, family, power_profiles)
+
+# AC status at startup, dispatched right away and known to the debouncer,
+# so a flap right after startup is coalesced against the actual state
+def setup_ac_status(context):
+    global last_ac_status
+    
+    for device in context.list_devices(subsystem="power_supply"):
+        status = get_udev_ac_status(device)
+        if (status >=0):
+            last_ac_status = status
+    
+    if (last_ac_status < 0):
+        return
+    
+    logger.info("AC status:{0}".format(last_ac_status))
+    event = common.SLB_EVENT_AC_OFFLINE + last_ac_status
+    debouncer.seed(event)
+    dispatch_event(event)
+
+# initial state for snapshots, later kept up to date by notifications
+def seed_state(tpad, platform, power_profiles):
+    if (tpad.valid()):
+        state = tpad.get_state()
+        if (state == tpad.STATE_LOCKED):
+            publisher.update_state(common.SLB_EVENT_TOUCHPAD_OFF)
+        elif (state == tpad.STATE_UNLOCKED):
+            publisher.update_state(common.SLB_EVENT_TOUCHPAD_ON)
+    
+    if (platform != slimbook.info.SLB_PLATFORM_QC71):
+        return
+    
+    if (not service_ctx.module_loaded):
+        publisher.update_state(common.SLB_EVENT_QC71_INPUT_UNLOADED)
+        return
+    
+    publisher.update_state(common.SLB_EVENT_QC71_INPUT_LOADED)
+    
+    try:
+        if (slimbook.qc71.super_lock_get() == 1):
+            publisher.update_state(common.SLB_EVENT_QC71_SUPER_LOCK_ON)
+        else:
+            publisher.update_state(common.SLB_EVENT_QC71_SUPER_LOCK_OFF)
+        
+        tables = common.QC71_PROFILE_FROM_UPOWER.get(power_profiles)
+        if (tables):
+            code = tables[1].get(slimbook.qc71.profile_get())
+            if (code != None):
+                publisher.update_state(code)
+    except Exception as e:
+        logger.error("failed to read qc71 state: {0}".format(e))
+
 def set_power_profile(profile):
-    #ToDo: refactor this using Dbus instead
     if (settings[common.OPT_POWER_PROFILE]):
-        if (os.path.exists("/usr/bin/powerprofilesctl")):
-            subprocess.run(["/usr/bin/powerprofilesctl","set",profile])
-        elif (os.path.exists("/usr/bin/tuned-adm")):
-            subprocess.run(["/usr/bin/tuned-adm","profile",common.TUNED_PROFILE[profile]])
+        profile_applier.request(profile)
 
 def get_udev_ac_status(device):
     try:
@@ -89,13 +204,13 @@ def get_udev_ac_status(device):
 def upower_change(mode):
     if mode:
         event = common.POWER_NAME_TO_EVENT[mode]
-        slb_events.put(event)
+        post_event(event)
     
 def upower_hndlr(dbus_proxy, properties_changed, properties_removed):
     props = properties_changed.unpack()
     upower_change(props.get("ActiveProfile"))
-    
-def upower_worker():
+
+def upower_connect():
     upower_proxy = Gio.DBusProxy.new_for_bus_sync(
             bus_type = Gio.BusType.SYSTEM,
             flags = Gio.DBusProxyFlags.NONE,
@@ -107,68 +222,113 @@ def upower_worker():
 
     upower_proxy.connect('g-properties-changed', upower_hndlr)
     upower_change(upower_proxy.get_cached_property("ActiveProfile").unpack())
+    
+    return upower_proxy
+
+def upower_worker():
+    upower_proxy = upower_connect()
 
     ctx = GLib.MainContext.default()
     
     while (ctx.iteration(True)):
         pass
 
-def udev_worker():
-    context = pyudev.Context()
-    last_ac_status = -1
-
+def udev_scan(context):
+    global last_ac_status
+    
     for device in context.list_devices(subsystem="power_supply"):
         status = get_udev_ac_status(device)
 
-        if (status >=0):
+        # startup status is already dispatched by setup_ac_status
+        if (status >=0 and status != last_ac_status):
             last_ac_status = status
             logger.info("AC status:{0}".format(status))
-            slb_events.put(common.SLB_EVENT_AC_OFFLINE + status)
+            post_event(common.SLB_EVENT_AC_OFFLINE + status)
     
     for device in context.list_devices(subsystem="input"):
         if device.get("ID_PATH") == "platform-qc71_laptop":
             if (device.get("DEVNAME")):
-                slb_events.put(common.SLB_EVENT_QC71_INPUT_LOADED)
+                post_event(common.SLB_EVENT_QC71_INPUT_LOADED)
+
+def udev_event(device):
+    global last_ac_status
+    
+    if device.subsystem == "power_supply":
+        status = get_udev_ac_status(device)
+        if (status >=0 and status != last_ac_status):
+            last_ac_status = status
+            logger.info("AC status:{0}".format(status))
+            post_event(common.SLB_EVENT_AC_OFFLINE + status)
+    elif device.subsystem == "hidraw":
+        if (service_ctx.touchpad):
+            service_ctx.touchpad.on_udev_event(device.action, device.device_node)
+    elif device.subsystem == "input":
+        if (service_ctx.touchpad and device.sys_name.startswith("event")):
+            service_ctx.touchpad.on_udev_event(device.action, device.device_node)
+        
+        if (device.get("ID_PATH") == "platform-qc71_laptop" and device.get("DEVNAME")):
+            if (device.action == "add"):
+                post_event(common.SLB_EVENT_QC71_INPUT_LOADED)
+            else:
+                post_event(common.SLB_EVENT_QC71_INPUT_UNLOADED)
+
+def udev_worker():
+    context = pyudev.Context()
+    udev_scan(context)
 
     monitor = pyudev.Monitor.from_netlink(context)
     #monitor.filter_by('power_supply')
     for device in iter(monitor.poll, None):
-        if device.subsystem == "power_supply":
-            status = get_udev_ac_status(device)
-            if (status >=0 and status != last_ac_status):
-                last_ac_status = status
-                logger.info("AC status:{0}".format(status))
-                slb_events.put(common.SLB_EVENT_AC_OFFLINE + status)
-        elif device.subsystem == "input":
-            if (device.get("ID_PATH") == "platform-qc71_laptop" and device.get("DEVNAME")):
-                if (device.action == "add"):
-                    slb_events.put(common.SLB_EVENT_QC71_INPUT_LOADED)
-                else:
-                    slb_events.put(common.SLB_EVENT_QC71_INPUT_UNLOADED)
-                
-def zmq_worker():
+        udev_event(device)
+
+def zmq_reply(data):
+    cmd = data.get("cmd")
     
-    while True: 
-        if (socket_ctl.poll(timeout = 100) == 0):
-            continue
-        data = socket_ctl.recv_json()
+    if (cmd and cmd == common.CMD_LOAD_SETTINGS):
         
-        cmd = data.get("cmd")
+        keys = data.get("settings")
+        if (keys):
+            logger.info("Updating settings...")
+            for k in keys:
+                logger.info("{0}={1}".format(k,keys[k]))
+                settings[k] = keys[k]
         
-        if (cmd and cmd == common.CMD_LOAD_SETTINGS):
-            
-            keys = data.get("settings")
-            if (keys):
-                logger.info("Updating settings...")
-                for k in keys:
-                    logger.info("{0}={1}".format(k,keys[k]))
-                    settings[k] = keys[k]
-                
-        
-        socket_ctl.send_json({})
+        return {}
+    
+    elif (cmd and cmd == common.CMD_GET_CAPABILITIES):
+        return caps.to_dict()
+    
+    elif (cmd and cmd == common.CMD_GET_INPUT_STATS):
+        return input_sources.stats()
+    
+    elif (cmd and cmd == common.CMD_GET_EVENT_STATS):
+        return debouncer.stats()
     
-def keyboard_worker():
+    elif (cmd and cmd == common.CMD_GET_SNAPSHOT):
+        return publisher.snapshot()
     
+    return {}
+
+def zmq_request():
+    message = socket_ctl.recv()
+    
+    # REP socket must always answer, or it won't take another request
+    try:
+        reply = zmq_reply(json.loads(message))
+    except Exception as e:
+        logger.error("bad control request: {0}".format(e))
+        reply = {}
+    
+    socket_ctl.send_json(reply)
+
+def zmq_worker():
+    
+    while True: 
+        if (socket_ctl.poll(timeout = 100) == 0):
+            continue
+        zmq_request()
+
+def keyboard_device_path():
     device_path = "/dev/input/by-path/platform-i8042-serio-0-event-kbd"
     # work around for buggy dmi info
     try:
@@ -176,99 +336,174 @@ def keyboard_worker():
     except:
         pass
         
-    device = evdev.InputDevice(device_path)
+    return device_path
+
+def keyboard_event(event, state):
+    # also filtered by the reader, cheap check for replayed events
+    if (event.type != evdev.ecodes.EV_MSC):
+        return
+    
+    code = KEYBOARD_SCAN_EVENTS.get(event.value)
+    if (code == None):
+        return
+    
+    # every key sends its scancode on press and on release
+    if (state.get(event.value) == 1):
+        state[event.value] = 0
+        return
+    
+    state[event.value] = 1
+    
+    # the qc71 module reader reports these too, once is enough
+    if (code == common.SLB_EVENT_QC71_SUPER_LOCK_CHANGED):
+        if (service_ctx.module_loaded):
+            return
+    
+    if (code == common.SLB_EVENT_QC71_SILENT_MODE_CHANGED):
+        if (service_ctx.module_loaded):
+            return
+        logger.debug("qc71 performance change requested (i8042)")
     
+    post_event(code)
+
+def start_keyboard_reader(name):
     state = {}
+    input_sources.start(keyboard_device_path(), lambda event: keyboard_event(event, state),
+        name, KEYBOARD_EVENT_MASK)
+
+def qc71_module_event(event):
+    if (event.type == evdev.ecodes.EV_KEY):
+        if (event.value == 1 and event.code == evdev.ecodes.KEY_FN_F2):
+            post_event(common.SLB_EVENT_QC71_SUPER_LOCK_CHANGED)
+        elif (event.value == 1 and event.code == evdev.ecodes.KEY_FN_F5):
+            logger.debug("qc71 performance change requested")
+            post_event(common.SLB_EVENT_QC71_SILENT_MODE_CHANGED)
+        elif (event.value == 1 and event.code == evdev.ecodes.KEY_FN_F12):
+            post_event(common.SLB_EVENT_WEBCAM_CHANGED)
+
+def start_qc71_module_reader():
+    global qc71_module_path
     
-    for event in device.read_loop():
-        if (event.type == evdev.ecodes.EV_MSC):
-        
-            last = state.get(event.value)
-            
-            if (last == 1):
-                state[event.value] = 0
-                continue
-            else:
-                state[event.value] = 1
-            
-            if (event.value == slimbook.info.SLB_SCAN_QC71_SUPER_LOCK):
-                slb_events.put(common.SLB_EVENT_QC71_SUPER_LOCK_CHANGED)
-            
-            elif (event.value == slimbook.info.SLB_SCAN_QC71_SILENT_MODE and module_loaded == False):
-                logger.debug("qc71 performance change requested (i8042)")
-                slb_events.put(common.SLB_EVENT_QC71_SILENT_MODE_CHANGED)
-            
-            elif (event.value == slimbook.info.SLB_SCAN_TOUCHPAD_SWITCH):
-                slb_events.put(common.SLB_EVENT_TOUCHPAD_CHANGED)
-    
-            elif (event.value == slimbook.info.SLB_SCAN_ENERGY_SAVER_MODE):
-                slb_events.put(common.SLB_EVENT_ENERGY_SAVER_MODE)
-                
-            elif (event.value == slimbook.info.SLB_SCAN_BALANCED_MODE):
-                slb_events.put(common.SLB_EVENT_BALANCED_MODE)
-                
-            elif (event.value == slimbook.info.SLB_SCAN_PERFORMANCE_MODE):
-                slb_events.put(common.SLB_EVENT_PERFORMANCE_MODE)
-
-def qc71_module_worker():
-    logger.debug("qc71 keyboard worker start")
-    device = evdev.InputDevice(slimbook.info.module_device())
     try:
-        for event in device.read_loop():
-            if (event.type == evdev.ecodes.EV_KEY):
-                if (event.value == 1 and event.code == evdev.ecodes.KEY_FN_F2):
-                    slb_events.put(common.SLB_EVENT_QC71_SUPER_LOCK_CHANGED)
-                elif (event.value == 1 and event.code == evdev.ecodes.KEY_FN_F5):
-                    logger.debug("qc71 performance change requested")
-                    slb_events.put(common.SLB_EVENT_QC71_SILENT_MODE_CHANGED)
-                elif (event.value == 1 and event.code == evdev.ecodes.KEY_FN_F12):
-                    slb_events.put(common.SLB_EVENT_WEBCAM_CHANGED)
-    except:
-        pass
-    logger.info("qc71 keyboard thread end")
+        qc71_module_path = slimbook.info.module_device()
+    except Exception as e:
+        logger.error("failed to find qc71 input device: {0}".format(e))
+        return
+    
+    input_sources.start(qc71_module_path, qc71_module_event, 'slimbook.service.qc71.module')
+
+def stop_qc71_module_reader():
+    if (qc71_module_path):
+        input_sources.stop(qc71_module_path)
     
 def send_notify(code):
-    dt = datetime.now()
-    ts = datetime.timestamp(dt)
-    data = {"code": code, "timestamp": ts}
-    socket_out.send_json(data)
+    publisher.publish(code)
+
+def dispatch_event(event):
+    # no need to bother user with this event as it is already notified elsewhere
+    #if (event == common.SLB_EVENT_AC_OFFLINE or event == common.SLB_EVENT_AC_ONLINE):
+    #   return
     
-def main():
-    logger.info("Slimbook service")
+    source = event
+    event = dispatcher.dispatch(event)
+    
+    if (source != event and source in common.SLB_STATE_SOURCE_EVENTS):
+        publisher.update_state(source)
+    
+    if (event == None):
+        return
+    
+    logger.debug("out event {0:04X}".format(event))
+    send_notify(event)
 
-    zmq_thread = threading.Thread(
-            name='slimbook.service.zmq', target=zmq_worker)
-    zmq_thread.start()
+def flush_events():
+    for event in debouncer.due():
+        dispatch_event(event)
+
+def on_flush_timeout():
+    global flush_source, flush_deadline
+    
+    flush_source = None
+    flush_deadline = None
+    flush_events()
+    schedule_flush()
     
-    udev_thread = threading.Thread(
-            name='slimbook.service.udev', target=udev_worker)
-    udev_thread.start()
+    return False
+
+# event core only, threaded mode waits on the queue with a timeout instead
+def schedule_flush():
+    global flush_source, flush_deadline
     
-    upower_thread = threading.Thread(
-            name='slimbook.service.upower', target=upower_worker)
-    upower_thread.start()
+    deadline = debouncer.next_deadline()
     
-        
-    tpad = touchpad.Touchpad()
+    if (deadline == None):
+        return
+    
+    if (flush_source != None):
+        if (flush_deadline <= deadline):
+            return
+        GLib.source_remove(flush_source)
+    
+    flush_deadline = deadline
+    delay = max(0, int((deadline - time.monotonic()) * 1000) + 1)
+    flush_source = GLib.timeout_add(delay, on_flush_timeout)
+
+def process_event(event):
+    logger.debug("event {0:04X}".format(event))
+    
+    for code in debouncer.submit(event):
+        dispatch_event(code)
+    
+    if (event_core):
+        schedule_flush()
+    
+def main():
+    global event_core, post_event, caps, input_sources
+    
+    usage_msg = ('usage: %prog [options]')
+    parser = OptionParser(usage=usage_msg)
+    parser.add_option('-e', '--event-core',
+                      action='store_true',
+                      dest='event_core',
+                      default=False,
+                      help=('serve all event sources from a single thread.'))
+    parser.add_option('-b', '--binary-notify',
+                      action='store_true',
+                      dest='binary_notify',
+                      default=False,
+                      help=('publish notifications as topic and binary frames.'))
+    (options, args) = parser.parse_args()
+    
+    logger.info("Slimbook service")
+    
+    if (options.binary_notify):
+        setup_sockets(format = notify.FORMAT_BINARY)
+    else:
+        setup_sockets()
+    profile_applier.start()
+    
+    tpad = touchpad.TouchpadManager()
     if (tpad.valid()):
         tpad_mode_name = {touchpad.Touchpad.MODE_HIDRAW:"hidraw",touchpad.Touchpad.MODE_EVDEV:"evdev"}
         logger.info("Found a touchpad device of type {0}".format(tpad_mode_name[tpad.mode]))
     
     keyboard_platforms = [slimbook.info.SLB_PLATFORM_Z16,slimbook.info.SLB_PLATFORM_HMT16]
     
-    model = slimbook.info.get_model()
-    platform = slimbook.info.get_platform()
-    family = slimbook.info.get_family()
+    caps = capabilities.get()
     
-    power_profiles = slimbook.info.get_performance_profiles()
+    model = caps.model
+    platform = caps.platform
+    family = caps.family
+    
+    power_profiles = caps.power_profiles
 
     logger.info("platform:{0:04x}".format(platform))
     logger.info("model:{0:04x}".format(model))
     logger.info("power profiles:{0}".format(power_profiles))
     
     if (model == slimbook.info.SLB_MODEL_UNKNOWN):
-        product = slimbook.info.product_name().lower()
-        vendor = slimbook.info.board_vendor().lower()
+        product = caps.product.lower()
+        vendor = caps.vendor.lower()
         
         if (product.startswith("excalibur")):
             # work-around for buggy dmi data
@@ -276,209 +511,70 @@ def main():
             platform = slimbook.info.SLB_PLATFORM_Z16
         else:
             logger.warning("Unknown model:")
-            logger.warning("Product:[{0}]".format(slimbook.info.product_name()))
-            logger.warning("Vendor:[{0}]".format(slimbook.info.board_vendor()))
+            logger.warning("Product:[{0}]".format(caps.product))
+            logger.warning("Vendor:[{0}]".format(caps.vendor))
+    
+    setup_dispatcher(tpad, platform, family, power_profiles, slimbook.info.is_module_loaded())
+    seed_state(tpad, platform, power_profiles)
+    setup_ac_status(pyudev.Context())
+    
+    if (options.event_core):
+        logger.info("Using single threaded event core")
+        event_core = EventCore()
+        post_event = process_event
     
-    module_loaded = slimbook.info.is_module_loaded()
+    input_sources = inputsource.InputSources(event_core)
+    
+    if (event_core):
+        event_core.add_zmq_socket(socket_ctl, zmq_request)
+        
+        udev_context = pyudev.Context()
+        udev_scan(udev_context)
+        event_core.add_udev_monitor(pyudev.Monitor.from_netlink(udev_context), udev_event)
+        
+        upower_proxy = upower_connect()
+        
+    else:
+        zmq_thread = threading.Thread(
+                name='slimbook.service.zmq', target=zmq_worker)
+        zmq_thread.start()
+        
+        udev_thread = threading.Thread(
+                name='slimbook.service.udev', target=udev_worker)
+        udev_thread.start()
+        
+        upower_thread = threading.Thread(
+                name='slimbook.service.upower', target=upower_worker)
+        upower_thread.start()
     
     if (platform == slimbook.info.SLB_PLATFORM_QC71):
-        qc71_keyboard_thread = threading.Thread(
-            name='slimbook.service.qc71.keyboard', target=keyboard_worker)
-        qc71_keyboard_thread.start()
+        start_keyboard_reader('slimbook.service.qc71.keyboard')
             
-        if (module_loaded):
+        if (service_ctx.module_loaded):
             logger.info("Setting qc71 manual mode")
             slimbook.qc71.manual_control_set(True)
-            
-            #qc71_module_thread = threading.Thread(
-                #name='slimbook.service.qc71.module', target=qc71_module_worker)
-            #qc71_module_thread.start()
         
         else:
             logger.warning("QC71 kernel module is not available!")
             
     elif (platform in keyboard_platforms):
-        keyboard_thread = threading.Thread(
-            name='slimbook.service.generic.keyboard', target=keyboard_worker)
-        keyboard_thread.start()
+        start_keyboard_reader('slimbook.service.generic.keyboard')
     
     else:
         logger.warning("No event handler for this model!")
-        
-    cached_events = {}
-    expect_upower_event = False
-    ac = False
-    restore_profile = slimbook.info.SLB_QC71_PROFILE_BALANCED
-    
-    while True:
-       
-        event = slb_events.get()
-        now = time.time()
-        
-        logger.debug("event {0:04X}".format(event))
-        
-        cached = cached_events.get(event)
-        
-        if cached:
-            delta =  now - cached
-            if delta > 1.250:
-                cached_events[event] = now
-            else:
-                logger.debug("ignored duplicated event {0:04X} ({1})".format(event,delta))
-                continue
-        else:
-            cached_events[event] = now
-        
-        # no need to bother user with this event as it is already notified elsewhere
-        #if (event == common.SLB_EVENT_AC_OFFLINE or event == common.SLB_EVENT_AC_ONLINE):
-        #   continue
-        
-        if (family == slimbook.info.SLB_MODEL_EXCALIBUR):
-            if (event == common.SLB_EVENT_ENERGY_SAVER_MODE):
-                set_power_profile(common.POWER_PROFILE_POWER_SAVER)
-            elif (event == common.SLB_EVENT_BALANCED_MODE):
-                set_power_profile(common.POWER_PROFILE_BALANCED)
-            elif (event == common.SLB_EVENT_PERFORMANCE_MODE):
-                set_power_profile(common.POWER_PROFILE_PERFORMANCE)
-
-        if (platform == slimbook.info.SLB_PLATFORM_QC71):
-            if (event == common.SLB_EVENT_QC71_INPUT_LOADED):
-                qc71_module_thread = threading.Thread(
-                    name='slimbook.service.qc71.module', target=qc71_module_worker)
-                qc71_module_thread.start()
-                
-                module_loaded = True
-                continue
-                
-            if (event == common.SLB_EVENT_QC71_INPUT_UNLOADED):
-                module_loaded = False
-                continue
-                
-            if (module_loaded):
-                if (event == common.SLB_EVENT_QC71_SUPER_LOCK_CHANGED):
-                    value = slimbook.qc71.super_lock_get()
-                    if (value == 1):
-                        event = common.SLB_EVENT_QC71_SUPER_LOCK_ON
-                    else:
-                        event = common.SLB_EVENT_QC71_SUPER_LOCK_OFF
-                
-                # General Performance event on QC71
-                elif (event == common.SLB_EVENT_QC71_SILENT_MODE_CHANGED):
-                    value = slimbook.qc71.profile_get()
-                    logger.debug("current performance:{0}".format(common.POWER_PROFILE_NAME[value]))
-                    
-                    if (power_profiles == 2):
-                        if (value == slimbook.info.SLB_QC71_PROFILE_SILENT):
-                            slimbook.qc71.profile_set(slimbook.info.SLB_QC71_PROFILE_NORMAL)
-                            logger.debug("switching to {0}".format(common.POWER_PROFILE_NAME[slimbook.info.SLB_QC71_PROFILE_NORMAL]))
-                            event = common.SLB_EVENT_QC71_SILENT_MODE_OFF
-                            expect_upower_event = True
-                            set_power_profile(common.POWER_PROFILE_BALANCED)
-                            
-                        elif (value == slimbook.info.SLB_QC71_PROFILE_NORMAL):
-                            slimbook.qc71.profile_set(slimbook.info.SLB_QC71_PROFILE_SILENT)
-                            logger.debug("switching to {0}".format(common.POWER_PROFILE_NAME[slimbook.info.SLB_QC71_PROFILE_SILENT]))
-                            event = common.SLB_EVENT_QC71_SILENT_MODE_ON
-                            expect_upower_event = True
-                            set_power_profile(common.POWER_PROFILE_POWER_SAVER)
-                        
-                    if (power_profiles == 3):
-                        if (value == slimbook.info.SLB_QC71_PROFILE_PERFORMANCE):
-                            slimbook.qc71.profile_set(slimbook.info.SLB_QC71_PROFILE_ENERGY_SAVER)
-                            logger.debug("switching to {0}".format(common.POWER_PROFILE_NAME[slimbook.info.SLB_QC71_PROFILE_ENERGY_SAVER]))
-                            event = common.SLB_EVENT_ENERGY_SAVER_MODE
-                            expect_upower_event = True
-                            set_power_profile(common.POWER_PROFILE_POWER_SAVER)
-                            
-                        elif (value == slimbook.info.SLB_QC71_PROFILE_ENERGY_SAVER):
-                            slimbook.qc71.profile_set(slimbook.info.SLB_QC71_PROFILE_BALANCED)
-                            logger.debug("switching to {0}".format(common.POWER_PROFILE_NAME[slimbook.info.SLB_QC71_PROFILE_BALANCED]))
-                            event = common.SLB_EVENT_BALANCED_MODE
-                            expect_upower_event = True
-                            set_power_profile(common.POWER_PROFILE_BALANCED)
-                            
-                        elif (value == slimbook.info.SLB_QC71_PROFILE_BALANCED):
-                            slimbook.qc71.profile_set(slimbook.info.SLB_QC71_PROFILE_PERFORMANCE)
-                            logger.debug("switching to {0}".format(common.POWER_PROFILE_NAME[slimbook.info.SLB_QC71_PROFILE_PERFORMANCE]))
-                            event = common.SLB_EVENT_PERFORMANCE_MODE
-                            expect_upower_event = True
-                            set_power_profile(common.POWER_PROFILE_PERFORMANCE)
-
-                elif (event == common.SLB_EVENT_AC_OFFLINE):
-                    ac = False
-                    logger.debug("AC Offline")
-                    if ((family == slimbook.info.SLB_MODEL_CREATIVE or family == slimbook.info.SLB_MODEL_EVO) and module_loaded):
-                        restore_profile = slimbook.qc71.profile_get()
-                        slimbook.qc71.profile_set(slimbook.info.SLB_QC71_PROFILE_BALANCED)
-                        slimbook.qc71.profile_set(slimbook.info.SLB_QC71_PROFILE_ENERGY_SAVER)
-
-                        if (settings[common.OPT_AC_NOTIFICATIONS] == False):
-                            continue
-
-                        event = common.QC71_TRIPLE_PROFILE_TO_NOTIFICATION[slimbook.info.SLB_QC71_PROFILE_ENERGY_SAVER]
-                        
-
-                elif (event == common.SLB_EVENT_AC_ONLINE):
-                    ac = True
-                    
-                    if ((family == slimbook.info.SLB_MODEL_CREATIVE or family == slimbook.info.SLB_MODEL_EVO) and module_loaded):
-                        
-                        # restore profile
-                        logger.debug("AC Online")
-                        slimbook.qc71.profile_set(restore_profile)
-
-                        if (settings[common.OPT_AC_NOTIFICATIONS] == False):
-                            continue
-
-                        event = common.QC71_TRIPLE_PROFILE_TO_NOTIFICATION[restore_profile]
-                        
-                elif (event & 0xfff0 == common.SLB_EVENT_UPOWER_POWER_EVENT):
-                    # power profile matching is disabled
-                    if (settings[common.OPT_POWER_PROFILE] == False):
-                        continue
-                        
-                    if (expect_upower_event):
-                        logger.debug("Expected UPower event, nothing to do")
-                        expect_upower_event = False
-                        continue
-
-                    # Creative doesn't change TDP without AC'
-                    if (ac == False and (family == slimbook.info.SLB_MODEL_CREATIVE)):
-                        continue
-
-                    if (power_profiles == 3):
-                        expect = common.QC71_TRIPLE_PROFILE_FROM_UPOWER[event]
-                        logger.debug("external power event {0:04X}, expected {1:04X}".format(event,expect))
-                        slimbook.qc71.profile_set(expect)
-                        event = common.QC71_TRIPLE_PROFILE_TO_NOTIFICATION[expect]
-                        
-                    elif (power_profiles == 2):
-                        expect = common.QC71_DOUBLE_PROFILE_FROM_UPOWER[event]
-                        logger.debug("external power event {0:04X}, expected {1:04X}".format(event,expect))
-                        slimbook.qc71.profile_set(expect)
-                        event = common.QC71_DOUBLE_PROFILE_TO_NOTIFICATION[expect]
-
-        if (event == common.SLB_EVENT_TOUCHPAD_CHANGED):
-            if (not settings[common.OPT_TRACKPAD_LOCK]):
+    
+    if (event_core):
+        event_core.run()
+    else:
+        while True:
+            try:
+                event = slb_events.get(timeout = debouncer.timeout())
+            except queue.Empty:
+                flush_events()
                 continue
             
-            if (tpad.valid()):
-                tpad.toggle()
-                state = tpad.get_state()
-                
-                if (state == touchpad.Touchpad.STATE_LOCKED):
-                    event = common.SLB_EVENT_TOUCHPAD_OFF
-                elif (state == touchpad.Touchpad.STATE_UNLOCKED):
-                    event = common.SLB_EVENT_TOUCHPAD_ON
-                else:
-                    continue
-                
-            else:
-                #discard event
-                continue
-                    
-        logger.debug("out event {0:04X}".format(event))
-        send_notify(event)
+            process_event(event)
+            flush_events()
         
 if __name__=="__main__":
     try:
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+# Slimbook Service
+# Copyright (C) 2022 Slimbook
+# In case you modify or redistribute this code you must keep the copyright line above.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from gi.repository import GLib
+
+import zmq
+
+import errno
+import logging
+
+logger = logging.getLogger("slimbook.service")
+
+FD_CONDITION = GLib.IOCondition.IN | GLib.IOCondition.HUP | GLib.IOCondition.ERR
+
+# errors telling the device behind a fd is gone for good
+GONE_ERRNOS = [errno.ENODEV, errno.EBADF, errno.EIO]
+
+# Single threaded event loop. Every event source is a file descriptor
+# watched by the default GLib main context, so D-Bus signals, evdev,
+# udev and zmq are all served from the same poll() call and handlers run
+# right away, with no queue or extra threads in between.
+class EventCore:
+
+    def __init__(self):
+        self.loop = GLib.MainLoop()
+        self.sources = {}
+
+    def add_reader(self, fd, callback, *args):
+        self.remove_reader(fd)
+        self.sources[fd] = GLib.unix_fd_add_full(
+            GLib.PRIORITY_DEFAULT, fd, FD_CONDITION, self._on_fd, (callback, args))
+
+    def remove_reader(self, fd):
+        source = self.sources.pop(fd, None)
+        if (source):
+            GLib.source_remove(source)
+
+    def _on_fd(self, fd, condition, data):
+        callback, args = data
+        keep = True
+
+        # a failing handler must not silence its source, only a dead fd does
+        try:
+            keep = callback(fd, condition, *args)
+        except OSError as e:
+            if (e.errno in GONE_ERRNOS):
+                logger.info("event source {0} is gone: {1}".format(fd, e))
+                keep = False
+            else:
+                logger.error("event source {0} failed: {1}".format(fd, e))
+        except Exception as e:
+            logger.error("event source {0} failed: {1}".format(fd, e))
+
+        if (condition & (GLib.IOCondition.HUP | GLib.IOCondition.ERR)):
+            keep = False
+
+        if (not keep):
+            self.sources.pop(fd, None)
+
+        return keep
+
+    def add_evdev(self, device, handler):
+        self.add_reader(device.fd, self._on_evdev, device, handler)
+
+    def _on_evdev(self, fd, condition, device, handler):
+        if (condition & (GLib.IOCondition.HUP | GLib.IOCondition.ERR)):
+            logger.info("input device {0} is gone".format(device.path))
+            return False
+
+        try:
+            for event in device.read():
+                handler(event)
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            logger.info("input device {0} is gone ({1})".format(device.path, e))
+            return False
+
+        return True
+
+    def add_udev_monitor(self, monitor, handler):
+        monitor.start()
+        self.add_reader(monitor.fileno(), self._on_udev, monitor, handler)
+
+    def _on_udev(self, fd, condition, monitor, handler):
+        for device in iter(lambda: monitor.poll(timeout = 0), None):
+            try:
+                handler(device)
+            except Exception as e:
+                logger.error("udev event handler failed: {0}".format(e))
+
+        return True
+
+    def add_zmq_socket(self, socket, handler):
+        self.add_reader(socket.getsockopt(zmq.FD), self._on_zmq, socket, handler)
+
+    def _on_zmq(self, fd, condition, socket, handler):
+        # zmq fd is edge triggered, drain everything pending
+        while (socket.getsockopt(zmq.EVENTS) & zmq.POLLIN):
+            try:
+                handler()
+            except Exception as e:
+                logger.error("zmq handler failed: {0}".format(e))
+
+        return True
+
+    def run(self):
+        self.loop.run()
+
+    def quit(self):
+        self.loop.quit()
@@ -0,0 +1,470 @@
+# -*- coding: utf-8 -*-
+
+# Slimbook Service
+# Copyright (C) 2022 Slimbook
+# In case you modify or redistribute this code you must keep the copyright line above.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import common
+
+import os
+import re
+import json
+import time
+import hashlib
+import fnmatch
+import logging
+import datetime
+import tempfile
+
+FEED_INDEX_FILE = "sb-rss.idx"
+FEED_INDEX_VERSION = 2
+
+SEEN_FILE = "feeds.dat"
+SEEN_MAX_ENTRIES = 4096
+# journal is compacted when it has this many lines per live entry
+SEEN_COMPACT_RATIO = 4
+SEEN_COMPACT_MIN = 256
+
+# machine identity used for feed targeting
+IDENTITY_FIELDS = ["product", "sku", "family", "platform", "bios_version", "ec_firmware"]
+
+# entries older than this are not notified
+FEED_MAX_AGE = 90 * 24 * 3600
+
+class Feed:
+    def __init__(self, id, title, body, link = None, published = None, tags = [], icon = "dialog-information"):
+        self.id = id
+        self.title = title
+        self.body = body
+        self.link = link
+        # epoch or None
+        self.published = published
+        self.tags = list(tags)
+        self.icon = icon
+
+        self.cached = False
+
+    @property
+    def old(self):
+        if (self.published == None):
+            return True
+
+        return (time.time() - self.published) > FEED_MAX_AGE
+
+    @staticmethod
+    def from_entry(entry):
+        m = hashlib.md5()
+        m.update(str(entry).encode())
+
+        published = entry.get("published")
+        if (published):
+            from dateutil import parser
+
+            try:
+                ptime = parser.parse(published)
+                if (ptime.tzinfo == None):
+                    ptime = ptime.replace(tzinfo = datetime.timezone.utc)
+                published = ptime.timestamp()
+            except Exception as e:
+                logging.warning("bad feed date {0}: {1}".format(published, e))
+                published = None
+
+        tags = []
+        icon = "dialog-information"
+
+        if (entry.get("tags")):
+            for tag in entry.tags:
+                term = tag.get("term")
+
+                if (term):
+                    tags.append(term)
+
+                    if (term == "firmware"):
+                        icon = "application-x-firmware"
+
+        return Feed(m.hexdigest(), entry.title, entry.description, entry.get("link"), published, tags, icon)
+
+    @staticmethod
+    def from_dict(data):
+        return Feed(data["id"], data["title"], data["body"], data["link"], data["published"], data["tags"], data["icon"])
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "title": self.title,
+            "body": self.body,
+            "link": self.link,
+            "published": self.published,
+            "tags": self.tags,
+            "icon": self.icon
+        }
+
+# Targeting tags restrict an entry to some machines:
+#   family:<glob>, model:<glob> (product or sku), platform:<glob>
+#   bios:<range>, ec:<range> with >=1.05, <1.10, =1.07 or 1.05..1.09
+# A leading ! negates any of them. An entry matches when any of its glob
+# filters does (or it has none), all of its ranges hold and none of its
+# negated filters match.
+TARGET_GLOB_FIELDS = {
+    "family": ["family"],
+    "model": ["product", "sku"],
+    "platform": ["platform"]
+}
+
+TARGET_VERSION_FIELDS = {
+    "bios": "bios_version",
+    "ec": "ec_firmware"
+}
+
+def version_tuple(text):
+    return tuple(int(n) for n in re.findall(r"\d+", text or ""))
+
+# returns (low, high) bounds as (version, inclusive) or None
+def parse_version_range(text):
+    if (".." in text):
+        low, high = text.split("..", 1)
+        return ((version_tuple(low), True) if low else None, (version_tuple(high), True) if high else None)
+
+    for op in [">=", "<=", ">", "<", "="]:
+        if (text.startswith(op)):
+            version = version_tuple(text[len(op):])
+            break
+    else:
+        op = "="
+        version = version_tuple(text)
+
+    if (op == ">="):
+        return ((version, True), None)
+    if (op == ">"):
+        return ((version, False), None)
+    if (op == "<="):
+        return (None, (version, True))
+    if (op == "<"):
+        return (None, (version, False))
+
+    return ((version, True), (version, True))
+
+def in_version_range(version, bounds):
+    if (not version):
+        return False
+
+    low, high = bounds
+    if (low != None and (version < low[0] or (version == low[0] and not low[1]))):
+        return False
+    if (high != None and (version > high[0] or (version == high[0] and not high[1]))):
+        return False
+
+    return True
+
+# returns (kind, negated, argument) or None for non targeting tags
+def parse_target(tag):
+    kind, sep, arg = tag.partition(":")
+
+    if (not sep or (kind not in TARGET_GLOB_FIELDS and kind not in TARGET_VERSION_FIELDS)):
+        return None
+
+    negated = arg.startswith("!")
+    if (negated):
+        arg = arg[1:]
+
+    if (kind in TARGET_VERSION_FIELDS):
+        arg = parse_version_range(arg)
+
+    return (kind, negated, arg)
+
+# Evaluates the targeting tags of a whole feed against one machine. Glob
+# patterns are collected across all entries and checked once per distinct
+# pattern, with a single combined regex per tag kind to rule out the
+# common case where none of them matches.
+class TargetFilter:
+    def __init__(self, identity):
+        self.identity = identity
+        self.versions = {}
+
+        for kind, field in TARGET_VERSION_FIELDS.items():
+            self.versions[kind] = version_tuple(identity.get(field))
+
+    def _glob_matches(self, kind, patterns):
+        if (len(patterns) == 0):
+            return set()
+
+        values = [self.identity.get(field) or "" for field in TARGET_GLOB_FIELDS[kind]]
+        combined = re.compile("|".join(fnmatch.translate(p) for p in patterns))
+
+        if (not any(combined.match(value) for value in values)):
+            return set()
+
+        matches = set()
+        for pattern in patterns:
+            regex = re.compile(fnmatch.translate(pattern))
+            if (any(regex.match(value) for value in values)):
+                logging.info("feed match {0} filter:{1}".format(kind, pattern))
+                matches.add(pattern)
+
+        return matches
+
+    def _matches(self, kind, arg, globs):
+        if (kind in TARGET_VERSION_FIELDS):
+            return in_version_range(self.versions[kind], arg)
+
+        return arg in globs[kind]
+
+    def select(self, feeds):
+        rules = []
+        patterns = {kind: set() for kind in TARGET_GLOB_FIELDS}
+
+        for feed in feeds:
+            targets = [t for t in map(parse_target, feed.tags) if t != None]
+            rules.append(targets)
+
+            for kind, negated, arg in targets:
+                if (kind in TARGET_GLOB_FIELDS):
+                    patterns[kind].add(arg)
+
+        globs = {kind: self._glob_matches(kind, patterns[kind]) for kind in patterns}
+        selected = []
+
+        for feed, targets in zip(feeds, rules):
+            filters = 0
+            match = False
+            excluded = False
+
+            for kind, negated, arg in targets:
+                matched = self._matches(kind, arg, globs)
+
+                if (negated):
+                    excluded = excluded or matched
+                elif (kind in TARGET_VERSION_FIELDS):
+                    excluded = excluded or not matched
+                else:
+                    filters = filters + 1
+                    match = match or matched
+
+            if (excluded or (filters > 0 and not match)):
+                logging.info("entry ignored by filter")
+                continue
+
+            selected.append(feed)
+
+        return selected
+
+def compile_feed(path, identity):
+    # feedparser is slow to import and only needed when the feed changes
+    import feedparser
+
+    feeds = []
+    feed = feedparser.parse(path)
+
+    for entry in feed["entries"]:
+        try:
+            nw = Feed.from_entry(entry)
+        except Exception as e:
+            logging.error("bad feed entry: {0}".format(e))
+            continue
+
+        feeds.append(nw)
+
+    return TargetFilter(identity).select(feeds)
+
+def identity_key(identity):
+    return "|".join([identity.get(field) or "" for field in IDENTITY_FIELDS])
+
+# Feed entries already parsed and filtered for this machine. They are
+# compiled once per downloaded feed revision and stored next to it, so
+# check_news() does not parse the xml again until the feed changes.
+class FeedStore:
+    def __init__(self, cache_path = common.SLB_CACHE_PATH):
+        self.cache_path = cache_path
+        self.path = os.path.join(cache_path, common.SLB_FEED_FILE)
+        self.index_path = os.path.join(cache_path, FEED_INDEX_FILE)
+        self.stamp = None
+        self.key = None
+        self.feeds = []
+
+    def _source_hash(self):
+        m = hashlib.sha1()
+        with open(self.path, "rb") as f:
+            m.update(f.read())
+
+        return m.hexdigest()
+
+    def _load_index(self, source, key):
+        try:
+            with open(self.index_path, "r") as f:
+                index = json.load(f)
+
+            if (index["version"] == FEED_INDEX_VERSION and index["source"] == source and index["identity"] == key):
+                return [Feed.from_dict(e) for e in index["entries"]]
+        except:
+            pass
+
+        return None
+
+    def _store_index(self, source, key, feeds):
+        index = {
+            "version": FEED_INDEX_VERSION,
+            "source": source,
+            "identity": key,
+            "entries": [f.to_dict() for f in feeds]
+        }
+
+        try:
+            fd, tmp = tempfile.mkstemp(dir = self.cache_path, prefix = ".tmp-")
+            with os.fdopen(fd, "w") as f:
+                json.dump(index, f)
+            os.replace(tmp, self.index_path)
+        except Exception as e:
+            logging.warning("failed to store feed index: {0}".format(e))
+
+    def entries(self, identity):
+        if (not os.path.exists(self.path)):
+            return []
+
+        st = os.stat(self.path)
+        stamp = (st.st_mtime_ns, st.st_size)
+        key = identity_key(identity)
+
+        # fast path, nothing changed since last call
+        if (self.stamp == stamp and self.key == key):
+            return self.feeds
+
+        source = self._source_hash()
+        feeds = self._load_index(source, key)
+
+        if (feeds == None):
+            logging.info("compiling feed...")
+            feeds = compile_feed(self.path, identity)
+            self._store_index(source, key, feeds)
+
+        self.stamp = stamp
+        self.key = key
+        self.feeds = feeds
+
+        return feeds
+
+# Read/unread state of feed entries. Entries live in a dict for O(1)
+# membership and every change is appended to a journal file:
+#   S <id> <first seen>
+#   D <id> <dismissed>
+# The journal is rewritten only when it grows too much compared to the
+# live entries, dropping the oldest ones past SEEN_MAX_ENTRIES.
+# Plain id lines from older versions are read as seen entries.
+class SeenStore:
+    def __init__(self, cache_path = common.SLB_CACHE_PATH, max_entries = SEEN_MAX_ENTRIES):
+        self.cache_path = cache_path
+        self.path = os.path.join(cache_path, SEEN_FILE)
+        self.max_entries = max_entries
+        # id -> [first seen, dismissed]
+        self.entries = {}
+        self.journal_lines = 0
+        self.load()
+
+    def load(self):
+        self.entries = {}
+        self.journal_lines = 0
+
+        try:
+            with open(self.path, "r") as f:
+                for line in f:
+                    fields = line.split()
+                    self.journal_lines = self.journal_lines + 1
+
+                    if (len(fields) == 1):
+                        self.entries.setdefault(fields[0], [0, None])
+                    elif (len(fields) == 3 and fields[0] == "S"):
+                        self.entries.setdefault(fields[1], [float(fields[2]), None])
+                    elif (len(fields) == 3 and fields[0] == "D"):
+                        self.entries.setdefault(fields[1], [float(fields[2]), None])[1] = float(fields[2])
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.warning("failed to load seen feeds: {0}".format(e))
+
+    def __contains__(self, id):
+        return id in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def first_seen(self, id):
+        return self.entries[id][0]
+
+    def dismissed(self, id):
+        return self.entries[id][1]
+
+    def _append(self, lines):
+        if (len(lines) == 0):
+            return
+
+        try:
+            os.makedirs(self.cache_path, exist_ok = True)
+            with open(self.path, "a") as f:
+                f.write("".join(lines))
+            self.journal_lines = self.journal_lines + len(lines)
+        except Exception as e:
+            logging.warning("failed to store seen feeds: {0}".format(e))
+
+        self.maybe_compact()
+
+    def mark_seen(self, ids):
+        now = time.time()
+        lines = []
+
+        for id in ids:
+            if (id not in self.entries):
+                self.entries[id] = [now, None]
+                lines.append("S {0} {1:.0f}\n".format(id, now))
+
+        self._append(lines)
+
+    def dismiss(self, ids):
+        now = time.time()
+        lines = []
+
+        for id in ids:
+            entry = self.entries.setdefault(id, [now, None])
+            if (entry[1] == None):
+                entry[1] = now
+                lines.append("D {0} {1:.0f}\n".format(id, now))
+
+        self._append(lines)
+
+    def maybe_compact(self):
+        if (len(self.entries) > self.max_entries or
+            self.journal_lines > max(SEEN_COMPACT_MIN, SEEN_COMPACT_RATIO * len(self.entries))):
+            self.compact()
+
+    def compact(self):
+        if (len(self.entries) > self.max_entries):
+            ids = sorted(self.entries, key = lambda id: self.entries[id][0])
+            for id in ids[:len(ids) - self.max_entries]:
+                del self.entries[id]
+
+        lines = []
+        for id, (seen, dismissed) in self.entries.items():
+            lines.append("S {0} {1:.0f}\n".format(id, seen))
+            if (dismissed != None):
+                lines.append("D {0} {1:.0f}\n".format(id, dismissed))
+
+        try:
+            os.makedirs(self.cache_path, exist_ok = True)
+            fd, tmp = tempfile.mkstemp(dir = self.cache_path, prefix = ".tmp-")
+            with os.fdopen(fd, "w") as f:
+                f.write("".join(lines))
+            os.replace(tmp, self.path)
+            self.journal_lines = len(lines)
+        except Exception as e:
+            logging.warning("failed to compact seen feeds: {0}".format(e))
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+
+# Slimbook Service
+# Copyright (C) 2022 Slimbook
+# In case you modify or redistribute this code you must keep the copyright line above.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from gi.repository import GLib
+
+import evdev
+from evdev import ecodes
+
+import os
+import select
+import struct
+import ctypes
+from fcntl import ioctl
+import logging
+import threading
+import time
+
+logger = logging.getLogger("slimbook.service")
+
+# _IOW('E', 0x93, struct input_mask)
+EVIOCSMASK = 0x40104593
+
+# event types the kernel can mask per client, with their code count. The
+# EV_SYN slot is not a code mask but the mask of event types, and the
+# kernel never filters EV_SYN events themselves.
+EVENT_MASK_TYPES = {
+    ecodes.EV_SYN : ecodes.EV_CNT,
+    ecodes.EV_KEY : ecodes.KEY_MAX + 1,
+    ecodes.EV_REL : ecodes.REL_MAX + 1,
+    ecodes.EV_ABS : ecodes.ABS_MAX + 1,
+    ecodes.EV_MSC : ecodes.MSC_MAX + 1,
+    ecodes.EV_SW : ecodes.SW_MAX + 1,
+    ecodes.EV_LED : ecodes.LED_MAX + 1,
+    ecodes.EV_SND : ecodes.SND_MAX + 1
+}
+
+# Asks the kernel (4.4+) to deliver only the given {type: [codes]} events
+# to this fd, any other maskable type is dropped before reaching us.
+def set_event_mask(fd, mask):
+    for ev_type, count in EVENT_MASK_TYPES.items():
+        bitmap = (ctypes.c_ubyte * ((count + 7) // 8))()
+        
+        if (ev_type == ecodes.EV_SYN):
+            bits = mask.keys()
+        else:
+            bits = mask.get(ev_type, [])
+        
+        for bit in bits:
+            bitmap[bit // 8] |= 1 << (bit % 8)
+        
+        arg = struct.pack("IIQ", ev_type, len(bitmap), ctypes.addressof(bitmap))
+        ioctl(fd, EVIOCSMASK, arg)
+
+# Reads one evdev node and hands its events to handler. The reader can be
+# started and stopped any number of times: starting an open reader does
+# nothing, and the same thread (or event core watch) is reused after a
+# stop. Each wakeup reads every pending event at once.
+# An optional mask ({type: [codes]}) restricts the events handed over,
+# in the kernel when possible and otherwise here, before the handler.
+class InputReader:
+    def __init__(self, path, handler, name, event_core = None, mask = None):
+        self.path = path
+        self.handler = handler
+        self.name = name
+        self.event_core = event_core
+        self.mask = None
+        if (mask != None):
+            self.mask = {ev_type: frozenset(codes) for ev_type, codes in mask.items()}
+        self.kernel_mask = False
+
+        self.device = None
+        self.stopping = False
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.thread = None
+        self.wake_r = None
+        self.wake_w = None
+
+        self.opens = 0
+        self.wakeups = 0
+        self.events = 0
+        self.errors = 0
+        self.filtered = 0
+        # seconds spent open, for the filtered rate
+        self.open_time = 0.0
+        self.opened = None
+        self.last_error = None
+        self.last_event = None
+
+    @property
+    def running(self):
+        return (self.device != None)
+
+    def start(self):
+        with self.lock:
+            if (self.device != None):
+                # a pending stop is cancelled, the device stays open
+                self.stopping = False
+                return
+
+            try:
+                self.device = evdev.InputDevice(self.path)
+            except OSError as e:
+                self.errors += 1
+                self.last_error = str(e)
+                logger.error("failed to open input device {0}: {1}".format(self.path, e))
+                return
+
+            self.opens += 1
+            self.opened = time.monotonic()
+            logger.info("{0} reading {1}".format(self.name, self.path))
+            
+            if (self.mask != None):
+                try:
+                    set_event_mask(self.device.fd, self.mask)
+                    self.kernel_mask = True
+                except OSError as e:
+                    logger.info("{0} event mask not supported, filtering in user space: {1}".format(self.name, e))
+                    self.kernel_mask = False
+
+            if (self.event_core):
+                self.event_core.add_reader(self.device.fd, self._on_ready)
+            elif (self.thread == None):
+                self.wake_r, self.wake_w = os.pipe()
+                self.thread = threading.Thread(name = self.name, target = self._run, daemon = True)
+                self.thread.start()
+            else:
+                self.cond.notify()
+
+    def stop(self):
+        with self.lock:
+            if (self.device == None):
+                return
+
+            if (self.event_core):
+                self.event_core.remove_reader(self.device.fd)
+                self._close()
+            else:
+                # reader thread closes the device once out of select()
+                self.stopping = True
+                os.write(self.wake_w, b"\0")
+
+    # lock must be held
+    def _close(self):
+        try:
+            self.device.close()
+        except OSError:
+            pass
+
+        logger.info("{0} closed {1} ({2} events, {3:.1f} filtered/s)".format(
+            self.name, self.path, self.events, self.filtered_rate()))
+        self.open_time += time.monotonic() - self.opened
+        self.opened = None
+        self.device = None
+        self.stopping = False
+
+    # returns False when the device is gone
+    def _read(self, device):
+        try:
+            events = list(device.read())
+        except BlockingIOError:
+            return True
+        except OSError as e:
+            with self.lock:
+                self.errors += 1
+                self.last_error = str(e)
+                if (self.device is device):
+                    self._close()
+            return False
+
+        self.wakeups += 1
+        self.events += len(events)
+        self.last_event = time.monotonic()
+
+        if (self.mask != None):
+            mask = self.mask
+            count = len(events)
+            events = [e for e in events if e.code in mask.get(e.type, ())]
+            self.filtered += count - len(events)
+
+        for event in events:
+            try:
+                self.handler(event)
+            except Exception as e:
+                self.errors += 1
+                self.last_error = str(e)
+                logger.error("{0} handler failed: {1}".format(self.name, e))
+
+        return True
+
+    def _on_ready(self, fd, condition):
+        if (condition & (GLib.IOCondition.HUP | GLib.IOCondition.ERR)):
+            with self.lock:
+                if (self.device != None):
+                    self._close()
+            return False
+
+        return self._read(self.device)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while (self.device == None):
+                    self.cond.wait()
+                device = self.device
+
+            try:
+                ready = select.select([device.fd, self.wake_r], [], [])[0]
+            except (OSError, ValueError):
+                ready = [device.fd]
+
+            if (self.wake_r in ready):
+                os.read(self.wake_r, 64)
+
+                with self.lock:
+                    if (self.stopping and self.device is device):
+                        self._close()
+                        continue
+
+            if (device.fd in ready):
+                self._read(device)
+
+    def stats(self):
+        return {
+            "name": self.name,
+            "path": self.path,
+            "running": self.running,
+            "opens": self.opens,
+            "wakeups": self.wakeups,
+            "events": self.events,
+            "errors": self.errors,
+            # with a kernel mask only what gets past it (sync reports) is counted
+            "kernel_mask": self.kernel_mask,
+            "filtered": self.filtered,
+            "filtered_per_sec": self.filtered_rate(),
+            "last_error": self.last_error,
+            "idle": None if self.last_event == None else time.monotonic() - self.last_event
+        }
+
+    # events dropped in user space per second the device has been open
+    def filtered_rate(self):
+        elapsed = self.open_time
+        if (self.opened != None):
+            elapsed += time.monotonic() - self.opened
+        
+        if (elapsed <= 0):
+            return 0.0
+        
+        return self.filtered / elapsed
+
+# Owns every input reader of the service, one per evdev node
+class InputSources:
+    def __init__(self, event_core = None):
+        self.event_core = event_core
+        self.readers = {}
+
+    def start(self, path, handler, name, mask = None):
+        reader = self.readers.get(path)
+
+        if (reader == None):
+            reader = InputReader(path, handler, name, self.event_core, mask)
+            self.readers[path] = reader
+
+        reader.start()
+
+        return reader
+
+    def stop(self, path):
+        reader = self.readers.get(path)
+
+        if (reader):
+            reader.stop()
+
+    def stats(self):
+        return [reader.stats() for reader in self.readers.values()]
@@ -20,6 +20,7 @@
 import os
 import glob
 import struct
+import hashlib
 from fcntl import ioctl
 
 HID_MAX_DESCRIPTOR_SIZE = 4096
@@ -61,10 +62,24 @@ HID_MAIN_FEATURE = 0xB0
 HID_MAIN_COLLECTION = 0xA0
 HID_MAIN_END_COLLECTION = 0xC0
 
+HID_ITEM_LONG = 0xFE
+
 HID_LOCAL_USAGE = 0x08
+HID_LOCAL_USAGE_MINIMUM = 0x18
+HID_LOCAL_USAGE_MAXIMUM = 0x28
 
 HID_GLOBAL_USAGE_PAGE = 0x04
+HID_GLOBAL_LOGICAL_MINIMUM = 0x14
+HID_GLOBAL_LOGICAL_MAXIMUM = 0x24
+HID_GLOBAL_REPORT_SIZE = 0x74
 HID_GLOBAL_REPORT_ID = 0x84
+HID_GLOBAL_REPORT_COUNT = 0x94
+HID_GLOBAL_PUSH = 0xA4
+HID_GLOBAL_POP = 0xB4
+
+# main item data bits
+HID_FLAG_CONSTANT = 0x01
+HID_FLAG_VARIABLE = 0x02
 
 HID_COLLECTION_PHYSICAL = 0x00
 HID_COLLECTION_APPLICATION = 0x01
@@ -121,17 +136,60 @@ class Collection:
         
         return text
         
+# One value inside a report, located by bit offset and size from the start
+# of the report data (report id byte not included)
+class Field:
+    def __init__(self,usage,bit_offset,bit_size,logical_min = 0,logical_max = 0,flags = 0):
+        self.usage = usage
+        self.bit_offset = bit_offset
+        self.bit_size = bit_size
+        self.logical_min = logical_min
+        self.logical_max = logical_max
+        self.flags = flags
+        
+        self.first = bit_offset // 8
+        self.last = (bit_offset + bit_size - 1) // 8 + 1
+        self.shift = bit_offset % 8
+        self.mask = (1 << bit_size) - 1
+    
+    def get(self,data):
+        return (int.from_bytes(data[self.first:self.last],"little") >> self.shift) & self.mask
+    
+    def set(self,data,value):
+        current = int.from_bytes(data[self.first:self.last],"little")
+        mask = self.mask << self.shift
+        current = (current & ~mask) | ((value << self.shift) & mask)
+        data[self.first:self.last] = current.to_bytes(self.last - self.first,"little")
+    
+    def __str__(self):
+        usage = "padding" if self.usage == None else "{0:08x}".format(self.usage)
+        return "{0} bits {1}+{2} [{3},{4}]\n".format(usage,self.bit_offset,self.bit_size,self.logical_min,self.logical_max)
+
 class Report:
-    def __init__(self,id,report_type,usages):
+    def __init__(self,id,report_type,usages,fields = None,size = 0):
         self.id = id
         self.report_type = report_type
         self.usages = usages
+        self.fields = fields if fields != None else []
+        # in bits
+        self.size = size
+    
+    @property
+    def size_bytes(self):
+        return (self.size + 7) // 8
+    
+    def field(self,usage):
+        for f in self.fields:
+            if (f.usage == usage):
+                return f
+        
+        return None
         
     def __str__(self):
-        text = "{0} {1}\n".format(self.id,HID_MAIN[self.report_type])
+        text = "{0} {1} {2} bits\n".format(self.id,HID_MAIN[self.report_type],self.size)
         
-        for u in self.usages:
-            text = text + "...." + "{0:04x}\n".format(u)
+        for f in self.fields:
+            text = text + "...." + str(f)
         
         return text
 
@@ -145,15 +203,54 @@ def get_device_info(fd):
     
     return DeviceInfo(data[0], data[1], data[2])
 
+# Feature report I/O through a buffer allocated once: byte 0 holds the
+# report id and ioctl fills or reads the rest in place.
+class FeatureBuffer:
+    def __init__(self,id,size):
+        self.id = id
+        self.size = size
+        self.buffer = bytearray(1 + size)
+        self.data = memoryview(self.buffer)[1:]
+        self.get_cmd = HIDIOCGFEATURE | ((1 + size)<<16)
+        self.set_cmd = HIDIOCSFEATURE | ((1 + size)<<16)
+    
+    # returns a view of the report data, valid until next call
+    def get(self,fd):
+        self.buffer[0] = self.id
+        ioctl(fd,self.get_cmd,self.buffer,True)
+        return self.data
+    
+    def set(self,fd,data = None):
+        self.buffer[0] = self.id
+        if (data != None):
+            self.data[:] = data
+        ioctl(fd,self.set_cmd,self.buffer,True)
+
+# hidraw has no multi report ioctl, these just save the per call setup
+def get_features(fd,buffers):
+    return [b.get(fd) for b in buffers]
+
+def set_features(fd,buffers):
+    for b in buffers:
+        b.set(fd)
+
+_feature_buffers = {}
+
+def _get_feature_buffer(id,size):
+    key = (id,size)
+    buffer = _feature_buffers.get(key)
+    
+    if (buffer == None):
+        buffer = FeatureBuffer(id,size)
+        _feature_buffers[key] = buffer
+    
+    return buffer
+
 def set_feature(fd,id,data):
-    cmd = HIDIOCSFEATURE | ((1 + len(data))<<16)
-    data = bytes([id]) + data
-    return ioctl(fd,cmd,data)
+    return _get_feature_buffer(id,len(data)).set(fd,data)
 
 def get_feature(fd,id,size):
-    cmd = HIDIOCGFEATURE | ((1 + size)<<16)
-    data = bytes([id]) + bytes([0]*size)
-    return ioctl(fd,cmd,data)[1:]
+    return bytes(_get_feature_buffer(id,size).get(fd))
 
 def get_report_descriptor(fd):
     data = struct.pack("I",0)
@@ -165,54 +262,172 @@ def get_report_descriptor(fd):
     
     return struct.unpack("I{0}s".format(report_size),status)[1]
 
+class _ParserState:
+    def __init__(self):
+        self.globals = {
+            "usage_page": 0,
+            "logical_min": 0,
+            "logical_max": 0,
+            "report_size": 0,
+            "report_id": 0,
+            "report_count": 0
+        }
+        self.stack = []
+        self.reset_locals()
+    
+    def reset_locals(self):
+        self.usages = []
+        self.usage_min = None
+
+def _signed(value,size):
+    bits = size * 8
+    if (size > 0 and value & (1 << (bits - 1))):
+        value = value - (1 << bits)
+    
+    return value
+
+def _extended_usage(state,value,size):
+    # 4 byte usages carry their own page
+    if (size == 4):
+        return value
+    
+    return (state.globals["usage_page"] << 16) | value
+
+def _global_set(name,signed = False):
+    def handler(state,value,size):
+        state.globals[name] = _signed(value,size) if signed else value
+    
+    return handler
+
+def _global_push(state,value,size):
+    state.stack.append(dict(state.globals))
+
+def _global_pop(state,value,size):
+    if (state.stack):
+        state.globals = state.stack.pop()
+
+def _local_usage(state,value,size):
+    state.usages.append(_extended_usage(state,value,size))
+
+def _local_usage_min(state,value,size):
+    state.usage_min = _extended_usage(state,value,size)
+
+def _local_usage_max(state,value,size):
+    if (state.usage_min != None):
+        state.usages.extend(range(state.usage_min,_extended_usage(state,value,size) + 1))
+        state.usage_min = None
+
+def _main_collection(state,value,size,reports):
+    state.reset_locals()
+
+def _main_report(state,value,size,reports,main_type):
+    g = state.globals
+    key = (main_type,g["report_id"])
+    report = reports.get(key)
+    
+    if (report == None):
+        report = Report(g["report_id"],main_type,[])
+        reports[key] = report
+    
+    usages = state.usages
+    
+    for n in range(g["report_count"]):
+        usage = None
+        
+        if (not value & HID_FLAG_CONSTANT and value & HID_FLAG_VARIABLE and usages):
+            usage = usages[min(n,len(usages) - 1)]
+        
+        report.fields.append(Field(usage,report.size,g["report_size"],g["logical_min"],g["logical_max"],value))
+        report.size = report.size + g["report_size"]
+    
+    report.usages.extend(usages)
+    state.reset_locals()
+
+def _main_item(main_type):
+    def handler(state,value,size,reports):
+        _main_report(state,value,size,reports,main_type)
+    
+    return handler
+
+HID_MAIN_ITEMS = {
+    HID_MAIN_INPUT : _main_item(HID_MAIN_INPUT),
+    HID_MAIN_OUTPUT : _main_item(HID_MAIN_OUTPUT),
+    HID_MAIN_FEATURE : _main_item(HID_MAIN_FEATURE),
+    HID_MAIN_COLLECTION : _main_collection,
+    HID_MAIN_END_COLLECTION : _main_collection
+}
+
+HID_GLOBAL_ITEMS = {
+    HID_GLOBAL_USAGE_PAGE : _global_set("usage_page"),
+    HID_GLOBAL_LOGICAL_MINIMUM : _global_set("logical_min",True),
+    HID_GLOBAL_LOGICAL_MAXIMUM : _global_set("logical_max",True),
+    HID_GLOBAL_REPORT_SIZE : _global_set("report_size"),
+    HID_GLOBAL_REPORT_ID : _global_set("report_id"),
+    HID_GLOBAL_REPORT_COUNT : _global_set("report_count"),
+    HID_GLOBAL_PUSH : _global_push,
+    HID_GLOBAL_POP : _global_pop
+}
+
+HID_LOCAL_ITEMS = {
+    HID_LOCAL_USAGE : _local_usage,
+    HID_LOCAL_USAGE_MINIMUM : _local_usage_min,
+    HID_LOCAL_USAGE_MAXIMUM : _local_usage_max
+}
+
+# Returns a Report per (type, report id) with the bit layout of all of its
+# fields. Items without a handler in the tables above are skipped.
 def parse_report_descriptor(data):
     n = 0
     report_size = len(data)
-    usage_page = 0
-    usage = 0
-    report_id = 0
-    reports = []
-    usages = []
+    state = _ParserState()
+    reports = {}
     
     while (n<report_size):
         byte = data[n]
+        
+        if (byte == HID_ITEM_LONG):
+            if (n + 1 >= report_size):
+                break
+            n = n + 3 + data[n+1]
+            continue
+        
         bSize = HID_SIZE[byte & 0x03]
         bType = (byte & 0x0C) >> 2
-        bTag = (byte & 0xF0)
+        item = byte & 0xFC
+        value = int.from_bytes(data[n+1:n+1+bSize],"little")
         
         if (bType == HID_TYPE_MAIN):
-            main_type = byte & 0xFC
-            
-            if (main_type == HID_MAIN_COLLECTION):
-                collection_type = data[n+1]
-
-            if (main_type == HID_MAIN_END_COLLECTION):
-                pass
-                
-            if (main_type == HID_MAIN_INPUT or main_type == HID_MAIN_OUTPUT or main_type == HID_MAIN_FEATURE):
-                
-                reports.append(Report(report_id,main_type,usages))
-                usages = []
+            handler = HID_MAIN_ITEMS.get(item)
+            if (handler):
+                handler(state,value,bSize,reports)
         
-        if (bType == HID_TYPE_GLOBAL):
-            global_type = byte & 0xFC
-
-            if (global_type == HID_GLOBAL_USAGE_PAGE):
-                usage_page = data[n+1]
-
-            if (global_type == HID_GLOBAL_REPORT_ID):
-                report_id = data[n+1]
+        elif (bType == HID_TYPE_GLOBAL):
+            handler = HID_GLOBAL_ITEMS.get(item)
+            if (handler):
+                handler(state,value,bSize)
         
-        if (bType == HID_TYPE_LOCAL):
-            local_type = byte & 0xFC
-
-            if (local_type == HID_LOCAL_USAGE):
-                usage = data[n+1]
-                
-                usages.append((usage_page<<16) | usage)
+        elif (bType == HID_TYPE_LOCAL):
+            handler = HID_LOCAL_ITEMS.get(item)
+            if (handler):
+                handler(state,value,bSize)
         
         n = n + bSize
         n = n + 1
     
-    return reports
+    return list(reports.values())
+
+# parsed layouts, keyed by descriptor hash
+_layout_cache = {}
+
+def descriptor_hash(data):
+    return hashlib.sha1(data).hexdigest()
 
+def get_report_layout(data):
+    key = descriptor_hash(data)
+    reports = _layout_cache.get(key)
+    
+    if (reports == None):
+        reports = parse_report_descriptor(data)
+        _layout_cache[key] = reports
+    
+    return reports
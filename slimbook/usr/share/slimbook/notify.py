@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+# Slimbook Service
+# Copyright (C) 2022 Slimbook
+# In case you modify or redistribute this code you must keep the copyright line above.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import common
+
+import json
+import struct
+import threading
+import time
+
+# Notifications go out as a single json frame by default, as they always
+# did, so existing subscribers keep working; topics can't be filtered in
+# that mode. Binary mode is opt-in: two frames, topic and a fixed size
+# payload.
+FRAME_VERSION = 2
+
+# version, publisher instance, event code, sequence, CLOCK_MONOTONIC, realtime
+FRAME = struct.Struct("<BIIQdd")
+
+FORMAT_BINARY = "binary"
+FORMAT_JSON = "json"
+
+def topic(code):
+    return common.SLB_EVENT_TOPIC.get(code, common.SLB_TOPIC_EVENT)
+
+# Publishes notifications and keeps the last state of every topic, so late
+# subscribers can start from a snapshot instead of waiting for changes
+class Publisher:
+    def __init__(self, socket, format = FORMAT_JSON):
+        self.socket = socket
+        self.format = format
+        # tells subscribers sequences started over, start time in ms
+        self.instance = int(time.time() * 1000) & 0xFFFFFFFF
+        # one sequence per topic, so selective subscribers see no gaps
+        self.sequences = {}
+        self.topics = {}
+        self.frame = bytearray(FRAME.size)
+        self.published = 0
+        # topic -> last state event, snapshots are served from another thread
+        self.states = {}
+        self.lock = threading.Lock()
+
+    # lock must be held
+    def _set_state(self, name, code, monotonic, realtime):
+        if (code in common.SLB_STATE_EVENTS):
+            self.states[name] = {"code": code, "timestamp": realtime, "monotonic": monotonic}
+
+    # records a state that is not going to be notified
+    def update_state(self, code):
+        with self.lock:
+            self._set_state(topic(code), code, time.monotonic(), time.time())
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "instance": self.instance,
+                "monotonic": time.monotonic(),
+                "timestamp": time.time(),
+                "sequences": dict(self.sequences),
+                "states": {name: dict(state) for name, state in self.states.items()}
+            }
+
+    def publish(self, code):
+        name = topic(code)
+        monotonic = time.monotonic()
+        realtime = time.time()
+
+        with self.lock:
+            seq = self.sequences.get(name, 0) + 1
+            self.sequences[name] = seq
+            self._set_state(name, code, monotonic, realtime)
+
+        self.published += 1
+
+        if (self.format == FORMAT_JSON):
+            self.socket.send_json({"code": code, "timestamp": realtime,
+                "topic": name, "seq": seq, "monotonic": monotonic, "instance": self.instance})
+            return
+
+        prefix = self.topics.get(name)
+        if (prefix == None):
+            prefix = name.encode("ascii")
+            self.topics[name] = prefix
+
+        # frames this small are always copied by zmq, the buffer can be reused
+        FRAME.pack_into(self.frame, 0, FRAME_VERSION, self.instance, code, seq, monotonic, realtime)
+        self.socket.send_multipart([prefix, self.frame])
+
+# Decodes a notification from the frames of a received message, any format
+def decode(frames):
+    if (len(frames) == 1):
+        data = json.loads(frames[0])
+        code = data.get("code")
+        data.setdefault("topic", topic(code))
+        data.setdefault("seq", None)
+        data.setdefault("monotonic", None)
+        data.setdefault("instance", None)
+        return data
+
+    if (len(frames) != 2 or len(frames[1]) == 0):
+        raise ValueError("bad notification frame")
+
+    if (frames[1][0] != FRAME_VERSION):
+        raise ValueError("unknown notification frame version {0}".format(frames[1][0]))
+
+    if (len(frames[1]) != FRAME.size):
+        raise ValueError("bad notification frame")
+
+    version, instance, code, seq, monotonic, realtime = FRAME.unpack_from(frames[1])
+
+    return {"code": code, "timestamp": realtime, "topic": frames[0].decode("ascii"),
+        "seq": seq, "monotonic": monotonic, "instance": instance}
+
+# Tracks sequences per topic on the subscriber side
+class GapDetector:
+    def __init__(self):
+        self.last = {}
+        self.synced = {}
+        self.instance = None
+        self.lost = 0
+        self.restarts = 0
+
+    # sequences of another publisher instance mean nothing here
+    def _set_instance(self, instance):
+        if (instance == None or instance == self.instance):
+            return False
+
+        restarted = self.instance != None
+        self.instance = instance
+        self.last = {}
+        self.synced = {}
+
+        return restarted
+
+    # continues from the sequences of a snapshot, returns the topics that
+    # already got a notification newer than the snapshot
+    def sync(self, sequences, instance = None):
+        self._set_instance(instance)
+        self.synced = {}
+        newer = []
+
+        # never go back from what was already received
+        for name, seq in sequences.items():
+            if (seq > self.last.get(name, 0)):
+                self.last[name] = seq
+                self.synced[name] = seq
+            elif (seq < self.last.get(name, 0)):
+                newer.append(name)
+
+        return newer
+
+    # returns how many notifications were missed before this one, or None
+    # when it was already part of the last snapshot
+    def check(self, data):
+        seq = data.get("seq")
+        if (seq == None):
+            return 0
+
+        name = data.get("topic")
+
+        if (self._set_instance(data.get("instance"))):
+            self.restarts += 1
+
+        synced = self.synced.get(name)
+        if (synced != None):
+            if (seq <= synced):
+                return None
+            del self.synced[name]
+
+        last = self.last.get(name)
+        self.last[name] = seq
+
+        if (last == None):
+            return 0
+
+        if (seq <= last):
+            # publisher restarted, sequences start over
+            self.restarts += 1
+            return 0
+
+        lost = seq - last - 1
+        self.lost += lost
+
+        return lost
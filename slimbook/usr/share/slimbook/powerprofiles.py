@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+# Slimbook Service
+# Copyright (C) 2022 Slimbook
+# In case you modify or redistribute this code you must keep the copyright line above.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import common
+
+from gi.repository import GLib, Gio
+
+import subprocess
+import os
+import logging
+import threading
+import time
+
+logger = logging.getLogger("slimbook.service")
+
+PPD_BUS_NAME = "org.freedesktop.UPower.PowerProfiles"
+PPD_OBJECT_PATH = "/org/freedesktop/UPower/PowerProfiles"
+PPD_INTERFACE = "org.freedesktop.UPower.PowerProfiles"
+
+TUNED_BUS_NAME = "com.redhat.tuned"
+TUNED_OBJECT_PATH = "/Tuned"
+TUNED_INTERFACE = "com.redhat.tuned.control"
+
+DBUS_TIMEOUT = 5000
+
+# time to wait for more requests before applying, so a burst of Fn key
+# presses ends up in a single profile change
+SETTLE_TIME = 0.25
+
+# Applies power profiles from its own thread. Requests only store the
+# target profile, so any request still pending when a new one arrives is
+# replaced and only the latest profile gets applied.
+class ProfileApplier(threading.Thread):
+    def __init__(self, settle_time = SETTLE_TIME):
+        threading.Thread.__init__(self, name = 'slimbook.service.profile', daemon = True)
+        self.settle_time = settle_time
+        self.cond = threading.Condition()
+        self.pending = None
+        self.bus = None
+
+        self.requested = 0
+        self.applied = 0
+
+    def request(self, profile):
+        with self.cond:
+            self.requested += 1
+            self.pending = (profile, time.monotonic())
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while (self.pending == None):
+                    self.cond.wait()
+
+                # wait until no new request shows up for settle_time
+                while True:
+                    profile, stamp = self.pending
+                    remaining = stamp + self.settle_time - time.monotonic()
+                    if (remaining <= 0):
+                        break
+                    self.cond.wait(remaining)
+
+                self.pending = None
+
+            try:
+                self.apply(profile)
+                self.applied += 1
+            except Exception as e:
+                logger.error("failed to set power profile {0}: {1}".format(profile, e))
+
+    def apply(self, profile):
+        logger.debug("applying power profile {0}".format(profile))
+
+        if (os.path.exists("/usr/bin/powerprofilesctl")):
+            try:
+                self._ppd_set(profile)
+            except GLib.Error as e:
+                logger.warning("power-profiles-daemon D-Bus call failed: {0}".format(e))
+                subprocess.run(["/usr/bin/powerprofilesctl","set",profile])
+
+        elif (os.path.exists("/usr/bin/tuned-adm")):
+            try:
+                self._tuned_set(common.TUNED_PROFILE[profile])
+            except GLib.Error as e:
+                logger.warning("tuned D-Bus call failed: {0}".format(e))
+                subprocess.run(["/usr/bin/tuned-adm","profile",common.TUNED_PROFILE[profile]])
+
+    def _get_bus(self):
+        if (self.bus == None):
+            self.bus = Gio.bus_get_sync(Gio.BusType.SYSTEM, None)
+
+        return self.bus
+
+    def _ppd_set(self, profile):
+        self._get_bus().call_sync(
+            PPD_BUS_NAME,
+            PPD_OBJECT_PATH,
+            "org.freedesktop.DBus.Properties",
+            "Set",
+            GLib.Variant("(ssv)", (PPD_INTERFACE, "ActiveProfile", GLib.Variant("s", profile))),
+            None,
+            Gio.DBusCallFlags.NONE,
+            DBUS_TIMEOUT,
+            None)
+
+    def _tuned_set(self, profile):
+        ret = self._get_bus().call_sync(
+            TUNED_BUS_NAME,
+            TUNED_OBJECT_PATH,
+            TUNED_INTERFACE,
+            "switch_profile",
+            GLib.Variant("(s)", (profile,)),
+            GLib.VariantType.new("((bs))"),
+            Gio.DBusCallFlags.NONE,
+            DBUS_TIMEOUT,
+            None)
+
+        ok, message = ret.unpack()[0]
+        if (not ok):
+            logger.warning("tuned refused profile {0}: {1}".format(profile, message))
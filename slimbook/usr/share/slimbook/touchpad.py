@@ -18,14 +18,47 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import common
 import iohid
 
 import evdev
 import os
+import json
+import logging
+import threading
+
+logger = logging.getLogger("slimbook.service")
 
 BUTTON_SWITCH_USAGE_ID = (iohid.HID_USAGE_PAGE_DIGITIZER << 16) | iohid.HID_USAGE_DIGITIZER_BUTTON_SWITCH
 SURFACE_SWITCH_USAGE_ID = (iohid.HID_USAGE_PAGE_DIGITIZER << 16) | iohid.HID_USAGE_DIGITIZER_SURFACE_SWITCH
 
+HIDRAW_SYSFS_PATH = "/sys/class/hidraw/"
+INPUT_SYSFS_PATH = "/sys/class/input/"
+
+# ProX/Executive touchpad
+HIDRAW_VENDOR = 0x93A
+
+# sysfs device behind a /dev node, it stays the same while the device is
+# bound even if node numbers are handed out in a different order
+def sysfs_device(node):
+    name = os.path.basename(node)
+    
+    if (name.startswith("hidraw")):
+        path = os.path.join(HIDRAW_SYSFS_PATH, name, "device")
+    else:
+        path = os.path.join(INPUT_SYSFS_PATH, name, "device")
+    
+    return os.path.realpath(path)
+
+# returns the feature report holding both touchpad switches or None
+def find_switch_report(report):
+    for r in iohid.get_report_layout(report):
+        if r.report_type == iohid.HID_MAIN_FEATURE:
+            if r.field(BUTTON_SWITCH_USAGE_ID) and r.field(SURFACE_SWITCH_USAGE_ID):
+                return r
+    
+    return None
+
 class Touchpad:
     MODE_UNKNOWN = 0
     MODE_HIDRAW = 1
@@ -35,78 +68,227 @@ class Touchpad:
     STATE_LOCKED = 1
     STATE_UNLOCKED = 2
     
-    def __init__(self):
+    # The probe result is kept under /run together with what identifies
+    # the device (node, sysfs device, bus/vendor/product and a hash of the
+    # report descriptor), so a service restart only opens that node and
+    # checks it is still the same device instead of scanning all of them.
+    def __init__(self, cache_path = common.SLB_TOUCHPAD_PATH, scan = True):
         self.mode = Touchpad.MODE_UNKNOWN
         self.report_id = 0
+        self.feature = None
+        # surface and button switch fields of the feature report
+        self.switches = []
         self.fd = 0
         self.state = Touchpad.STATE_UNKNOWN
         self.device = None
+        self.cache_path = cache_path
+        # identity of the device in use
+        self.probe = None
         
-        for device in iohid.list_devices():
-            fd = os.open(device,os.O_RDWR)
-            info = iohid.get_device_info(fd)
-            found = False
+        if (not scan):
+            return
         
-            # ProX/Executive touchpad
-            if (info.bus == iohid.HID_BUS_I2C and info.vendor == 0x93A):
-                report = iohid.get_report_descriptor(fd)
-                reports = iohid.parse_report_descriptor(report)
-                
-                for r in reports:
-                    if r.report_type == iohid.HID_MAIN_FEATURE:
-                        button_switch = False
-                        surface_switch = False
-                        
-                        for usage in r.usages:
-                            
-                            if usage == BUTTON_SWITCH_USAGE_ID:
-                                button_switch = True
-                            if usage == SURFACE_SWITCH_USAGE_ID:
-                                surface_switch = True
-                        
-                        if button_switch and surface_switch:
-                            self.report_id = r.id
-                            self.fd = fd
-                            self.mode = Touchpad.MODE_HIDRAW
-                            found = True
-                if not found:
-                    os.close(fd)
-            else:
-                os.close(fd)
+        if (self._open_cached()):
+            logger.debug("touchpad found at cached {0}".format(self.probe["node"]))
+            return
         
-            if found:
-                try:
-                    self.get_state()
-                    return
-                except:
-                    #some devices fails with a errno 22 (Invalid Argument)
-                    #better to fallback to evdev grab method
-                    found = False
+        self._scan()
+        
+        if (self.probe != None):
+            self._store_cache()
     
-        found = False
+    def _open_cached(self):
+        try:
+            with open(self.cache_path, "r") as f:
+                probe = json.load(f)
+        except:
+            return False
+        
+        if (probe.get("mode") == Touchpad.MODE_HIDRAW):
+            return self._open_hidraw(probe["node"], probe)
+        if (probe.get("mode") == Touchpad.MODE_EVDEV):
+            return self._open_evdev(probe["node"], probe)
+        
+        return False
+    
+    def _store_cache(self):
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok = True)
+            tmp = self.cache_path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.probe, f)
+            os.replace(tmp, self.cache_path)
+        except Exception as e:
+            logger.warning("failed to store touchpad probe: {0}".format(e))
+    
+    def invalidate(self):
+        try:
+            os.unlink(self.cache_path)
+        except FileNotFoundError:
+            pass
+    
+    def _scan(self):
+        for node in sorted(iohid.list_devices()):
+            if (self._open_hidraw(node)):
+                return
+        
         # generic touchpad lookup based on evdev grabing
-        for devpath in evdev.list_devices():
-            device = evdev.InputDevice(devpath)
-    
-            for cap in device.capabilities():
-                # EV_KEY
-                if cap==1:
-                    for k in device.capabilities()[cap]:
-                        #BTN_TOUCH
-                        if k==330:
-                            self.device = device
-                            self.mode = Touchpad.MODE_EVDEV
-                            
-                            found = True
-                            break
+        for node in evdev.list_devices():
+            if (self._open_evdev(node)):
+                return
+    
+    # expected is a cached probe the device must match
+    def _open_hidraw(self, node, expected = None):
+        sysfs = sysfs_device(node)
+        if (expected and expected["sysfs"] != sysfs):
+            return False
+        
+        try:
+            fd = os.open(node, os.O_RDWR)
+        except OSError:
+            return False
+        
+        try:
+            info = iohid.get_device_info(fd)
+            if (info.bus != iohid.HID_BUS_I2C or info.vendor != HIDRAW_VENDOR):
+                raise ValueError("not a touchpad")
             
-            if found:
-                self.state = Touchpad.STATE_UNLOCKED
-                break
+            if (expected and [info.bus, info.vendor, info.product] != [expected["bus"], expected["vendor"], expected["product"]]):
+                raise ValueError("device changed")
+            
+            report = iohid.get_report_descriptor(fd)
+            descriptor = iohid.descriptor_hash(report)
+            
+            # the cached probe already has the switch layout
+            if (expected and expected["descriptor"] == descriptor and expected.get("switches")):
+                report_id = expected["report_id"]
+                report_size = expected["report_size"]
+                switches = [iohid.Field(usage, offset, size) for usage, offset, size in expected["switches"]]
+            else:
+                r = find_switch_report(report)
+                if (r == None):
+                    raise ValueError("no switch report")
+                
+                report_id = r.id
+                report_size = r.size_bytes
+                switches = [r.field(SURFACE_SWITCH_USAGE_ID), r.field(BUTTON_SWITCH_USAGE_ID)]
+            
+            self.fd = fd
+            self.report_id = report_id
+            self.feature = iohid.FeatureBuffer(report_id,report_size)
+            self.switches = switches
+            self.mode = Touchpad.MODE_HIDRAW
+            
+            #some devices fails with a errno 22 (Invalid Argument)
+            #better to fallback to evdev grab method
+            self.get_state()
+        except Exception:
+            os.close(fd)
+            self.fd = 0
+            self.report_id = 0
+            self.feature = None
+            self.switches = []
+            self.mode = Touchpad.MODE_UNKNOWN
+            self.state = Touchpad.STATE_UNKNOWN
+            return False
+        
+        self.probe = {
+            "mode": Touchpad.MODE_HIDRAW,
+            "node": node,
+            "sysfs": sysfs,
+            "bus": info.bus,
+            "vendor": info.vendor,
+            "product": info.product,
+            "descriptor": descriptor,
+            "report_id": report_id,
+            "report_size": report_size,
+            "switches": [[f.usage, f.bit_offset, f.bit_size] for f in switches]
+        }
+        
+        return True
+    
+    def _open_evdev(self, node, expected = None):
+        sysfs = sysfs_device(node)
+        if (expected and expected["sysfs"] != sysfs):
+            return False
+        
+        try:
+            device = evdev.InputDevice(node)
+        except OSError:
+            return False
+        
+        info = device.info
+        if (expected and [info.bustype, info.vendor, info.product] != [expected["bus"], expected["vendor"], expected["product"]]):
+            device.close()
+            return False
+        
+        if (evdev.ecodes.BTN_TOUCH not in device.capabilities().get(evdev.ecodes.EV_KEY, [])):
+            device.close()
+            return False
+        
+        self.device = device
+        self.mode = Touchpad.MODE_EVDEV
+        self.state = Touchpad.STATE_UNLOCKED
+        
+        self.probe = {
+            "mode": Touchpad.MODE_EVDEV,
+            "node": node,
+            "sysfs": sysfs,
+            "bus": info.bustype,
+            "vendor": info.vendor,
+            "product": info.product
+        }
+        
+        return True
+    
+    # tries a single node, used when udev reports a new one
+    def open_node(self, node):
+        if (os.path.basename(node).startswith("hidraw")):
+            found = self._open_hidraw(node)
+        else:
+            found = self._open_evdev(node)
+        
+        if (found):
+            self._store_cache()
+        
+        return found
+    
+    def owns(self, node):
+        return (self.probe != None and self.probe["node"] == node)
+    
+    def close(self):
+        if (self.fd > 0):
+            try:
+                os.close(self.fd)
+            except OSError:
+                pass
+        
+        if (self.device):
+            try:
+                self.device.close()
+            except OSError:
+                pass
+        
+        self.fd = 0
+        self.feature = None
+        self.switches = []
+        self.device = None
+        self.mode = Touchpad.MODE_UNKNOWN
+        self.state = Touchpad.STATE_UNKNOWN
+        self.probe = None
+    
+    # writes both switches keeping the rest of the report as it is
+    def _set_switches(self, value):
+        data = self.feature.get(self.fd)
+        
+        for field in self.switches:
+            field.set(data, value)
+        
+        self.feature.set(self.fd)
                 
     def lock(self):
         if self.mode == Touchpad.MODE_HIDRAW and self.fd>0:
-            iohid.set_feature(self.fd,self.report_id,bytes([0x00]))
+            self._set_switches(0)
         
         if self.mode == Touchpad.MODE_EVDEV and self.device:
             self.device.grab()
@@ -114,7 +296,7 @@ class Touchpad:
     
     def unlock(self):
         if self.mode == Touchpad.MODE_HIDRAW and self.fd>0:
-            iohid.set_feature(self.fd,self.report_id,bytes([0x03]))
+            self._set_switches(1)
             
         if self.mode == Touchpad.MODE_EVDEV and self.device:
             self.device.ungrab()
@@ -137,12 +319,9 @@ class Touchpad:
         
         if self.mode == Touchpad.MODE_HIDRAW and self.fd>0:
             self.state = Touchpad.MODE_UNKNOWN
-            data = iohid.get_feature(self.fd, self.report_id,1)
-            # mask is hardcoded, in the future maybe would be
-            # better to obtain it from report descriptor
-            data = int(data[0]) & 0x03
+            data = self.feature.get(self.fd)
             
-            if (data == 0):
+            if (not any(field.get(data) for field in self.switches)):
                 self.state = Touchpad.STATE_LOCKED
             else:
                 self.state = Touchpad.STATE_UNLOCKED
@@ -151,3 +330,80 @@ class Touchpad:
         
     def valid(self):
         return (self.mode != Touchpad.MODE_UNKNOWN)
+
+# Keeps a Touchpad usable across driver rebinds (suspend/resume, i2c-hid
+# reloads). udev add/remove events for hidraw and input nodes are fed to
+# on_udev_event, which only looks at the node that changed, and the last
+# lock state set through toggle() is applied again to the new device.
+class TouchpadManager:
+    MODE_UNKNOWN = Touchpad.MODE_UNKNOWN
+    MODE_HIDRAW = Touchpad.MODE_HIDRAW
+    MODE_EVDEV = Touchpad.MODE_EVDEV
+    
+    STATE_UNKNOWN = Touchpad.STATE_UNKNOWN
+    STATE_LOCKED = Touchpad.STATE_LOCKED
+    STATE_UNLOCKED = Touchpad.STATE_UNLOCKED
+    
+    def __init__(self, cache_path = common.SLB_TOUCHPAD_PATH):
+        self.cache_path = cache_path
+        # toggles come from the event thread and udev events may not
+        self.lock = threading.Lock()
+        self.touchpad = Touchpad(cache_path)
+        self.wanted_state = TouchpadManager.STATE_UNKNOWN
+        
+        self.rebinds = 0
+    
+    @property
+    def mode(self):
+        return self.touchpad.mode
+    
+    def valid(self):
+        return self.touchpad.valid()
+    
+    def toggle(self):
+        with self.lock:
+            self.touchpad.toggle()
+            self.wanted_state = self.touchpad.get_state()
+    
+    def get_state(self):
+        with self.lock:
+            return self.touchpad.get_state()
+    
+    def on_udev_event(self, action, node):
+        if (node == None):
+            return
+        
+        with self.lock:
+            if (action == "remove"):
+                if (self.touchpad.owns(node)):
+                    logger.info("touchpad {0} removed".format(node))
+                    self.touchpad.close()
+                    self.touchpad.invalidate()
+            
+            elif (action == "add"):
+                current = self.touchpad.mode
+                
+                # hidraw access is preferred over an evdev grab
+                if (current == TouchpadManager.MODE_HIDRAW):
+                    return
+                if (current == TouchpadManager.MODE_EVDEV and not os.path.basename(node).startswith("hidraw")):
+                    return
+                
+                touchpad = Touchpad(self.cache_path, scan = False)
+                if (not touchpad.open_node(node)):
+                    return
+                
+                logger.info("touchpad found at {0}".format(node))
+                self.touchpad.close()
+                self.touchpad = touchpad
+                self.rebinds += 1
+                self._restore_state()
+    
+    def _restore_state(self):
+        try:
+            if (self.wanted_state == TouchpadManager.STATE_LOCKED):
+                self.touchpad.lock()
+            elif (self.wanted_state == TouchpadManager.STATE_UNLOCKED):
+                self.touchpad.unlock()
+        except Exception as e:
+            logger.warning("failed to restore touchpad state: {0}".format(e))